@@ -6,8 +6,21 @@ __all__ = [
     "constants",
     "ephemeris",
     "twitter_client",
+    "storage",
     "postgresql_client",
+    "sqlite_client",
+    "memory_storage",
+    "pipeline",
+    "publisher",
+    "retry",
+    "scheduler",
     "data_loader",
+    "data_exporter",
+    "compression",
+    "partitioning",
+    "tracing",
+    "maps",
+    "selection",
 ]
 
 from almanacbot import (
@@ -16,6 +29,19 @@ from almanacbot import (
     constants,
     ephemeris,
     twitter_client,
+    storage,
     postgresql_client,
+    sqlite_client,
+    memory_storage,
+    pipeline,
+    publisher,
+    retry,
+    scheduler,
     data_loader,
+    data_exporter,
+    compression,
+    partitioning,
+    tracing,
+    maps,
+    selection,
 )
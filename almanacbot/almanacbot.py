@@ -1,38 +1,70 @@
 """Almanac Bot module"""
 
 import argparse
+import datetime
 import json
 import logging
 import logging.config
 import os
+import signal
 import sys
-from typing import List
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
 
 from babel import Locale, UnknownLocaleError
 
-from almanacbot import config, constants
+from almanacbot import config, constants, logs, retry, tracing
+from almanacbot.clock import Clock, utc_now
 from almanacbot.ephemeris import Ephemeris
-from almanacbot.postgresql_client import PostgreSQLClient
-from almanacbot.twitter_client import TwitterClient
+from almanacbot.maps import MediaCache
+from almanacbot.pipeline import AcknowledgementWriter
+from almanacbot.publisher import FanOutPublisher, PublishTarget, create_target
+from almanacbot.scheduler import PostingSchedule, parse_windows
+from almanacbot.selection import Scoring
+from almanacbot.storage import (
+    EphemerisStorage,
+    InsertListener,
+    PostRecord,
+    RetryEntry,
+    create_channel_storages,
+)
 
 logger = logging.getLogger("almanacbot")
 
 
+@dataclass
+class Channel:
+    """Ephemeris corpus posted to its own publishing targets"""
+
+    name: str
+    storage: EphemerisStorage
+    publisher: FanOutPublisher
+
+
 class AlmanacBot:
     """Almanac Bot class"""
 
-    def __init__(self):
+    def __init__(self, now: Clock = utc_now):
+        self.now: Clock = now
         self.conf: config.Configuration = None
-        self.twitter_client: TwitterClient = None
-        self.postgresql_client: PostgreSQLClient = None
+        self.targets: Dict[str, PublishTarget] = None
+        self.channels: List[Channel] = None
+        self.ack_queue_size: int = None
+        self.ack_batch_size: int = None
+        self.retry_batch_size: int = None
+        self.retry_lease: datetime.timedelta = None
+        self.schedule: PostingSchedule = None
 
-        # configure logger
+        # configure logger and tracing
         self._setup_logging()
+        tracing.configure(os.getenv(constants.TRACES_ENVVAR))
 
         # read configuration
         logger.info("Initializing Almanac Bot...")
         try:
-            self.conf = config.Configuration(constants.CONFIG_FILE_NAME)
+            with tracing.span("config.load", path=constants.CONFIG_FILE_NAME):
+                self.conf = config.Configuration(constants.CONFIG_FILE_NAME)
         except ValueError:
             logger.exception("Error getting configuration.")
             sys.exit(1)
@@ -40,27 +72,68 @@ class AlmanacBot:
         # setup locale
         try:
             self.locale: Locale = Locale.parse(self.conf.config["language"]["locale"])
-            logger.info(f"Locale set to: {self.locale}")
+            logger.info("Locale set to: %s", self.locale)
         except (ValueError, UnknownLocaleError):
             logger.exception("Error setting up locale.")
             sys.exit(1)
 
-        # setup Twitter API client
+        # setup publishing targets
+        try:
+            self._setup_publisher()
+        except (ValueError, UnknownLocaleError):
+            logger.exception("Error setting up publishing targets.")
+            sys.exit(1)
+
+        # setup channels, with their storage backend
         try:
-            self._setup_twitter()
+            self._setup_channels()
         except ValueError:
-            logger.exception("Error setting up Twitter API client.")
+            logger.exception("Error setting up channels.")
             sys.exit(1)
 
-        # setup PostgreSQL client
+        # setup posting schedule
         try:
-            self._setup_postgresql()
+            self._setup_schedule()
         except ValueError:
-            logger.exception("Error setting up PostgreSQL client.")
+            logger.exception("Error setting up posting schedule.")
             sys.exit(1)
 
+        self.ack_queue_size = self.conf.config["pipeline"]["ack_queue_size"]
+        self.ack_batch_size = self.conf.config["pipeline"]["ack_batch_size"]
+        self.retry_batch_size = self.conf.config["retry"]["batch_size"]
+        self.retry_lease = datetime.timedelta(
+            seconds=self.conf.config["retry"]["lease"]
+        )
+
         logger.info("Almanac Bot properly initialized.")
 
+    @classmethod
+    def from_channels(
+        cls,
+        channels: List[Channel],
+        schedule: Optional[PostingSchedule] = None,
+        now: Clock = utc_now,
+    ) -> "AlmanacBot":
+        """
+        Create a bot running the given channels, without reading the
+        configuration nor setting up logging, e.g. to simulate runs.
+        """
+        bot: AlmanacBot = cls.__new__(cls)
+        bot.now = now
+        bot.conf = None
+        bot.targets = {
+            target.name: target
+            for channel in channels
+            for target in channel.publisher.targets
+        }
+        bot.channels = channels
+        bot.ack_queue_size = 100
+        bot.ack_batch_size = 50
+        bot.retry_batch_size = 50
+        bot.retry_lease = datetime.timedelta(minutes=15)
+        bot.schedule = schedule or PostingSchedule()
+        return bot
+
     def _setup_logging(
         self,
         path="logging.json",
@@ -74,78 +147,384 @@ class AlmanacBot:
             with open(path, "rt", encoding="UTF-8") as f:
                 log_conf = json.load(f)
                 logging.config.dictConfig(log_conf)
-                logger.debug(f"Loaded logging configuration:\n{log_conf}")
+            logger_names: List[str] = list(log_conf.get("loggers", {}))
         else:
             logging.basicConfig(level=log_level)
-            logger.debug("Default logging configuration applied.")
-
-    def _setup_twitter(self) -> None:
-        logger.info("Setting up Twitter API client...")
-        self.twitter_client = TwitterClient(
-            bearer_token=self.conf.config["twitter"]["bearer_token"],
-            consumer_key=self.conf.config["twitter"]["consumer_key"],
-            consumer_secret=self.conf.config["twitter"]["consumer_secret"],
-            access_token_key=self.conf.config["twitter"]["access_token_key"],
-            access_token_secret=self.conf.config["twitter"]["access_token_secret"],
-            locale=self.locale,
+            logger_names = []
+            path = "default"
+        # console and file I/O happen off the posting threads
+        logs.enqueue_handlers(
+            [logging.getLogger(), *map(logging.getLogger, logger_names)],
+            json_format=os.getenv(constants.LOG_FORMAT_ENVVAR) == "json",
+        )
+        logger.debug("Applied %s logging configuration.", path)
+
+    def _setup_publisher(self) -> None:
+        logger.info("Setting up publishing targets...")
+        self.targets = {
+            target_conf["name"]: create_target(target_conf, self.now)
+            for target_conf in self.conf.config["targets"]
+        }
+        logger.info("Publishing targets set up: %s.", ", ".join(self.targets))
+
+    def _setup_channels(self) -> None:
+        logger.info(
+            "Setting up channels on %s storage backend...",
+            self.conf.config["storage"]["backend"],
+        )
+        storages: Dict[str, EphemerisStorage] = create_channel_storages(
+            self.conf.config, self.now
         )
-        logger.info("Twitter API client set up.")
-
-    def _setup_postgresql(self) -> None:
-        logger.info("Setting up PostgreSQL client...")
-        self.postgresql_client: PostgreSQLClient = PostgreSQLClient(
-            user=self.conf.config["postgresql"]["user"],
-            password=self.conf.config["postgresql"]["password"],
-            hostname=self.conf.config["postgresql"]["hostname"],
-            database=self.conf.config["postgresql"]["database"],
-            ephemeris_table=self.conf.config["postgresql"]["ephemeris_table"],
-            logging_echo=bool(self.conf.config["postgresql"]["logging_echo"]),
+        maps_conf: dict = self.conf.config["maps"]
+        # one cache for every channel, so that maps are uploaded once per target
+        media: Optional[MediaCache] = (
+            MediaCache(
+                maps_conf["cache_dir"],
+                precision=maps_conf["precision"],
+                width=maps_conf["width"],
+                span=maps_conf["span"],
+                coastlines=maps_conf["coastlines"],
+                now=self.now,
+            )
+            if maps_conf["cache_dir"]
+            else None
         )
-        logger.info("PostgreSQL client set up.")
+        self.channels = []
+        for channel_conf in self.conf.config["channels"]:
+            names: List[str] = channel_conf["targets"] or list(self.targets)
+            unknown: Set[str] = set(names) - self.targets.keys()
+            if unknown:
+                raise ValueError(
+                    f"Unknown targets of channel {channel_conf['name']}: {unknown}"
+                )
+            self.channels.append(
+                Channel(
+                    name=channel_conf["name"],
+                    storage=storages[channel_conf["name"]],
+                    publisher=FanOutPublisher(
+                        [self.targets[name] for name in names],
+                        now=self.now,
+                        media=media,
+                    ),
+                )
+            )
+            logger.info(
+                "Channel %s set up, posting to %s.",
+                channel_conf["name"],
+                ", ".join(names),
+            )
 
-    def run(self, dry_run: bool = False) -> int:
+    def _setup_schedule(self) -> None:
+        logger.info("Setting up posting schedule...")
+        self.schedule = PostingSchedule(
+            windows=parse_windows(self.conf.config["schedule"]["windows"]),
+            timezone=self.conf.config["schedule"]["timezone"],
+            daily_cap=self.conf.config["schedule"]["daily_cap"],
+            scoring=Scoring(**self.conf.config["selection"]),
+        )
+        logger.info(
+            "Posting schedule set up: %s.",
+            ", ".join(map(str, self.schedule.windows))
+            or (
+                f"at most {self.schedule.daily_cap} a day"
+                if self.schedule.daily_cap
+                else "all at once"
+            ),
+        )
+
+    def _thread_heads(self, channel: Channel) -> Dict[str, str]:
+        """Last post of today's thread of each thread bundling target."""
+        names: Set[str] = {
+            target.name
+            for target in channel.publisher.targets
+            if target.bundle == "thread"
+        }
+        if not names:
+            return {}
+        now: datetime.datetime = self.now()
+        day_start: datetime.datetime = now.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        heads: Dict[str, str] = {}
+        for post in channel.storage.get_post_history(
+            day_start, day_start + datetime.timedelta(days=1)
+        ):
+            if post.target in names and post.post_id is not None:
+                heads[post.target] = post.post_id
+        return heads
+
+    def _schedule_retry(
+        self,
+        channel: Channel,
+        eph: Ephemeris,
+        attempts: int,
+        errors: Dict[str, Exception],
+    ) -> None:
+        now: datetime.datetime = self.now()
+        # retried as soon as one of the failed targets may be retried
+        retry_at: Optional[datetime.datetime] = min(
+            (
+                retry_time
+                for exc in errors.values()
+                if (retry_time := retry.next_attempt_at(exc, attempts, now))
+            ),
+            default=None,
+        )
+        multi_target: bool = len(channel.publisher.targets) > 1
+        error_class: str = ", ".join(
+            sorted({type(exc).__name__ for exc in errors.values()})
+        )
+        error: str = "; ".join(
+            f"{name}: {exc}" if multi_target else str(exc)
+            for name, exc in errors.items()
+        )
+        try:
+            channel.storage.schedule_retry(
+                eph.id, attempts, error_class, error, retry_at
+            )
+        except Exception:
+            logger.exception("Failed to schedule retry of ephemeris id=%s", eph.id)
+            return
+        if retry_at:
+            logger.info(
+                "Retry #%s of ephemeris id=%s to %s at %s",
+                attempts,
+                eph.id,
+                ", ".join(errors),
+                retry_at,
+            )
+        else:
+            logger.warning(
+                "Giving up ephemeris id=%s after %s attempts, "
+                "kept in the retry outbox.",
+                eph.id,
+                attempts,
+            )
+
+    def run(self, dry_run: bool = False, retry_only: bool = False) -> int:
         """
-        Execute once: get untweeted ephemeris for today, tweet them.
+        Execute once for every channel: retry due failed posts, get untweeted
+        ephemeris for today, post the share of them planned by the posting
+        schedule to every publishing target of the channel. Failed posts are
+        written to the retry outbox.
 
         Args:
             dry_run: If True, log what would be tweeted without actually tweeting.
+            retry_only: If True, only retry the due failed posts.
 
         Returns:
-            Number of tweets sent (or would be sent in dry-run mode).
+            Number of ephemeris posted to every target (or would be posted in
+            dry-run mode).
         """
-        logger.info("Getting today's untweeted ephemeris...")
-        today_ephs: List[Ephemeris] = (
-            self.postgresql_client.get_untweeted_today_ephemeris()
-        )
+        run_id: str = logs.start_run()
+        logger.info("Starting run %s...", run_id)
+        tweets_sent: int = 0
+        with tracing.span("run", run_id=run_id, dry_run=dry_run) as span:
+            for channel in self.channels:
+                logger.info("Running channel %s...", channel.name)
+                with tracing.span("channel", channel=channel.name):
+                    tweets_sent += self._run_channel(channel, dry_run, retry_only)
+            span.set("posted", tweets_sent)
+        tracing.flush()
+        return tweets_sent
+
+    def listen(
+        self,
+        dry_run: bool = False,
+        timeout: float = 5.0,
+        stop: Optional[threading.Event] = None,
+    ) -> int:
+        """
+        Post the ephemeris inserted for today as soon as the storage of their
+        channel notifies them, until stop is set.
+
+        Each channel listens on its own connection. Listeners are waited for in
+        turn, so with n channels a wait lasts up to timeout / n seconds; stop
+        is checked between waits.
+
+        Returns:
+            Number of inserted ephemeris posted to every target.
+
+        Raises:
+            ValueError: if no channel storage can notify its inserts.
+        """
+        stop = stop or threading.Event()
+        listeners: List[Tuple[Channel, InsertListener]] = []
+        try:
+            for channel in self.channels:
+                listener: Optional[InsertListener] = channel.storage.listen_inserts()
+                if listener is None:
+                    logger.warning(
+                        "Storage of channel %s cannot notify inserts.", channel.name
+                    )
+                else:
+                    listeners.append((channel, listener))
+            if not listeners:
+                raise ValueError("No channel storage can notify inserts.")
+            logger.info(
+                "Listening for inserts into channels %s...",
+                ", ".join(channel.name for channel, _ in listeners),
+            )
+
+            tweets_sent: int = 0
+            while not stop.is_set():
+                for channel, listener in listeners:
+                    inserted: List[int] = listener.wait(timeout / len(listeners))
+                    if not inserted:
+                        continue
+                    run_id: str = logs.start_run()
+                    logger.info(
+                        "Starting run %s for %d ephemeris inserted into channel %s.",
+                        run_id,
+                        len(inserted),
+                        channel.name,
+                    )
+                    with tracing.span(
+                        "run", run_id=run_id, channel=channel.name, dry_run=dry_run
+                    ):
+                        tweets_sent += self._run_channel(
+                            channel, dry_run, retry_only=False, inserted=set(inserted)
+                        )
+                    tracing.flush()
+            return tweets_sent
+        finally:
+            for _, listener in listeners:
+                listener.close()
+
+    def _run_channel(
+        self,
+        channel: Channel,
+        dry_run: bool,
+        retry_only: bool,
+        inserted: Optional[Set[int]] = None,
+    ) -> int:
+        with logs.stage("select"), tracing.span("select"):
+            if inserted is not None:
+                # inserted ephemeris are posted at once, outside the schedule
+                logger.info("Getting the ephemeris inserted for today...")
+                due_retries: List[RetryEntry] = []
+                today_ephs: List[Ephemeris] = [
+                    eph
+                    for eph in channel.storage.get_untweeted_today_ephemeris()
+                    if eph.id in inserted
+                ]
+            else:
+                logger.info("Claiming due retries...")
+                # dry runs leave the due retries to the next run
+                due_retries = channel.storage.claim_due_retries(
+                    self.retry_batch_size,
+                    datetime.timedelta(0) if dry_run else self.retry_lease,
+                )
+                today_ephs = [entry.ephemeris for entry in due_retries]
+            attempts: Dict[int, int] = {
+                entry.ephemeris.id: entry.attempts for entry in due_retries
+            }
+
+            if inserted is None and not retry_only:
+                logger.info("Getting today's untweeted ephemeris...")
+                today_ephs.extend(
+                    self.schedule.plan(channel.storage, self.now(), exclude=attempts)
+                )
+
+            if not dry_run:
+                # overlapping runs, e.g. a scheduled one and a listening one,
+                # each post only the ephemeris they claim
+                claimed: Set[int] = set(
+                    channel.storage.claim_ephemeris(
+                        [eph.id for eph in today_ephs if eph.id not in attempts],
+                        self.retry_lease,
+                    )
+                )
+                today_ephs = [
+                    eph for eph in today_ephs if eph.id in attempts or eph.id in claimed
+                ]
 
         if not today_ephs:
             logger.info("No untweeted ephemeris for today.")
             return 0
 
-        logger.debug(f"Found {len(today_ephs)} untweeted ephemeris entries.")
+        logger.debug(
+            "Found %d untweeted ephemeris entries, %d of them retries.",
+            len(today_ephs),
+            len(due_retries),
+        )
 
-        tweets_sent = 0
-        for eph in today_ephs:
-            try:
+        # targets post concurrently while a background writer acknowledges in
+        # batches; partial deliveries are only tracked with several targets
+        track_deliveries: bool = len(channel.publisher.targets) > 1 and not dry_run
+        delivered: Dict[int, Set[str]] = (
+            channel.storage.get_deliveries([eph.id for eph in today_ephs])
+            if track_deliveries
+            else {}
+        )
+        completed: List[int] = []
+        with (
+            logs.stage("publish"),
+            tracing.span("publish", ephemeris_id=[eph.id for eph in today_ephs]),
+            AcknowledgementWriter(
+                channel.storage,
+                queue_size=self.ack_queue_size,
+                batch_size=self.ack_batch_size,
+            ) as ack_writer,
+        ):
+
+            def on_delivery(eph: Ephemeris, post: PostRecord) -> None:
                 if dry_run:
-                    text = TwitterClient._process_tweet_text(eph, self.locale)
-                    logger.info(f"[DRY-RUN] Would tweet id={eph.id}: {text}")
-                else:
-                    logger.info(f"Tweeting ephemeris id={eph.id}...")
-                    self.twitter_client.tweet_ephemeris(eph)
-                    self.postgresql_client.mark_as_tweeted(eph.id)
-                    logger.info(f"Successfully tweeted ephemeris id={eph.id}")
-                tweets_sent += 1
-            except Exception:
-                logger.exception(f"Failed to tweet ephemeris id={eph.id}")
+                    return
+                ack_writer.record(post)
+                if track_deliveries:
+                    ack_writer.deliver(eph.id, post.target)
+
+            def on_complete(
+                results: List[Tuple[Ephemeris, Dict[str, Exception]]],
+            ) -> None:
+                posted: List[int] = []
+                for eph, errors in results:
+                    if not errors:
+                        posted.append(eph.id)
+                    elif not dry_run:
+                        self._schedule_retry(
+                            channel, eph, attempts.get(eph.id, 0) + 1, errors
+                        )
+                if not posted:
+                    return
+                # ephemeris bundled in the same posts are marked together
+                if not dry_run:
+                    ack_writer.acknowledge_many(posted)
+                    logger.info(
+                        "Successfully posted ephemeris id=%s "
+                        "(queued acknowledgements: %d)",
+                        ", ".join(map(str, posted)),
+                        ack_writer.depth,
+                    )
+                completed.extend(posted)
 
+            channel.publisher.publish(
+                today_ephs,
+                delivered,
+                on_delivery,
+                on_complete,
+                dry_run=dry_run,
+                threads=self._thread_heads(channel) if not dry_run else None,
+            )
+        tweets_sent = len(completed)
+
+        if not dry_run:
+            logger.info(
+                "Acknowledged %d tweets, %d failed "
+                "(acknowledgement queue peak depth: %d/%d).",
+                len(ack_writer.acknowledged),
+                len(ack_writer.failed),
+                ack_writer.peak_depth,
+                self.ack_queue_size,
+            )
         mode = "would be sent" if dry_run else "sent"
-        logger.info(f"Completed: {tweets_sent}/{len(today_ephs)} tweets {mode}.")
+        logger.info("Completed: %d/%d tweets %s.", tweets_sent, len(today_ephs), mode)
         return tweets_sent
 
 
 def main() -> None:
-    """Main entry point for one-shot execution."""
+    """Main entry point for one-shot execution, or listening for inserts."""
     parser = argparse.ArgumentParser(
         description="Almanac Bot - Tweet historical events"
     )
@@ -154,15 +533,37 @@ def main() -> None:
         action="store_true",
         help="Log tweets without actually sending them",
     )
+    parser.add_argument(
+        "--retry-only",
+        action="store_true",
+        help="Only retry failed tweets that are due",
+    )
+    parser.add_argument(
+        "--listen",
+        action="store_true",
+        help="After the run, keep posting the events inserted for today as "
+        "soon as they are inserted",
+    )
     args = parser.parse_args()
 
-    logger.info("Starting Almanac Bot (one-shot mode)...")
+    logger.info(
+        "Starting Almanac Bot (%s mode)...", "listen" if args.listen else "one-shot"
+    )
 
     ab = AlmanacBot()
-    tweets_sent = ab.run(dry_run=args.dry_run)
+    tweets_sent = ab.run(dry_run=args.dry_run, retry_only=args.retry_only)
+    if args.listen:
+        # stop between runs on `docker stop`, instead of in the middle of one
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            tweets_sent += ab.listen(dry_run=args.dry_run, stop=stop)
+        except ValueError:
+            logger.exception("Error listening for inserts.")
+            sys.exit(1)
 
     mode = "would be" if args.dry_run else ""
-    logger.info(f"Almanac Bot finished. Tweets {mode} sent: {tweets_sent}")
+    logger.info("Almanac Bot finished. Tweets %s sent: %d", mode, tweets_sent)
     sys.exit(0)
 
 
@@ -0,0 +1,27 @@
+"""Clocks telling the bot what day it is, injectable to replay other days"""
+
+import datetime
+from typing import Callable
+
+# Returns the current time, as an aware datetime.
+Clock = Callable[[], datetime.datetime]
+
+
+def utc_now() -> datetime.datetime:
+    """Wall clock, in UTC."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class SimulatedClock:
+    """Clock standing still at a given time, until it is moved."""
+
+    def __init__(self, now: datetime.datetime):
+        if now.tzinfo is None:
+            raise ValueError(f"Simulated time must be timezone aware: {now}")
+        self.now: datetime.datetime = now
+
+    def __call__(self) -> datetime.datetime:
+        return self.now
+
+    def advance(self, delta: datetime.timedelta) -> None:
+        self.now += delta
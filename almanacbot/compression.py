@@ -0,0 +1,49 @@
+"""Transparent gzip/zstd compression of data files, chosen by file extension"""
+
+import gzip
+import io
+import os
+from typing import BinaryIO, Dict, Optional
+
+EXTENSIONS: Dict[str, str] = {
+    ".gz": "gzip",
+    ".zst": "zstd",
+}
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """Return the compression of path according to its extension, if any."""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_compression_extension(path: str) -> str:
+    """Return path without its compression extension, e.g. `a.csv.gz` -> `a.csv`."""
+    root, extension = os.path.splitext(path)
+    return root if extension.lower() in EXTENSIONS else path
+
+
+def format_extension(path: str) -> str:
+    """Return the data format extension of path, e.g. `a.CSV.gz` -> `.csv`."""
+    return os.path.splitext(strip_compression_extension(path))[1].lower()
+
+
+def open_file(path: str, mode: str) -> BinaryIO:
+    """
+    Open path in binary mode ("rb" or "wb"), (de)compressing on the fly.
+
+    zstd support requires the zstandard package to be installed.
+    """
+    compression: Optional[str] = detect_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, mode)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as exc:
+            raise ValueError(
+                "zstd compression requires zstandard to be installed"
+            ) from exc
+        if mode == "rb":
+            return io.BufferedReader(zstandard.open(path, "rb"))
+        return zstandard.open(path, "wb", cctx=zstandard.ZstdCompressor(level=3))
+    return open(path, mode)
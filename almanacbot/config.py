@@ -3,6 +3,8 @@
 import configparser
 import logging
 
+from almanacbot.templates import MAX_TWEET_LENGTH
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,8 +25,14 @@ class Configuration:
         try:
             logger.info("Reading configuration...")
             self.__read_language_configuration()
-            self.__read_twitter_configuration()
-            self.__read_postgresql_configuration()
+            self.__read_targets_configuration()
+            self.__read_storage_configuration()
+            self.__read_channels_configuration()
+            self.__read_pipeline_configuration()
+            self.__read_retry_configuration()
+            self.__read_schedule_configuration()
+            self.__read_selection_configuration()
+            self.__read_maps_configuration()
             logger.info("Configuration correctly read.")
         except Exception as e:
             err_msg = (
@@ -64,6 +72,69 @@ class Configuration:
 
         logger.debug("Twitter configuration correctly read.")
 
+    def __read_targets_configuration(self):
+        logger.debug("Reading publishing targets configuration...")
+
+        targets_conf = self._config["targets"] = []
+
+        for section in self._config_parser.sections():
+            if not section.startswith("target:"):
+                continue
+            target_conf = dict(self._config_parser.items(section))
+            target_conf["name"] = section.removeprefix("target:")
+            target_conf["type"] = self._config_parser.get(section, "type")
+            target_conf["locale"] = self._config_parser.get(
+                section, "locale", fallback=self._config["language"]["locale"]
+            )
+            target_conf["min_interval"] = self._config_parser.getfloat(
+                section, "min_interval", fallback=0.0
+            )
+            target_conf["bundle"] = self._config_parser.get(
+                section, "bundle", fallback="none"
+            )
+            target_conf["max_length"] = self._config_parser.getint(
+                section, "max_length", fallback=MAX_TWEET_LENGTH
+            )
+            target_conf["maps"] = self._config_parser.getboolean(
+                section, "maps", fallback=True
+            )
+            targets_conf.append(target_conf)
+
+        # a single Twitter account, configured in the [twitter] section
+        if not targets_conf:
+            self.__read_twitter_configuration()
+            targets_conf.append(
+                {
+                    "name": "twitter",
+                    "type": "twitter",
+                    "locale": self._config["language"]["locale"],
+                    "min_interval": 0.0,
+                    **self._config["twitter"],
+                }
+            )
+
+        logger.debug("Publishing targets configuration correctly read.")
+
+    def __read_storage_configuration(self):
+        logger.debug("Reading storage configuration...")
+
+        storage_conf = self._config["storage"] = {}
+
+        storage_conf["backend"] = self._config_parser.get(
+            "storage", "backend", fallback="postgresql"
+        )
+
+        logger.debug("Storage configuration correctly read.")
+
+        if storage_conf["backend"] == "postgresql":
+            self.__read_postgresql_configuration()
+        elif storage_conf["backend"] == "sqlite":
+            self.__read_sqlite_configuration()
+        elif storage_conf["backend"] == "memory":
+            self.__read_memory_configuration()
+        else:
+            raise ValueError(f"Unknown storage backend: {storage_conf['backend']}")
+
     def __read_postgresql_configuration(self):
         logger.debug("Reading PostgreSQL configuration...")
 
@@ -79,9 +150,185 @@ class Configuration:
         postgresql_conf["logging_echo"] = self._config_parser.get(
             "postgresql", "logging_echo"
         )
+        postgresql_conf["schema"] = (
+            self._config_parser.get("postgresql", "schema", fallback="") or None
+        )
+        # executions before a statement is prepared on the server, empty: never
+        prepare_threshold: str = self._config_parser.get(
+            "postgresql", "prepare_threshold", fallback="5"
+        )
+        postgresql_conf["prepare_threshold"] = (
+            int(prepare_threshold) if prepare_threshold else None
+        )
+        postgresql_conf["partitioned"] = self._config_parser.getboolean(
+            "postgresql", "partitioned", fallback=False
+        )
 
         logger.debug("PostgreSQL configuration correctly read.")
 
+        if self._config_parser.has_section("postgresql_replica"):
+            self.__read_postgresql_replica_configuration()
+
+    def __read_postgresql_replica_configuration(self):
+        logger.debug("Reading PostgreSQL replica configuration...")
+
+        postgresql_conf = self._config["postgresql"]
+        replica_conf = self._config["postgresql_replica"] = {}
+
+        replica_conf["hostname"] = self._config_parser.get(
+            "postgresql_replica", "hostname"
+        )
+        # credentials and database default to the ones of the primary
+        for option in ("user", "password", "database"):
+            replica_conf[option] = self._config_parser.get(
+                "postgresql_replica", option, fallback=postgresql_conf[option]
+            )
+        replica_conf["max_lag"] = self._config_parser.getfloat(
+            "postgresql_replica", "max_lag", fallback=10.0
+        )
+
+        logger.debug("PostgreSQL replica configuration correctly read.")
+
+    def __read_sqlite_configuration(self):
+        logger.debug("Reading SQLite configuration...")
+
+        sqlite_conf = self._config["sqlite"] = {}
+
+        sqlite_conf["path"] = self._config_parser.get(
+            "sqlite", "path", fallback="almanac.db"
+        )
+
+        logger.debug("SQLite configuration correctly read.")
+
+    def __read_memory_configuration(self):
+        logger.debug("Reading memory storage configuration...")
+
+        memory_conf = self._config["memory"] = {}
+
+        memory_conf["corpus"] = self.__read_list("memory", "corpus") or ["init_db.csv"]
+
+        logger.debug("Memory storage configuration correctly read.")
+
+    def __read_channels_configuration(self):
+        logger.debug("Reading channels configuration...")
+
+        channels_conf = self._config["channels"] = []
+
+        for section in self._config_parser.sections():
+            if not section.startswith("channel:"):
+                continue
+            channel_conf = {
+                key: value
+                for key, value in self._config_parser.items(section)
+                if key in ("ephemeris_table", "schema", "path")
+            }
+            channel_conf["name"] = section.removeprefix("channel:")
+            channel_conf["targets"] = self.__read_list(section, "targets")
+            if self._config_parser.has_option(section, "corpus"):
+                channel_conf["corpus"] = self.__read_list(section, "corpus")
+            if self._config_parser.has_option(section, "partitioned"):
+                channel_conf["partitioned"] = self._config_parser.getboolean(
+                    section, "partitioned"
+                )
+            channels_conf.append(channel_conf)
+
+        # a single channel, served by the storage sections, posting to every target
+        if not channels_conf:
+            channels_conf.append({"name": "default", "targets": []})
+
+        logger.debug("Channels configuration correctly read.")
+
+    def __read_list(self, section: str, option: str) -> list:
+        return [
+            item.strip()
+            for item in self._config_parser.get(section, option, fallback="").split(",")
+            if item.strip()
+        ]
+
+    def __read_pipeline_configuration(self):
+        logger.debug("Reading pipeline configuration...")
+
+        pipeline_conf = self._config["pipeline"] = {}
+
+        pipeline_conf["ack_queue_size"] = self._config_parser.getint(
+            "pipeline", "ack_queue_size", fallback=100
+        )
+        pipeline_conf["ack_batch_size"] = self._config_parser.getint(
+            "pipeline", "ack_batch_size", fallback=50
+        )
+
+        logger.debug("Pipeline configuration correctly read.")
+
+    def __read_retry_configuration(self):
+        logger.debug("Reading retry configuration...")
+
+        retry_conf = self._config["retry"] = {}
+
+        retry_conf["batch_size"] = self._config_parser.getint(
+            "retry", "batch_size", fallback=50
+        )
+        retry_conf["lease"] = self._config_parser.getint("retry", "lease", fallback=900)
+        if retry_conf["lease"] <= 0:
+            raise ValueError(f"Retry lease must be positive: {retry_conf['lease']}")
+
+        logger.debug("Retry configuration correctly read.")
+
+    def __read_schedule_configuration(self):
+        logger.debug("Reading schedule configuration...")
+
+        schedule_conf = self._config["schedule"] = {}
+
+        schedule_conf["windows"] = self._config_parser.get(
+            "schedule", "windows", fallback=""
+        )
+        schedule_conf["timezone"] = self._config_parser.get(
+            "schedule", "timezone", fallback="UTC"
+        )
+        schedule_conf["daily_cap"] = self._config_parser.getint(
+            "schedule", "daily_cap", fallback=0
+        )
+
+        logger.debug("Schedule configuration correctly read.")
+
+    def __read_selection_configuration(self):
+        logger.debug("Reading selection configuration...")
+
+        selection_conf = self._config["selection"] = {}
+
+        selection_conf["weight"] = self._config_parser.getfloat(
+            "selection", "weight", fallback=1.0
+        )
+        selection_conf["per_year"] = self._config_parser.getfloat(
+            "selection", "per_year", fallback=1.0
+        )
+        selection_conf["max_years"] = self._config_parser.getint(
+            "selection", "max_years", fallback=10
+        )
+        selection_conf["round_bonus"] = self._config_parser.getfloat(
+            "selection", "round_bonus", fallback=10.0
+        )
+
+        logger.debug("Selection configuration correctly read.")
+
+    def __read_maps_configuration(self):
+        logger.debug("Reading maps configuration...")
+
+        maps_conf = self._config["maps"] = {}
+
+        maps_conf["cache_dir"] = self._config_parser.get(
+            "maps", "cache_dir", fallback=""
+        )
+        maps_conf["precision"] = self._config_parser.getint(
+            "maps", "precision", fallback=1
+        )
+        maps_conf["width"] = self._config_parser.getint("maps", "width", fallback=360)
+        maps_conf["span"] = self._config_parser.getfloat("maps", "span", fallback=360.0)
+        maps_conf["coastlines"] = (
+            self._config_parser.get("maps", "coastlines", fallback="") or None
+        )
+
+        logger.debug("Maps configuration correctly read.")
+
     @property
     def config(self):
         """Returns current config"""
@@ -3,3 +3,5 @@
 CONFIG_ENVVAR = "LOG_CFG"
 CONFIG_FILE_NAME = "config.ini"
 LOGGING_CONFIG_FILE = "logging.json"
+LOG_FORMAT_ENVVAR = "LOG_FORMAT"
+TRACES_ENVVAR = "TRACES"
@@ -0,0 +1,133 @@
+"""Coverage of the calendar by the ephemeris of a channel, day by day"""
+
+import calendar
+import datetime
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from psycopg import OperationalError
+import typer
+
+from almanacbot.data_loader import read_configuration
+from almanacbot.storage import DayStats, EphemerisStorage, create_storage, get_channel
+
+# Leap year, so that Feb 29 has its own cell.
+_YEAR: int = 2024
+_CELL_WIDTH: int = 5
+
+
+@dataclass
+class Coverage:
+    """Summary of the day statistics over the 366 calendar days"""
+
+    events: int = 0
+    untweeted: int = 0
+    empty: List[str] = field(default_factory=list)
+    sparse: List[str] = field(default_factory=list)
+    crowded: List[str] = field(default_factory=list)
+
+
+def calendar_days() -> List[datetime.date]:
+    """Every calendar day, Feb 29 included."""
+    first: datetime.date = datetime.date(_YEAR, 1, 1)
+    return [first + datetime.timedelta(days=day) for day in range(366)]
+
+
+def summarize(stats: List[DayStats], few: int, many: int) -> Coverage:
+    """
+    Find the days without events, with fewer than few or more than many.
+
+    A many of 0 does not look for crowded days.
+    """
+    by_day: Dict[datetime.date, DayStats] = {
+        datetime.date(_YEAR, day.month, day.day): day for day in stats
+    }
+    coverage = Coverage(
+        events=sum(day.events for day in stats),
+        untweeted=sum(day.untweeted for day in stats),
+    )
+    for date in calendar_days():
+        events: int = by_day[date].events if date in by_day else 0
+        if events == 0:
+            coverage.empty.append(f"{date:%m-%d}")
+        elif events < few:
+            coverage.sparse.append(f"{date:%m-%d}")
+        elif many and events > many:
+            coverage.crowded.append(f"{date:%m-%d}")
+    return coverage
+
+
+def heat_table(stats: List[DayStats], untweeted: bool = False) -> List[str]:
+    """
+    Lay out the events (or untweeted events) of every day in a table of one
+    row per day of the month and one column per month. Days without events
+    show as `-`, days missing from a month are left blank.
+    """
+    counts: Dict[tuple, int] = {
+        (day.month, day.day): day.untweeted if untweeted else day.events
+        for day in stats
+    }
+    lines: List[str] = [
+        "  "
+        + "".join(
+            f"{calendar.month_abbr[month]:>{_CELL_WIDTH}}" for month in range(1, 13)
+        )
+    ]
+    for day in range(1, 32):
+        cells: List[str] = []
+        for month in range(1, 13):
+            if day > calendar.monthrange(_YEAR, month)[1]:
+                cells.append(" " * _CELL_WIDTH)
+            else:
+                cells.append(f"{counts.get((month, day)) or '-':>{_CELL_WIDTH}}")
+        lines.append(f"{day:>2}" + "".join(cells).rstrip())
+    return lines
+
+
+def main(
+    channel: Optional[str] = typer.Option(
+        None, help="Channel whose table is reported [default: the first one]"
+    ),
+    refresh: bool = typer.Option(
+        False, help="Refresh the day statistics first, e.g. after a manual import"
+    ),
+    untweeted: bool = typer.Option(
+        False, help="Show the events not tweeted this year instead of all of them"
+    ),
+    few: int = typer.Option(3, help="Report the days with fewer events than this"),
+    many: int = typer.Option(
+        0, help="Report the days with more events than this, 0 to not report them"
+    ),
+):
+    config: dict = read_configuration()
+
+    try:
+        storage: EphemerisStorage = create_storage(config, get_channel(config, channel))
+        try:
+            if refresh:
+                print("Refreshing day statistics...")
+                storage.refresh_day_stats()
+            stats: List[DayStats] = storage.get_day_stats()
+        finally:
+            storage.close()
+    except (OperationalError, ValueError) as exc:
+        print(f"Error reading day statistics: {exc}")
+        raise typer.Exit(2)
+
+    for line in heat_table(stats, untweeted):
+        print(line)
+
+    coverage: Coverage = summarize(stats, few, many)
+    print(
+        f"{coverage.events} events, {coverage.untweeted} not tweeted this year. "
+        f"{len(coverage.empty)} days without events, {len(coverage.sparse)} with "
+        f"fewer than {few}"
+        + (f", {len(coverage.crowded)} with more than {many}." if many else ".")
+    )
+    for name, days in (
+        ("Without events", coverage.empty),
+        (f"Fewer than {few}", coverage.sparse),
+        (f"More than {many}", coverage.crowded),
+    ):
+        if days:
+            print(f"{name}: {' '.join(days)}")
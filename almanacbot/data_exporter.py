@@ -0,0 +1,219 @@
+import abc
+import datetime
+import json
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+from psycopg import OperationalError
+import typer
+
+from almanacbot import compression
+from almanacbot.data_loader import (
+    DEFAULT_BATCH_SIZE,
+    Row,
+    read_configuration,
+)
+from almanacbot.postgresql_client import MonthDay, PostgreSQLClient
+from almanacbot.storage import create_storage, get_channel
+
+TWEET_STATUSES: Dict[str, Optional[bool]] = {
+    "all": None,
+    "tweeted": True,
+    "untweeted": False,
+}
+
+
+class EphemerisWriter(abc.ABC):
+    """Base class of the output format writers, mirroring the loader readers."""
+
+    extensions: Tuple[str, ...] = ()
+
+    @abc.abstractmethod
+    def write(
+        self,
+        psql_client: PostgreSQLClient,
+        path: str,
+        from_day: Optional[MonthDay],
+        to_day: Optional[MonthDay],
+        tweeted: Optional[bool],
+        batch_size: int,
+    ) -> None:
+        pass
+
+
+class CsvWriter(EphemerisWriter):
+    """Raw `COPY ... TO STDOUT` CSV output, copied chunk by chunk."""
+
+    extensions = (".csv",)
+
+    def write(self, psql_client, path, from_day, to_day, tweeted, batch_size):
+        with compression.open_file(path, "wb") as output:
+            psql_client.copy_ephemeris_csv_to(output, from_day, to_day, tweeted)
+
+
+class JsonlWriter(EphemerisWriter):
+    """One JSON object per line."""
+
+    extensions = (".jsonl", ".ndjson")
+
+    def write(self, psql_client, path, from_day, to_day, tweeted, batch_size):
+        with compression.open_file(path, "wb") as output:
+            write_jsonl(
+                output, psql_client.iter_ephemeris_rows(from_day, to_day, tweeted)
+            )
+
+
+class ParquetWriter(EphemerisWriter):
+    """
+    Parquet output written one record batch at a time.
+
+    Parquet files are compressed internally (zstd) rather than wrapped.
+    """
+
+    extensions = (".parquet",)
+
+    def write(self, psql_client, path, from_day, to_day, tweeted, batch_size):
+        if compression.detect_compression(path):
+            raise ValueError("Parquet output is compressed internally, drop the suffix")
+        write_parquet(
+            path, psql_client.iter_ephemeris_rows(from_day, to_day, tweeted), batch_size
+        )
+
+
+WRITERS: Dict[str, EphemerisWriter] = {
+    extension: writer
+    for writer in (CsvWriter(), JsonlWriter(), ParquetWriter())
+    for extension in writer.extensions
+}
+
+
+def get_writer(path: str) -> EphemerisWriter:
+    """Return the writer registered for the extension of path, e.g. `.csv.zst`."""
+    extension: str = compression.format_extension(path)
+    try:
+        return WRITERS[extension]
+    except KeyError:
+        raise ValueError(f"Unsupported output file format: {path}") from None
+
+
+def write_jsonl(output: BinaryIO, rows: Iterator[Row]) -> int:
+    written: int = 0
+    for date, text, location in rows:
+        record: dict = {
+            "date": date.isoformat() if isinstance(date, datetime.datetime) else date,
+            "text": text,
+            "location": (
+                {"latitude": location.latitude, "longitude": location.longitude}
+                if location is not None
+                else None
+            ),
+        }
+        output.write(json.dumps(record, ensure_ascii=False).encode("UTF-8") + b"\n")
+        written += 1
+    return written
+
+
+def write_parquet(path: str, rows: Iterator[Row], batch_size: int) -> int:
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ValueError(
+            "Writing Parquet files requires pyarrow to be installed"
+        ) from exc
+
+    location_type = pyarrow.struct(
+        [("latitude", pyarrow.float64()), ("longitude", pyarrow.float64())]
+    )
+    schema = pyarrow.schema(
+        [
+            ("date", pyarrow.timestamp("us", tz="UTC")),
+            ("text", pyarrow.string()),
+            ("location", location_type),
+        ]
+    )
+
+    def to_batch(batch: list) -> "pyarrow.RecordBatch":
+        dates, texts, locations = zip(*batch)
+        return pyarrow.RecordBatch.from_arrays(
+            [
+                pyarrow.array(dates, type=schema.field("date").type),
+                pyarrow.array(texts, type=pyarrow.string()),
+                pyarrow.array(
+                    [
+                        {"latitude": loc.latitude, "longitude": loc.longitude}
+                        if loc is not None
+                        else None
+                        for loc in locations
+                    ],
+                    type=location_type,
+                ),
+            ],
+            schema=schema,
+        )
+
+    written: int = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+        batch: list = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_batch(to_batch(batch))
+                written += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(to_batch(batch))
+            written += len(batch)
+    return written
+
+
+def parse_month_day(value: Optional[str]) -> Optional[MonthDay]:
+    """Parse a `MM-DD` string into a (month, day) pair."""
+    if not value:
+        return None
+    try:
+        month_day = datetime.datetime.strptime(f"2000-{value}", "%Y-%m-%d")
+    except ValueError:
+        raise typer.BadParameter(f"Expected MM-DD, got {value!r}") from None
+    return month_day.month, month_day.day
+
+
+def main(
+    output: str = typer.Argument(
+        ...,
+        help="Output file: .csv, .jsonl or .parquet, optionally ending in .gz/.zst",
+    ),
+    from_day: Optional[str] = typer.Option(None, help="First calendar day (MM-DD)"),
+    to_day: Optional[str] = typer.Option(None, help="Last calendar day (MM-DD)"),
+    status: str = typer.Option("all", help="Tweet status: all, tweeted or untweeted"),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, help="Rows per record batch for Parquet output"
+    ),
+    channel: Optional[str] = typer.Option(
+        None, help="Channel whose table is exported [default: the first one]"
+    ),
+):
+    if status not in TWEET_STATUSES:
+        raise typer.BadParameter(f"Unknown tweet status: {status}")
+
+    config: dict = read_configuration()
+
+    try:
+        writer: EphemerisWriter = get_writer(output)
+        print("Connecting to PostgreSQL...")
+        psql_client = create_storage(config, get_channel(config, channel))
+        if not isinstance(psql_client, PostgreSQLClient):
+            raise ValueError("Exporting requires the postgresql storage backend")
+
+        print(f"Exporting ephemeris to {output}...")
+        writer.write(
+            psql_client,
+            output,
+            parse_month_day(from_day),
+            parse_month_day(to_day),
+            TWEET_STATUSES[status],
+            batch_size,
+        )
+    except (OperationalError, ValueError) as exc:
+        print(f"Error exporting ephemeris from the DB: {exc}")
+        raise typer.Exit(2)
+    print("Export finished.")
@@ -1,17 +1,188 @@
-import ast
+import abc
+import concurrent.futures
 import configparser
 import csv
+import datetime
+import io
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from psycopg import OperationalError
+from babel import Locale
+from psycopg import OperationalError, ProgrammingError
 import typer
 
-from almanacbot import constants
+from almanacbot import compression, constants, templates
 from almanacbot.config import Configuration
-from almanacbot.ephemeris import Ephemeris, Location
-from almanacbot.postgresql_client import PostgreSQLClient
+from almanacbot.ephemeris import Location
+from almanacbot.postgresql_client import NearDuplicate, PostgreSQLClient
+from almanacbot.storage import (
+    CopyRow,
+    EphemerisStorage,
+    create_storage,
+    get_channel,
+)
 
 config_parser: configparser = configparser.ConfigParser()
 
+# Files bigger than this are split into several partitions.
+DEFAULT_CHUNK_SIZE: int = 64 * 1024 * 1024
+# Maximum number of rows held in memory at once by batched readers.
+DEFAULT_BATCH_SIZE: int = 10_000
+# Minimum trigram similarity of the near-duplicates reported for review.
+DEFAULT_SIMILARITY: float = 0.6
+
+Row = Tuple[datetime.datetime | str, str, Optional[Location]]
+
+
+@dataclass(frozen=True)
+class FileRange:
+    """
+    Partition [start, end) of an input file.
+
+    Units depend on the reader: byte offsets aligned to line boundaries for
+    line-based formats, row group indexes for Parquet.
+    """
+
+    path: str
+    start: int
+    end: int
+
+    @property
+    def has_header(self) -> bool:
+        return self.start == 0
+
+
+@dataclass
+class WorkerResult:
+    """Outcome of loading a single FileRange."""
+
+    file_range: FileRange
+    rows: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    # rows not loaded, e.g. "<date>: Unknown placeholder: ${name}"
+    rejected: List[str] = field(default_factory=list)
+
+
+class EphemerisReader(abc.ABC):
+    """Base class of the input format readers, splitting files by lines."""
+
+    extensions: Tuple[str, ...] = ()
+
+    def split(self, path: str, chunk_size: int) -> List[FileRange]:
+        return split_file(path, chunk_size)
+
+    @abc.abstractmethod
+    def read(self, file_range: FileRange, batch_size: int) -> Iterator[Row]:
+        pass
+
+
+class CsvReader(EphemerisReader):
+    """`;`-delimited `date;text;location` files with a header line."""
+
+    extensions = (".csv",)
+
+    def read(self, file_range: FileRange, batch_size: int) -> Iterator[Row]:
+        lines: Iterator[str] = read_lines(file_range, skip_header=True)
+        for row in csv.reader(lines, delimiter=";"):
+            if row:
+                yield parse_csv_row(row)
+
+
+class JsonlReader(EphemerisReader):
+    """One JSON object per line, as in `epehemeris_sample.json`."""
+
+    extensions = (".jsonl", ".ndjson")
+
+    def read(self, file_range: FileRange, batch_size: int) -> Iterator[Row]:
+        for line in read_lines(file_range, skip_header=False):
+            if not line.strip():
+                continue
+            record: dict = json.loads(line)
+            location: Optional[dict] = record.get("location")
+            yield (
+                record["date"],
+                record["text"],
+                Location(location["latitude"], location["longitude"])
+                if location
+                else None,
+            )
+
+
+class ParquetReader(EphemerisReader):
+    """
+    Parquet files with `date` (timestamp), `text` (string) and `location`
+    (struct of `latitude`/`longitude` doubles) columns.
+
+    Files are split by row groups and read one record batch at a time.
+    """
+
+    extensions = (".parquet",)
+
+    def split(self, path: str, chunk_size: int) -> List[FileRange]:
+        metadata = _import_pyarrow_parquet().ParquetFile(path).metadata
+        ranges: List[FileRange] = []
+        start: int = 0
+        size: int = 0
+        for index in range(metadata.num_row_groups):
+            size += metadata.row_group(index).total_byte_size
+            if size >= chunk_size:
+                ranges.append(FileRange(path=path, start=start, end=index + 1))
+                start, size = index + 1, 0
+        if start < metadata.num_row_groups:
+            ranges.append(
+                FileRange(path=path, start=start, end=metadata.num_row_groups)
+            )
+        return ranges
+
+    def read(self, file_range: FileRange, batch_size: int) -> Iterator[Row]:
+        parquet_file = _import_pyarrow_parquet().ParquetFile(file_range.path)
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size,
+            row_groups=range(file_range.start, file_range.end),
+            columns=["date", "text", "location"],
+        ):
+            locations = batch.column("location")
+            latitudes = locations.field("latitude").to_pylist()
+            longitudes = locations.field("longitude").to_pylist()
+            for date, text, is_valid, latitude, longitude in zip(
+                batch.column("date").to_pylist(),
+                batch.column("text").to_pylist(),
+                locations.is_valid().to_pylist(),
+                latitudes,
+                longitudes,
+            ):
+                yield date, text, Location(latitude, longitude) if is_valid else None
+
+
+READERS: Dict[str, EphemerisReader] = {
+    extension: reader
+    for reader in (CsvReader(), JsonlReader(), ParquetReader())
+    for extension in reader.extensions
+}
+
+
+def _import_pyarrow_parquet():
+    try:
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ValueError(
+            "Reading Parquet files requires pyarrow to be installed"
+        ) from exc
+    return pyarrow.parquet
+
+
+def get_reader(path: str) -> EphemerisReader:
+    """Return the reader registered for the extension of path, e.g. `.csv.gz`."""
+    extension: str = compression.format_extension(path)
+    try:
+        return READERS[extension]
+    except KeyError:
+        raise ValueError(f"Unsupported input file format: {path}") from None
+
 
 def read_configuration():
     # read configuration
@@ -24,51 +195,326 @@ def read_configuration():
     print("Configuration correctly read.")
 
 
+def collect_input_files(paths: List[str]) -> List[str]:
+    """Expand directories into their (sorted) loadable files."""
+    files: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if compression.format_extension(name) in READERS
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def split_file(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[FileRange]:
+    """
+    Split a file into byte ranges of roughly chunk_size bytes.
+
+    Every range boundary is moved forward to the start of the next line so
+    that no record is cut in half. Records are therefore expected to fit in a
+    single line (no quoted newlines).
+
+    Compressed files cannot be seeked into and always make a single range.
+    """
+    size: int = os.path.getsize(path)
+    if compression.detect_compression(path):
+        return [FileRange(path=path, start=0, end=size)] if size else []
+    ranges: List[FileRange] = []
+    with open(path, "rb") as f:
+        start: int = 0
+        while start < size:
+            end: int = min(start + chunk_size, size)
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            ranges.append(FileRange(path=path, start=start, end=end))
+            start = end
+    return ranges
+
+
+def read_lines(file_range: FileRange, skip_header: bool) -> Iterator[str]:
+    """Yield the decoded lines of a byte FileRange, optionally skipping the header."""
+    compressed: bool = compression.detect_compression(file_range.path) is not None
+    with compression.open_file(file_range.path, "rb") as f:
+        if not compressed:
+            f.seek(file_range.start)
+        position: int = file_range.start
+        if skip_header and file_range.has_header:
+            position += len(f.readline())
+        # offsets of compressed files refer to the compressed stream: read it all
+        while compressed or position < file_range.end:
+            line: bytes = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode("UTF-8")
+
+
+def parse_csv_row(row: List[str]) -> Row:
+    location: Location = None
+    if row[2]:
+        latitude, longitude = row[2].strip("()").split(",")
+        location = Location(latitude=float(latitude), longitude=float(longitude))
+    return row[0], row[1], location
+
+
+def channel_locales(config: dict, channel: Optional[dict] = None) -> List[str]:
+    """Locales of the publishing targets the ephemeris of a channel are posted to."""
+    names: List[str] = (channel or {}).get("targets") or []
+    return sorted(
+        {
+            target_conf["locale"]
+            for target_conf in config["targets"]
+            if not names or target_conf["name"] in names
+        }
+    )
+
+
+def validate_rows(
+    rows: Iterable[Row],
+    locales: Sequence[Locale],
+    max_length: int,
+    rejected: List[str],
+) -> Iterator[CopyRow]:
+    """
+    Yield the rows whose text is a valid template, which rendered in any of
+    locales fits in max_length weighted characters. The reasons the other
+    rows are rejected are appended to rejected.
+
+    The rows are yielded with the TemplateInfo of their text, which storages
+    then do not analyze again.
+    """
+    for date, text, location in rows:
+        try:
+            info: templates.TemplateInfo = templates.analyze(text)
+        except templates.TemplateError as exc:
+            rejected.append(f"{date}: {exc}")
+            continue
+        length: int = info.max_length(locales)
+        if length > max_length:
+            rejected.append(
+                f"{date}: up to {length} characters once rendered, "
+                f"over the limit of {max_length}"
+            )
+            continue
+        yield date, text, location, info
+
+
+def load_range(
+    config: dict,
+    file_range: FileRange,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    channel: Optional[dict] = None,
+    max_length: int = templates.MAX_TWEET_LENGTH,
+) -> WorkerResult:
+    """
+    Load one FileRange through its own connection and COPY stream, skipping
+    the rows with invalid or too long text templates.
+    """
+    result = WorkerResult(file_range=file_range)
+    started: float = time.perf_counter()
+    try:
+        locales: List[Locale] = [
+            Locale.parse(locale) for locale in channel_locales(config, channel)
+        ]
+        storage: EphemerisStorage = create_storage(config, channel)
+        try:
+            reader: EphemerisReader = get_reader(file_range.path)
+            result.rows = storage.copy_ephemeris(
+                validate_rows(
+                    reader.read(file_range, batch_size),
+                    locales,
+                    max_length,
+                    result.rejected,
+                )
+            )
+        finally:
+            storage.close()
+    except Exception as exc:
+        result.error = f"{type(exc).__name__}: {exc}"
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def write_review(path: str, duplicates: Iterable[NearDuplicate]) -> int:
+    """
+    Write near-duplicates to a `;`-delimited CSV report for editors, compressed
+    according to the extension of path. Returns the number of rows written.
+    """
+    written: int = 0
+    with compression.open_file(path, "wb") as binary:
+        with io.TextIOWrapper(binary, encoding="utf-8", newline="") as text:
+            writer = csv.writer(text, delimiter=";")
+            writer.writerow(
+                [
+                    "similarity",
+                    "id",
+                    "date",
+                    "text",
+                    "duplicate_of",
+                    "duplicate_date",
+                    "duplicate_text",
+                ]
+            )
+            for duplicate in duplicates:
+                writer.writerow(
+                    [
+                        f"{duplicate.similarity:.3f}",
+                        duplicate.ephemeris_id,
+                        duplicate.date.isoformat(),
+                        duplicate.text,
+                        duplicate.duplicate_of,
+                        duplicate.duplicate_date.isoformat(),
+                        duplicate.duplicate_text,
+                    ]
+                )
+                written += 1
+    return written
+
+
 def main(
-    csv_file_path: str = "init_db.csv",
+    paths: List[str] = typer.Argument(
+        None,
+        help="CSV, JSONL or Parquet files, or directories containing them "
+        "[default: init_db.csv]",
+    ),
+    workers: int = typer.Option(
+        os.cpu_count() or 1, help="Number of parallel loader processes"
+    ),
+    chunk_size: int = typer.Option(
+        DEFAULT_CHUNK_SIZE, help="Approximate size in bytes of each file range"
+    ),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, help="Rows read at once from batched formats (Parquet)"
+    ),
+    channel: Optional[str] = typer.Option(
+        None, help="Channel whose storage is loaded [default: the first one]"
+    ),
+    max_length: int = typer.Option(
+        templates.MAX_TWEET_LENGTH,
+        help="Maximum weighted length of rendered texts, longer ones are rejected",
+    ),
+    review: Optional[str] = typer.Option(
+        None,
+        help="Load through a staging table and write the near-duplicates of the "
+        "loaded rows to this CSV report (postgresql backend only)",
+    ),
+    similarity: float = typer.Option(
+        DEFAULT_SIMILARITY,
+        min=0.0,
+        max=1.0,
+        help="Minimum trigram similarity of the near-duplicates reported",
+    ),
 ):
     config: dict = read_configuration()
 
-    with open(csv_file_path, "r") as csv_file:
-        try:
-            print("Connecting to PostgreSQL...")
-            psql_client = PostgreSQLClient(
-                user=config["postgresql"]["user"],
-                password=config["postgresql"]["password"],
-                hostname=config["postgresql"]["hostname"],
-                database=config["postgresql"]["database"],
-                ephemeris_table=config["postgresql"]["ephemeris_table"],
-                logging_echo=bool(config["postgresql"]["logging_echo"]),
+    try:
+        channel_conf: dict = get_channel(config, channel)
+        print(
+            f"Connecting to {config['storage']['backend']} storage of channel "
+            f"{channel_conf['name']}..."
+        )
+        storage: EphemerisStorage = create_storage(config, channel_conf)
+
+        print("Checking for existing data...")
+        if storage.count_ephemeris() > 0:
+            confirmation: str = typer.confirm(
+                "There is data in the databse, are you sure you want to append more?"
             )
+            if not confirmation:
+                print("Aborting!")
+                raise typer.Abort()
+        load_conf: dict = channel_conf
+        if review:
+            if not isinstance(storage, PostgreSQLClient):
+                raise ValueError("Reviewing requires the postgresql storage backend")
+            load_conf = {**channel_conf, "ephemeris_table": storage.create_staging()}
+            print(f"Loading into staging table {load_conf['ephemeris_table']}...")
+        storage.close()
+    except (OperationalError, ProgrammingError, ValueError) as exc:
+        print(f"Error introducing CSV data to the DB: {exc}")
+        raise typer.Exit(2)
 
-            print("Checking for existing data...")
-            if psql_client.count_ephemeris() > 0:
-                confirmation: str = typer.confirm(
-                    "There is data in the databse, are you sure you want to append more?"
+    try:
+        file_ranges: List[FileRange] = [
+            file_range
+            for path in collect_input_files(paths or ["init_db.csv"])
+            for file_range in get_reader(path).split(path, chunk_size)
+        ]
+    except (OSError, ValueError) as exc:
+        print(f"Error reading input files: {exc}")
+        raise typer.Exit(2)
+    print(f"Reading and inserting data from {len(file_ranges)} file ranges...")
+
+    started: float = time.perf_counter()
+    results: List[WorkerResult] = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                load_range, config, file_range, batch_size, load_conf, max_length
+            )
+            for file_range in file_ranges
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result: WorkerResult = future.result()
+            results.append(result)
+            file_range: FileRange = result.file_range
+            if result.error:
+                print(
+                    f"Error loading {file_range.path} "
+                    f"[{file_range.start}:{file_range.end}]: {result.error}"
                 )
-                if not confirmation:
-                    print("Aborting!")
-                    raise typer.Abort()
-
-            print("Reading and inserting data...")
-            csvReader = csv.reader(csv_file, delimiter=";")
-            next(csvReader, None)  # skip header
-            for row in csvReader:
-                print(f"Read row: {row}")
-                location_tpl: tuple = ast.literal_eval(row[2]) if row[2] else None
-                location: Location = None
-                if location_tpl:
-                    location: Location = Location(
-                        latitude=location_tpl[0],
-                        longitude=location_tpl[1],
-                    )
-                psql_client.insert_ephemeris(
-                    Ephemeris(
-                        date=row[0],
-                        text=row[1],
-                        location=location,
-                    )
+            else:
+                print(
+                    f"Loaded {result.rows} rows from {file_range.path} "
+                    f"[{file_range.start}:{file_range.end}] in {result.elapsed:.2f}s"
+                )
+            for reason in result.rejected:
+                print(f"Rejected row of {file_range.path}: {reason}")
+    elapsed: float = time.perf_counter() - started
+
+    total_rows: int = sum(result.rows for result in results)
+    total_rejected: int = sum(len(result.rejected) for result in results)
+    errors: List[WorkerResult] = [result for result in results if result.error]
+    print(
+        f"Loaded {total_rows} rows in {elapsed:.2f}s "
+        f"({total_rows / elapsed if elapsed else 0:.0f} rows/s) "
+        f"with {len(errors)}/{len(results)} failed ranges "
+        f"and {total_rejected} rejected rows."
+    )
+
+    if review:
+        try:
+            storage = create_storage(config, channel_conf)
+            try:
+                print(f"Looking for near-duplicates above {similarity}...")
+                reported: int = write_review(
+                    review, storage.find_near_duplicates(similarity)
                 )
-        except (OperationalError, ValueError) as exc:
-            print(f"Error introducing CSV data to the DB: {exc}")
-            typer.Exit(2)
+                print(f"Wrote {reported} near-duplicates to {review}.")
+                print(f"Merged {storage.merge_staging()} staged rows.")
+            finally:
+                storage.close()
+        except (OSError, OperationalError, ProgrammingError, ValueError) as exc:
+            print(f"Error reviewing staged data: {exc}")
+            raise typer.Exit(2)
+
+    if total_rows:
+        try:
+            print("Refreshing day statistics...")
+            storage = create_storage(config, channel_conf)
+            try:
+                storage.refresh_day_stats()
+            finally:
+                storage.close()
+        except (OperationalError, ProgrammingError, ValueError) as exc:
+            print(f"Error refreshing day statistics: {exc}")
+            raise typer.Exit(2)
+
+    if errors or total_rejected:
+        raise typer.Exit(2)
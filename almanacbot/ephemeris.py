@@ -1,8 +1,9 @@
 import datetime
+import functools
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Tuple, Type
 
-from sqlalchemy import TIMESTAMP, Text
+from sqlalchemy import TIMESTAMP, Column, Double, Integer, SmallInteger, Text, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.types import UserDefinedType
 import sqlalchemy
@@ -80,3 +81,132 @@ class Ephemeris(Base):
     last_tweeted_at: Mapped[Optional[datetime.datetime]] = mapped_column(
         TIMESTAMP(timezone=True), default=None
     )
+    # template metadata computed at ingest, NULL for rows loaded before it
+    # placeholders used by text, space-separated
+    placeholders: Mapped[Optional[str]] = mapped_column(Text, default=None)
+    # weighted length of text without its placeholders
+    static_length: Mapped[Optional[int]] = mapped_column(Integer, default=None)
+    # priority of the ephemeris when a day has more of them than its cap
+    weight: Mapped[float] = mapped_column(Double, default=1.0)
+
+
+@dataclass
+class RetryOutbox(Base):
+    """Failed posts waiting to be retried, one row per ephemeris"""
+
+    __tablename__ = "retry_outbox"
+
+    ephemeris_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    attempts: Mapped[int] = mapped_column(Integer)
+    error_class: Mapped[str] = mapped_column(Text)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, default=None)
+    # NULL once retries are exhausted or the error is permanent
+    next_attempt_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        TIMESTAMP(timezone=True), default=None
+    )
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        TIMESTAMP(timezone=True), server_default=func.now(), default=None
+    )
+
+
+@dataclass
+class Delivery(Base):
+    """Publishing targets an ephemeris has reached, until it reaches them all"""
+
+    __tablename__ = "delivery"
+
+    ephemeris_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    target: Mapped[str] = mapped_column(Text, primary_key=True)
+    delivered_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        TIMESTAMP(timezone=True), server_default=func.now(), default=None
+    )
+
+
+@dataclass
+class PostHistory(Base):
+    """Posts of ephemeris to publishing targets, appended and never updated"""
+
+    __tablename__ = "post_history"
+
+    # the table has no primary key, these columns identify a post for the ORM
+    ephemeris_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    target: Mapped[str] = mapped_column(Text, primary_key=True)
+    posted_at: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP(timezone=True), primary_key=True
+    )
+    # seconds the target took to post
+    latency: Mapped[float] = mapped_column(Double)
+    post_id: Mapped[Optional[str]] = mapped_column(Text, default=None)
+
+
+def companion_table_name(ephemeris_table: str, name: str) -> str:
+    """Name of a retry_outbox, delivery or post_history table of an ephemeris table."""
+    if ephemeris_table == Ephemeris.__tablename__:
+        return name
+    return f"{ephemeris_table}_{name}"
+
+
+def table_models(
+    ephemeris_table: str = Ephemeris.__tablename__,
+    schema: Optional[str] = None,
+    partitioned: bool = False,
+) -> Tuple[Type[Ephemeris], Type[RetryOutbox], Type[Delivery], Type[PostHistory]]:
+    """
+    Get the models of an ephemeris table and of its companion tables.
+
+    The default ephemeris table is served by the declared models. Other tables
+    get models derived from them by concrete inheritance, so that their rows
+    are still Ephemeris instances. Companion tables are named after the
+    ephemeris table, e.g. `events_retry_outbox`, in the same schema.
+
+    A partitioned ephemeris table has a `month` partition key column, the
+    month of date in UTC, which is not mapped to an Ephemeris attribute.
+    """
+    # arguments passed positionally, so that every call hits the same entry
+    return _table_models(ephemeris_table, schema, partitioned)
+
+
+@functools.cache
+def _table_models(
+    ephemeris_table: str, schema: Optional[str], partitioned: bool
+) -> Tuple[Type[Ephemeris], Type[RetryOutbox], Type[Delivery], Type[PostHistory]]:
+    if partitioned:
+        ephemeris, *companions = _table_models(ephemeris_table, schema, False)
+        # a metadata of its own, not to clash with the unpartitioned table
+        partitioned_table = ephemeris.__table__.to_metadata(sqlalchemy.MetaData())
+        partitioned_table.append_column(Column("month", SmallInteger, nullable=False))
+        return (
+            type(
+                f"{Ephemeris.__name__}[{schema or ''}.{ephemeris_table}, partitioned]",
+                (Ephemeris,),
+                {
+                    "__table__": partitioned_table,
+                    "__mapper_args__": {
+                        "concrete": True,
+                        "exclude_properties": ["month"],
+                    },
+                },
+            ),
+            *companions,
+        )
+    if ephemeris_table == Ephemeris.__tablename__ and schema is None:
+        return Ephemeris, RetryOutbox, Delivery, PostHistory
+
+    def derive(model: type, table_name: str) -> type:
+        return type(
+            f"{model.__name__}[{schema or ''}.{ephemeris_table}]",
+            (model,),
+            {
+                "__table__": model.__table__.to_metadata(
+                    Base.metadata, schema=schema, name=table_name
+                ),
+                "__mapper_args__": {"concrete": True},
+            },
+        )
+
+    return (
+        derive(Ephemeris, ephemeris_table),
+        derive(RetryOutbox, companion_table_name(ephemeris_table, "retry_outbox")),
+        derive(Delivery, companion_table_name(ephemeris_table, "delivery")),
+        derive(PostHistory, companion_table_name(ephemeris_table, "post_history")),
+    )
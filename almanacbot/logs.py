@@ -0,0 +1,135 @@
+"""Non-blocking logging: queued handlers, run context and JSON records"""
+
+import atexit
+import contextlib
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+_run_id: contextvars.ContextVar[str] = contextvars.ContextVar("run_id", default="-")
+_stage: contextvars.ContextVar[str] = contextvars.ContextVar("stage", default="-")
+
+
+def start_run(run_id: Optional[str] = None) -> str:
+    """Set the id logged with every record of the current run."""
+    run_id = run_id or uuid.uuid4().hex[:12]
+    _run_id.set(run_id)
+    return run_id
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Log the records emitted within the block with a stage field."""
+    token: contextvars.Token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Add the run_id and stage fields of the emitting context to records."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.run_id = _run_id.get()
+        record.stage = _stage.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "run_id": getattr(record, "run_id", None),
+            "stage": getattr(record, "stage", None),
+            "location": f"{record.filename}:{record.lineno}",
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler leaving the layout of records to the listener's handlers.
+
+    The message is merged with its arguments before leaving the emitting
+    thread, as they may change afterwards, and the traceback is rendered
+    while it is still available. Everything else, formatting included, runs
+    on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Queue listener which may be stopped more than once, e.g. at exit"""
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            super().stop()
+
+
+def enqueue_handlers(
+    loggers: Iterable[logging.Logger], json_format: bool = False
+) -> List[logging.handlers.QueueListener]:
+    """
+    Move the handlers of the loggers behind queues served by listener threads.
+
+    Logging calls then only put records on a queue, while console and file
+    I/O happen on the listener threads, stopped and flushed at exit. Loggers
+    sharing the same handlers share a queue and its listener.
+
+    Args:
+        loggers: loggers whose handlers are moved.
+        json_format: format the records of every handler as JSON.
+
+    Returns:
+        The started listeners.
+    """
+    groups: Dict[Tuple[logging.Handler, ...], List[logging.Logger]] = {}
+    for log in loggers:
+        if log.handlers:
+            groups.setdefault(tuple(log.handlers), []).append(log)
+
+    listeners: List[logging.handlers.QueueListener] = []
+    for handlers, group in groups.items():
+        if json_format:
+            for handler in handlers:
+                handler.setFormatter(JsonFormatter())
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(records)
+        queue_handler.addFilter(ContextFilter())
+        for log in group:
+            for handler in handlers:
+                log.removeHandler(handler)
+            log.addHandler(queue_handler)
+        listener = _QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        listeners.append(listener)
+    return listeners
@@ -0,0 +1,323 @@
+"""Offline locator maps of ephemeris locations, cached on disk and per target"""
+
+import datetime
+import functools
+import importlib.resources
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import Location
+
+if TYPE_CHECKING:
+    from almanacbot.publisher import PublishTarget
+
+logger = logging.getLogger(__name__)
+
+# Width in pixels of rendered maps, twice their height.
+DEFAULT_WIDTH: int = 360
+# Degrees of longitude shown around the location, 360 for the whole world.
+DEFAULT_SPAN: float = 360.0
+# Decimals coordinates are rounded to, 1 is about 11 km.
+DEFAULT_PRECISION: int = 1
+
+# (red, green, blue) of the palette indexes drawn
+OCEAN, LAND, RING, MARKER = range(4)
+PALETTE: Sequence[Tuple[int, int, int]] = (
+    (170, 211, 223),
+    (242, 239, 233),
+    (255, 255, 255),
+    (200, 30, 30),
+)
+
+# polygons of (longitude, latitude) rings, holes included
+Polygon = List[List[Tuple[float, float]]]
+
+
+@functools.cache
+def load_coastlines(path: Optional[str] = None) -> Tuple[Polygon, ...]:
+    """
+    Read the land polygons of a GeoJSON file, the low-resolution outlines
+    bundled with the package by default. Polygon and MultiPolygon
+    geometries are read, e.g. from Natural Earth's 110m land file.
+    """
+    if path:
+        with open(path, "r", encoding="UTF-8") as geojson:
+            collection: dict = json.load(geojson)
+    else:
+        collection = json.loads(
+            importlib.resources.files("almanacbot")
+            .joinpath("coastlines.geojson")
+            .read_text(encoding="UTF-8")
+        )
+    polygons: List[Polygon] = []
+    for feature in collection["features"]:
+        geometry: dict = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            shapes = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            shapes = geometry["coordinates"]
+        else:
+            continue
+        for shape in shapes:
+            polygons.append([[(lon, lat) for lon, lat, *_ in ring] for ring in shape])
+    return tuple(polygons)
+
+
+def encode_png(
+    pixels: bytes, width: int, height: int, palette: Sequence[Tuple[int, int, int]]
+) -> bytes:
+    """Encode rows of 8-bit palette indexes as an indexed-color PNG."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    # every row starts with its filter type, 0 for none
+    rows: bytes = b"".join(
+        b"\x00" + pixels[y * width : (y + 1) * width] for y in range(height)
+    )
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        + chunk(b"PLTE", bytes(value for color in palette for value in color))
+        + chunk(b"IDAT", zlib.compress(rows, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _fill(
+    pixels: bytearray,
+    width: int,
+    height: int,
+    rings: Sequence[Sequence[Tuple[float, float]]],
+    color: int,
+) -> None:
+    """Fill the inside of rings of pixel coordinates, by the even-odd rule."""
+    edges: List[Tuple[float, float, float, float]] = [
+        (x1, y1, x2, y2)
+        for ring in rings
+        for (x1, y1), (x2, y2) in zip(ring, [*ring[1:], ring[0]])
+        if y1 != y2
+    ]
+    if not edges:
+        return
+    top: int = max(0, int(min(min(edge[1], edge[3]) for edge in edges)))
+    bottom: int = min(height, int(max(max(edge[1], edge[3]) for edge in edges)) + 1)
+    for y in range(top, bottom):
+        center: float = y + 0.5
+        crossings: List[float] = sorted(
+            x1 + (center - y1) * (x2 - x1) / (y2 - y1)
+            for x1, y1, x2, y2 in edges
+            if (y1 <= center) != (y2 <= center)
+        )
+        for start, end in zip(crossings[::2], crossings[1::2]):
+            first: int = max(0, int(start + 0.5))
+            last: int = min(width, int(end + 0.5))
+            if first < last:
+                pixels[y * width + first : y * width + last] = bytes([color]) * (
+                    last - first
+                )
+
+
+def _disc(
+    pixels: bytearray,
+    width: int,
+    height: int,
+    x: float,
+    y: float,
+    radius: float,
+    color: int,
+) -> None:
+    for row in range(max(0, int(y - radius)), min(height, int(y + radius) + 1)):
+        for column in range(max(0, int(x - radius)), min(width, int(x + radius) + 1)):
+            if (column + 0.5 - x) ** 2 + (row + 0.5 - y) ** 2 <= radius**2:
+                pixels[row * width + column] = color
+
+
+def render_locator(
+    location: Location,
+    width: int = DEFAULT_WIDTH,
+    span: float = DEFAULT_SPAN,
+    coastlines: Optional[str] = None,
+) -> bytes:
+    """
+    Draw a PNG map marking location, in the equirectangular projection.
+
+    The map shows span degrees of longitude and half as many of latitude,
+    centered on the location as far as the edges of the world allow.
+
+    Args:
+        location: place marked on the map.
+        width: width of the map in pixels, twice its height.
+        span: degrees of longitude shown, 360 for the whole world.
+        coastlines: GeoJSON file of the land, the bundled outlines if None.
+    """
+    if not 0 < span <= 360:
+        raise ValueError(f"Map span must be within (0, 360] degrees: {span}")
+    height: int = max(1, width // 2)
+    west: float = min(max(location.longitude - span / 2, -180.0), 180.0 - span)
+    north: float = max(min(location.latitude + span / 4, 90.0), -90.0 + span / 2)
+    scale: float = width / span
+
+    def project(lon: float, lat: float) -> Tuple[float, float]:
+        return (lon - west) * scale, (north - lat) * scale
+
+    pixels = bytearray([OCEAN]) * (width * height)
+    for polygon in load_coastlines(coastlines):
+        _fill(
+            pixels,
+            width,
+            height,
+            [[project(lon, lat) for lon, lat in ring] for ring in polygon],
+            LAND,
+        )
+    x, y = project(location.longitude, location.latitude)
+    radius: float = max(2.0, width / 90)
+    _disc(pixels, width, height, x, y, radius + 1.5, RING)
+    _disc(pixels, width, height, x, y, radius, MARKER)
+    return encode_png(bytes(pixels), width, height, PALETTE)
+
+
+class MediaCache:
+    """
+    Locator maps of ephemeris locations and their media ids on each target.
+
+    Locations are rounded to precision decimals, and each rounded location
+    is rendered once, into a PNG file of directory, and uploaded once per
+    publishing target while the media can be attached: the media ids returned
+    are kept in media_ids.json, along with when the target expires them, so
+    that later posts of the same place attach the same media. Targets whose
+    media can only be attached to a single post upload the map every time.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        precision: int = DEFAULT_PRECISION,
+        width: int = DEFAULT_WIDTH,
+        span: float = DEFAULT_SPAN,
+        coastlines: Optional[str] = None,
+        now: Clock = utc_now,
+    ):
+        self.directory: str = directory
+        self.precision: int = precision
+        self.width: int = width
+        self.span: float = span
+        self.coastlines: Optional[str] = coastlines
+        self._now: Clock = now
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._ids_path: str = os.path.join(directory, "media_ids.json")
+        # media id of each key and when it expires (ISO 8601 or None), per
+        # target name
+        self._media_ids: Dict[str, Dict[str, Dict[str, Optional[str]]]] = {}
+        if os.path.exists(self._ids_path):
+            with open(self._ids_path, "r", encoding="UTF-8") as ids:
+                self._media_ids = json.load(ids)
+
+    def key(self, location: Location) -> str:
+        """Name of the rounded location, e.g. +41.4_+002.2."""
+        digits: int = self.precision
+        # sign, integer digits, and the decimal point with the decimals
+        decimals: int = digits + 1 if digits else 0
+        return (
+            f"{round(location.latitude, digits):+0{3 + decimals}.{digits}f}_"
+            f"{round(location.longitude, digits):+0{4 + decimals}.{digits}f}"
+        )
+
+    def image(self, location: Location) -> bytes:
+        """PNG map of the rounded location, rendered on the first call."""
+        key: str = self.key(location)
+        path: str = os.path.join(self.directory, f"{key}.png")
+        with self._lock:
+            if os.path.exists(path):
+                with open(path, "rb") as image:
+                    return image.read()
+            digits: int = self.precision
+            logger.debug("Rendering the map of %s...", key)
+            data: bytes = render_locator(
+                Location(
+                    round(location.latitude, digits), round(location.longitude, digits)
+                ),
+                self.width,
+                self.span,
+                self.coastlines,
+            )
+            self._write(path, data)
+            return data
+
+    def media_id(self, target: "PublishTarget", location: Location) -> str:
+        """
+        Id of the map of location on target, uploading it on the first call,
+        once the media uploaded expired, or on every call if target does not
+        reuse media.
+
+        Each target uploads from its own publishing thread, so a target never
+        uploads the same map twice at once.
+        """
+        key: str = self.key(location)
+        now: datetime.datetime = self._now()
+        if target.media_reusable:
+            with self._lock:
+                entry: Optional[Dict[str, Optional[str]]] = self._media_ids.get(
+                    target.name, {}
+                ).get(key)
+            # ids of earlier versions, kept without their expiry, are dropped
+            if isinstance(entry, dict) and (
+                entry["expires_at"] is None
+                or now < datetime.datetime.fromisoformat(entry["expires_at"])
+            ):
+                return entry["id"]
+        media_id: str = target.upload_media(
+            self.image(location),
+            "image/png",
+            f"Map locating {location.latitude:.2f}, {location.longitude:.2f}",
+        )
+        logger.info("Uploaded the map of %s to %s: %s", key, target.name, media_id)
+        if target.media_reusable:
+            with self._lock:
+                self._media_ids.setdefault(target.name, {})[key] = {
+                    "id": media_id,
+                    "expires_at": (
+                        None
+                        if target.media_ttl is None
+                        else (now + target.media_ttl).isoformat()
+                    ),
+                }
+                self._save()
+        return media_id
+
+    def evict(self, target: "PublishTarget", location: Location) -> None:
+        """Forget the media id of the map of location on target, e.g. rejected."""
+        key: str = self.key(location)
+        with self._lock:
+            if self._media_ids.get(target.name, {}).pop(key, None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        self._write(
+            self._ids_path,
+            json.dumps(self._media_ids, indent=1, sort_keys=True).encode("UTF-8"),
+        )
+
+    def _write(self, path: str, data: bytes) -> None:
+        """Replace path atomically, so that readers never see partial files."""
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as output:
+                output.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
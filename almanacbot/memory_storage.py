@@ -0,0 +1,374 @@
+import datetime
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import Ephemeris, Location
+from almanacbot.selection import Scoring, top
+from almanacbot.storage import (
+    CopyRow,
+    DayStats,
+    EphemerisStorage,
+    InsertListener,
+    PostRecord,
+    RetryEntry,
+    TodayCounts,
+    row_template,
+    to_datetime,
+)
+from almanacbot.templates import TemplateInfo
+
+# Days before the first of each month in a leap year, so that Feb 29 has its own slot.
+_MONTH_OFFSETS: Tuple[int, ...] = (
+    0,
+    31,
+    60,
+    91,
+    121,
+    152,
+    182,
+    213,
+    244,
+    274,
+    305,
+    335,
+)
+DAY_SLOTS: int = 366
+
+
+def day_slot(value: datetime.date) -> int:
+    """Index of the calendar day of value in a 366-slot leap year."""
+    return _MONTH_OFFSETS[value.month - 1] + value.day - 1
+
+
+class _Record:
+    """Compact in-memory ephemeris row"""
+
+    __slots__ = ("id", "date", "text", "location", "last_tweeted_at", "info", "weight")
+
+    def __init__(
+        self,
+        id: int,
+        date: datetime.datetime,
+        text: str,
+        location: Optional[Location],
+        info: TemplateInfo,
+        weight: float = 1.0,
+    ):
+        self.id: int = id
+        self.date: datetime.datetime = date
+        self.text: str = text
+        self.location: Optional[Location] = location
+        self.last_tweeted_at: Optional[datetime.datetime] = None
+        self.info: TemplateInfo = info
+        self.weight: float = weight
+
+    def to_ephemeris(self) -> Ephemeris:
+        return Ephemeris(
+            id=self.id,
+            date=self.date,
+            text=self.text,
+            location=self.location,
+            last_tweeted_at=self.last_tweeted_at,
+            placeholders=" ".join(self.info.placeholders),
+            static_length=self.info.static_length,
+            weight=self.weight,
+        )
+
+
+class _InsertListener(InsertListener):
+    """Queue of the ids inserted for today, fed by the storage itself"""
+
+    def __init__(self, storage: "MemoryStorage"):
+        self._storage: MemoryStorage = storage
+        self.inserted: queue.SimpleQueue = queue.SimpleQueue()
+
+    def wait(self, timeout: float) -> List[int]:
+        try:
+            ephemeris_ids: List[int] = list(self.inserted.get(timeout=timeout))
+        except queue.Empty:
+            return []
+        while not self.inserted.empty():
+            ephemeris_ids.extend(self.inserted.get())
+        return ephemeris_ids
+
+    def close(self) -> None:
+        with self._storage._lock:
+            self._storage._listeners.remove(self)
+
+
+class MemoryStorage(EphemerisStorage):
+    """
+    Class serving as in-memory storage, for dry runs, tests and simulations.
+
+    The corpus is indexed once into one list of records per calendar day, so
+    today's lookups cost O(events today). Tweet status lives in a set of the
+    ids tweeted on the current day and is lost when the process exits.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[CopyRow] = (),
+        now: Clock = utc_now,
+    ):
+        self._now: Clock = now
+        self._lock = threading.Lock()
+        self._days: List[List[_Record]] = [[] for _ in range(DAY_SLOTS)]
+        self._records: Dict[int, _Record] = {}
+        self._tweeted: Set[int] = set()
+        self._tweeted_on: Optional[datetime.date] = None
+        # ephemeris id -> (attempts, error class, error, next attempt)
+        self._retries: Dict[int, Tuple[int, str, str, Optional[datetime.datetime]]] = {}
+        self._deliveries: Dict[int, Set[str]] = {}
+        self._history: List[PostRecord] = []
+        self._listeners: List[_InsertListener] = []
+        self._next_id: int = 1
+        self.copy_ephemeris(rows)
+
+    @classmethod
+    def from_files(
+        cls,
+        paths: List[str],
+        now: Clock = utc_now,
+    ) -> "MemoryStorage":
+        """Load a corpus with the data loader readers (CSV, JSONL, Parquet)."""
+        from almanacbot import data_loader
+
+        storage = cls(now=now)
+        for path in data_loader.collect_input_files(paths):
+            reader = data_loader.get_reader(path)
+            for file_range in reader.split(path, data_loader.DEFAULT_CHUNK_SIZE):
+                storage.copy_ephemeris(
+                    reader.read(file_range, data_loader.DEFAULT_BATCH_SIZE)
+                )
+        return storage
+
+    def _tweeted_today(self, today: datetime.date) -> Set[int]:
+        if self._tweeted_on != today:
+            self._tweeted = set()
+            self._tweeted_on = today
+        return self._tweeted
+
+    def get_today_ephemeris(self) -> List[Ephemeris]:
+        with self._lock:
+            records: List[_Record] = list(self._days[day_slot(self._now())])
+        return [record.to_ephemeris() for record in records]
+
+    def get_untweeted_today_ephemeris(self) -> List[Ephemeris]:
+        today: datetime.date = self._now().date()
+        with self._lock:
+            tweeted: Set[int] = self._tweeted_today(today)
+            records: List[_Record] = [
+                record
+                for record in self._days[day_slot(today)]
+                if record.id not in tweeted
+            ]
+        return [record.to_ephemeris() for record in records]
+
+    def get_top_untweeted_today_ephemeris(
+        self, limit: int, scoring: Scoring
+    ) -> List[Ephemeris]:
+        today: datetime.date = self._now().date()
+        with self._lock:
+            tweeted: Set[int] = self._tweeted_today(today)
+            records: List[_Record] = top(
+                (
+                    record
+                    for record in self._days[day_slot(today)]
+                    if record.id not in tweeted and record.id not in self._retries
+                ),
+                limit,
+                scoring,
+                today,
+            )
+        return [record.to_ephemeris() for record in records]
+
+    def count_today_ephemeris(self, since: datetime.datetime) -> TodayCounts:
+        today: datetime.date = self._now().date()
+        with self._lock:
+            tweeted: Set[int] = self._tweeted_today(today)
+            records: List[_Record] = self._days[day_slot(today)]
+            return TodayCounts(
+                untweeted=sum(1 for record in records if record.id not in tweeted),
+                tweeted_since=sum(
+                    1
+                    for record in records
+                    if record.id in tweeted and record.last_tweeted_at >= since
+                ),
+            )
+
+    def mark_as_tweeted(self, ephemeris_id: int) -> None:
+        self.mark_many_as_tweeted([ephemeris_id])
+
+    def mark_many_as_tweeted(self, ephemeris_ids: Sequence[int]) -> None:
+        now: datetime.datetime = self._now()
+        with self._lock:
+            tweeted: Set[int] = self._tweeted_today(now.date())
+            for ephemeris_id in ephemeris_ids:
+                record: Optional[_Record] = self._records.get(ephemeris_id)
+                if record is not None:
+                    record.last_tweeted_at = now
+                    tweeted.add(ephemeris_id)
+                self._retries.pop(ephemeris_id, None)
+                self._deliveries.pop(ephemeris_id, None)
+
+    def schedule_retry(
+        self,
+        ephemeris_id: int,
+        attempts: int,
+        error_class: str,
+        error: str,
+        next_attempt_at: Optional[datetime.datetime],
+    ) -> None:
+        with self._lock:
+            self._retries[ephemeris_id] = (
+                attempts,
+                error_class,
+                error,
+                next_attempt_at,
+            )
+            if next_attempt_at is None:
+                self._deliveries.pop(ephemeris_id, None)
+
+    def claim_due_retries(
+        self, limit: int, lease: datetime.timedelta
+    ) -> List[RetryEntry]:
+        now: datetime.datetime = self._now()
+        with self._lock:
+            due: List[Tuple[datetime.datetime, int, int]] = sorted(
+                (next_attempt_at, ephemeris_id, attempts)
+                for ephemeris_id, (
+                    attempts,
+                    _,
+                    _,
+                    next_attempt_at,
+                ) in self._retries.items()
+                if next_attempt_at is not None and next_attempt_at <= now
+            )[:limit]
+            for _, ephemeris_id, _ in due:
+                self._retries[ephemeris_id] = (
+                    *self._retries[ephemeris_id][:3],
+                    now + lease,
+                )
+            return [
+                RetryEntry(
+                    ephemeris=self._records[ephemeris_id].to_ephemeris(),
+                    attempts=attempts,
+                )
+                for _, ephemeris_id, attempts in due
+            ]
+
+    def claim_ephemeris(
+        self, ephemeris_ids: Sequence[int], lease: datetime.timedelta
+    ) -> List[int]:
+        now: datetime.datetime = self._now()
+        claimed: List[int] = []
+        with self._lock:
+            for ephemeris_id in ephemeris_ids:
+                if ephemeris_id not in self._retries:
+                    self._retries[ephemeris_id] = (0, "", "", now + lease)
+                    claimed.append(ephemeris_id)
+        return claimed
+
+    def mark_many_delivered(self, deliveries: Sequence[Tuple[int, str]]) -> None:
+        with self._lock:
+            for ephemeris_id, target in deliveries:
+                self._deliveries.setdefault(ephemeris_id, set()).add(target)
+
+    def get_deliveries(self, ephemeris_ids: Sequence[int]) -> Dict[int, Set[str]]:
+        with self._lock:
+            return {
+                ephemeris_id: set(self._deliveries[ephemeris_id])
+                for ephemeris_id in ephemeris_ids
+                if ephemeris_id in self._deliveries
+            }
+
+    def record_posts(self, posts: Sequence[PostRecord]) -> None:
+        with self._lock:
+            self._history.extend(posts)
+
+    def get_post_history(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        target: Optional[str] = None,
+    ) -> List[PostRecord]:
+        with self._lock:
+            return sorted(
+                (
+                    post
+                    for post in self._history
+                    if start <= post.posted_at < end
+                    and (target is None or post.target == target)
+                ),
+                key=lambda post: post.posted_at,
+            )
+
+    def count_ephemeris(self) -> int:
+        return len(self._records)
+
+    def get_day_stats(self) -> List[DayStats]:
+        year_start: datetime.datetime = self._now().replace(
+            month=1, day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        # slots are the days of a leap year
+        first: datetime.date = datetime.date(2024, 1, 1)
+        stats: List[DayStats] = []
+        with self._lock:
+            for slot, records in enumerate(self._days):
+                if not records:
+                    continue
+                day: datetime.date = first + datetime.timedelta(days=slot)
+                stats.append(
+                    DayStats(
+                        month=day.month,
+                        day=day.day,
+                        events=len(records),
+                        untweeted=sum(
+                            record.last_tweeted_at is None
+                            or record.last_tweeted_at < year_start
+                            for record in records
+                        ),
+                    )
+                )
+        return stats
+
+    def insert_ephemeris(self, eph: Ephemeris) -> None:
+        self._copy([(eph.date, eph.text, eph.location)], eph.weight)
+
+    def copy_ephemeris(self, rows: Iterable[CopyRow]) -> int:
+        return self._copy(rows)
+
+    def _copy(self, rows: Iterable[CopyRow], weight: Optional[float] = None) -> int:
+        """Insert rows with the priority weight given, 1 like the SQL default."""
+        if weight is None:
+            weight = 1.0
+        copied: int = 0
+        today: int = day_slot(self._now())
+        inserted_today: List[int] = []
+        with self._lock:
+            for row in rows:
+                date, text, location = row[:3]
+                date = to_datetime(date)
+                record = _Record(
+                    self._next_id, date, text, location, row_template(row), weight
+                )
+                self._records[record.id] = record
+                self._days[day_slot(date)].append(record)
+                if day_slot(date) == today:
+                    inserted_today.append(record.id)
+                self._next_id += 1
+                copied += 1
+            # one notification per call, like the statement trigger of PostgreSQL
+            if inserted_today:
+                for listener in self._listeners:
+                    listener.inserted.put(inserted_today)
+        return copied
+
+    def listen_inserts(self) -> InsertListener:
+        """Listen for the ephemeris inserted for today into this storage."""
+        listener = _InsertListener(self)
+        with self._lock:
+            self._listeners.append(listener)
+        return listener
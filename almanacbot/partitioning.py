@@ -0,0 +1,419 @@
+"""Online migration of an ephemeris table to a table list-partitioned by month"""
+
+import time
+from typing import Iterator, Optional, Tuple
+
+from psycopg import Connection, Cursor, OperationalError, ProgrammingError, sql
+import typer
+
+from almanacbot.data_loader import read_configuration
+from almanacbot.postgresql_client import PostgreSQLClient
+from almanacbot.storage import create_storage, get_channel
+
+# Columns of the ephemeris table, copied as they are.
+COLUMNS: Tuple[str, ...] = (
+    "id",
+    "date",
+    "text",
+    "location",
+    "last_tweeted_at",
+    "placeholders",
+    "static_length",
+    "weight",
+)
+# The partition key, month of date in UTC, as the client computes it.
+_MONTH = sql.SQL("EXTRACT(MONTH FROM {} AT TIME ZONE 'UTC')::smallint")
+# Rows at most locked (FOR SHARE) by each copy transaction.
+DEFAULT_BATCH_SIZE: int = 10_000
+
+
+def _name(schema: str, name: str) -> sql.Identifier:
+    return sql.Identifier(schema, name)
+
+
+def _columns(prefix: str = "") -> sql.Composable:
+    return sql.SQL(", ").join(
+        sql.SQL(prefix) + sql.Identifier(column) for column in COLUMNS
+    )
+
+
+def table_schema(cursor: Cursor, table: str, schema: Optional[str]) -> str:
+    """The given schema, or else the schema of the table in the search path."""
+    if schema:
+        return schema
+    cursor.execute(
+        "SELECT relnamespace::regnamespace::text FROM pg_class "
+        "WHERE oid = %s::regclass",
+        (table,),
+    )
+    return cursor.fetchone()[0]
+
+
+def is_partitioned(cursor: Cursor, schema: str, table: str) -> bool:
+    cursor.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass",
+        (_name(schema, table).as_string(),),
+    )
+    return cursor.fetchone()[0]
+
+
+def create_partitioned_table(
+    cursor: Cursor,
+    schema: str,
+    table: str,
+    partition_prefix: Optional[str] = None,
+    sequence: Optional[str] = None,
+) -> None:
+    """
+    Create an ephemeris table list-partitioned by month, unless it exists.
+
+    Partitions are named after partition_prefix (the table by default), e.g.
+    `ephemeris_01`. Ids are drawn from sequence, or from a serial of the table.
+    """
+    id_column = (
+        sql.SQL("id integer NOT NULL DEFAULT nextval({}::regclass)").format(
+            sql.Literal(sequence)
+        )
+        if sequence
+        else sql.SQL("id serial")
+    )
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} ("
+            "{}, "
+            "date timestamp with time zone not null, "
+            "month smallint not null, "
+            "text text not null, "
+            "location point default null, "
+            "last_tweeted_at timestamp with time zone default null, "
+            "placeholders text default null, "
+            "static_length integer default null, "
+            "weight double precision not null default 1, "
+            "primary key (id, month)"
+            ") PARTITION BY LIST (month)"
+        ).format(_name(schema, table), id_column)
+    )
+    for month in range(1, 13):
+        cursor.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})"
+            ).format(
+                _name(schema, f"{partition_prefix or table}_{month:02d}"),
+                _name(schema, table),
+                sql.Literal(month),
+            )
+        )
+    cursor.execute(
+        sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} "
+            "(EXTRACT(MONTH FROM date), EXTRACT(DAY FROM date))"
+        ).format(sql.Identifier(f"idx_{table}_month_day"), _name(schema, table))
+    )
+    # the near-duplicate search of the data loader matches texts with pg_trgm
+    cursor.execute(
+        sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} USING gin (text gin_trgm_ops)"
+        ).format(sql.Identifier(f"idx_{table}_text_trgm"), _name(schema, table))
+    )
+
+
+def create_day_stats(cursor: Cursor, schema: str, table: str, view: str) -> None:
+    """Create the day statistics view of a table, as the init script does."""
+    cursor.execute(
+        sql.SQL(
+            "CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS "
+            "SELECT EXTRACT(MONTH FROM date)::integer AS month, "
+            "EXTRACT(DAY FROM date)::integer AS day, "
+            "COALESCE(EXTRACT(YEAR FROM last_tweeted_at)::integer, 0) AS tweeted_year, "
+            "count(*) AS events "
+            "FROM {} GROUP BY 1, 2, 3"
+        ).format(_name(schema, view), _name(schema, table))
+    )
+    cursor.execute(
+        sql.SQL(
+            "CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (month, day, tweeted_year)"
+        ).format(sql.Identifier(f"idx_{view}"), _name(schema, view))
+    )
+
+
+class Migration:
+    """
+    Moves an ephemeris table to a new table partitioned by month, online.
+
+    The rows are copied in batches of their own transactions while a trigger
+    mirrors every later insert, update and delete of the table, so that the
+    bot keeps reading and acknowledging the table meanwhile. The switch then
+    renames, under a short exclusive lock, the table to `<table>_unpartitioned`
+    and the partitioned one to `<table>`. Every step can be run again after an
+    interruption.
+    """
+
+    def __init__(self, connection: Connection, schema: Optional[str], table: str):
+        self.connection: Connection = connection
+        self.table: str = table
+        with connection.cursor() as cursor:
+            self.schema: str = table_schema(cursor, table, schema)
+        self.partitioned: str = f"{table}_partitioned"
+        self.unpartitioned: str = f"{table}_unpartitioned"
+        self._mirror: str = f"{table}_to_partitioned"
+
+    def _exists(self, cursor: Cursor, name: str) -> bool:
+        cursor.execute(
+            "SELECT to_regclass(%s) IS NOT NULL",
+            (_name(self.schema, name).as_string(),),
+        )
+        return cursor.fetchone()[0]
+
+    def prepare(self) -> None:
+        """Create the partitioned table and the trigger mirroring the changes."""
+        source = _name(self.schema, self.table)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_serial_sequence(%s, 'id')", (source.as_string(),)
+            )
+            create_partitioned_table(
+                cursor,
+                self.schema,
+                self.partitioned,
+                partition_prefix=self.table,
+                sequence=cursor.fetchone()[0],
+            )
+            # later changes of rows copied or not yet copied
+            cursor.execute(
+                sql.SQL(
+                    "CREATE OR REPLACE FUNCTION {function}() RETURNS trigger "
+                    "LANGUAGE plpgsql AS $$ BEGIN "
+                    "IF TG_OP <> 'INSERT' THEN "
+                    "DELETE FROM {target} WHERE id = OLD.id; "
+                    "END IF; "
+                    "IF TG_OP <> 'DELETE' THEN "
+                    "INSERT INTO {target} ({columns}, month) "
+                    "VALUES ({values}, {month}) ON CONFLICT DO NOTHING; "
+                    "END IF; "
+                    "RETURN NULL; "
+                    "END $$"
+                ).format(
+                    function=_name(self.schema, self._mirror),
+                    target=_name(self.schema, self.partitioned),
+                    columns=_columns(),
+                    values=_columns("NEW."),
+                    month=_MONTH.format(sql.SQL("NEW.date")),
+                )
+            )
+            cursor.execute(
+                sql.SQL(
+                    "CREATE OR REPLACE TRIGGER {} "
+                    "AFTER INSERT OR UPDATE OR DELETE ON {} "
+                    "FOR EACH ROW EXECUTE FUNCTION {}()"
+                ).format(
+                    sql.Identifier(self._mirror),
+                    source,
+                    _name(self.schema, self._mirror),
+                )
+            )
+        self.connection.commit()
+
+    def copy(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[Tuple[int, int]]:
+        """
+        Copy the rows present when the mirroring started, batch_size ids per
+        transaction, yielding the last id copied and the last id to copy.
+
+        The rows of a batch are locked FOR SHARE until it commits, so that a
+        concurrent update or delete is mirrored after their copy.
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("SELECT min(id), max(id) FROM {}").format(
+                    _name(self.schema, self.table)
+                )
+            )
+            first, last = cursor.fetchone()
+            self.connection.commit()
+            if first is None:
+                return
+            statement = sql.SQL(
+                "INSERT INTO {} ({}, month) "
+                "SELECT {}, {} FROM {} WHERE id >= %s AND id < %s FOR SHARE "
+                "ON CONFLICT DO NOTHING"
+            ).format(
+                _name(self.schema, self.partitioned),
+                _columns(),
+                _columns(),
+                _MONTH.format(sql.Identifier("date")),
+                _name(self.schema, self.table),
+            )
+            for start in range(first, last + 1, batch_size):
+                end: int = min(start + batch_size, last + 1)
+                cursor.execute(statement, (start, end))
+                self.connection.commit()
+                yield end - 1, last
+
+    def create_day_stats(self) -> bool:
+        """
+        Create the day statistics view of the partitioned table, if the table
+        has one, so that it only has to be renamed by the switch.
+        """
+        with self.connection.cursor() as cursor:
+            if not self._exists(cursor, f"{self.table}_day_stats"):
+                return False
+            create_day_stats(
+                cursor, self.schema, self.partitioned, f"{self.partitioned}_day_stats"
+            )
+        self.connection.commit()
+        return True
+
+    def switch(self, verify: bool = True) -> None:
+        """
+        Swap the tables in a single transaction, holding an exclusive lock on
+        the table for its duration (and a count of both tables if verify).
+
+        Raises:
+            ValueError: if verify and the tables have different row counts,
+                in which case nothing is changed.
+        """
+        source = _name(self.schema, self.table)
+        target = _name(self.schema, self.partitioned)
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(source)
+                )
+                if verify:
+                    cursor.execute(
+                        sql.SQL(
+                            "SELECT (SELECT count(*) FROM {}), "
+                            "(SELECT count(*) FROM {})"
+                        ).format(source, target)
+                    )
+                    rows, copied = cursor.fetchone()
+                    if rows != copied:
+                        raise ValueError(
+                            f"{copied} rows copied out of {rows}, copy them again"
+                        )
+                cursor.execute(
+                    sql.SQL("DROP TRIGGER {} ON {}").format(
+                        sql.Identifier(self._mirror), source
+                    )
+                )
+                cursor.execute(
+                    sql.SQL("DROP FUNCTION {}()").format(
+                        _name(self.schema, self._mirror)
+                    )
+                )
+                cursor.execute(
+                    "SELECT pg_get_serial_sequence(%s, 'id')",
+                    (source.as_string(),),
+                )
+                sequence: Optional[str] = cursor.fetchone()[0]
+                for table, name in (
+                    (source, self.unpartitioned),
+                    (target, self.table),
+                ):
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                            table, sql.Identifier(name)
+                        )
+                    )
+                if sequence:
+                    # dropping the unpartitioned table must keep the sequence
+                    cursor.execute(
+                        sql.SQL("ALTER SEQUENCE {} OWNED BY {}").format(
+                            sql.SQL(sequence),
+                            sql.Identifier(self.schema, self.table, "id"),
+                        )
+                    )
+                notify = sql.Identifier(f"{self.table}_notify_today_inserts")
+                cursor.execute(
+                    "SELECT to_regprocedure(%s) IS NOT NULL",
+                    (f"{self.schema}.notify_today_inserts()",),
+                )
+                if cursor.fetchone()[0]:
+                    cursor.execute(
+                        sql.SQL("DROP TRIGGER IF EXISTS {} ON {}").format(
+                            notify, _name(self.schema, self.unpartitioned)
+                        )
+                    )
+                    cursor.execute(
+                        sql.SQL(
+                            "CREATE TRIGGER {} AFTER INSERT ON {} "
+                            "REFERENCING NEW TABLE AS inserted "
+                            "FOR EACH STATEMENT EXECUTE FUNCTION {}()"
+                        ).format(
+                            notify,
+                            source,
+                            _name(self.schema, "notify_today_inserts"),
+                        )
+                    )
+                if self._exists(cursor, f"{self.partitioned}_day_stats"):
+                    cursor.execute(
+                        sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(
+                            _name(self.schema, f"{self.table}_day_stats")
+                        )
+                    )
+                    cursor.execute(
+                        sql.SQL("ALTER MATERIALIZED VIEW {} RENAME TO {}").format(
+                            _name(self.schema, f"{self.partitioned}_day_stats"),
+                            sql.Identifier(f"{self.table}_day_stats"),
+                        )
+                    )
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+
+def main(
+    channel: Optional[str] = typer.Option(
+        None, help="Channel whose table is partitioned [default: the first one]"
+    ),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, help="Ids copied (and locked) per transaction"
+    ),
+    pause: float = typer.Option(
+        0.0, help="Seconds to wait between batches, to spare the server"
+    ),
+    verify: bool = typer.Option(
+        True, help="Compare the row counts of both tables before switching"
+    ),
+):
+    config: dict = read_configuration()
+
+    try:
+        storage = create_storage(config, get_channel(config, channel))
+        if not isinstance(storage, PostgreSQLClient):
+            raise ValueError("Partitioning requires the postgresql storage backend")
+        connection = storage.engine.raw_connection()
+        try:
+            migration = Migration(
+                connection.driver_connection, storage.schema, storage.ephemeris_table
+            )
+            with connection.driver_connection.cursor() as cursor:
+                if is_partitioned(cursor, migration.schema, migration.table):
+                    print(
+                        f"{migration.schema}.{migration.table} is already partitioned."
+                    )
+                    return
+
+            print(f"Creating {migration.schema}.{migration.partitioned}...")
+            migration.prepare()
+            started: float = time.perf_counter()
+            for copied, last in migration.copy(batch_size):
+                print(f"Copied ids up to {copied}/{last}.")
+                time.sleep(pause)
+            print(f"Rows copied in {time.perf_counter() - started:.1f}s.")
+            if migration.create_day_stats():
+                print("Day statistics computed.")
+
+            print("Switching tables...")
+            migration.switch(verify)
+        finally:
+            connection.close()
+            storage.close()
+    except (OperationalError, ProgrammingError, ValueError) as exc:
+        print(f"Error partitioning the ephemeris table: {exc}")
+        raise typer.Exit(2)
+    print(
+        f"{migration.schema}.{migration.table} is partitioned by month, set "
+        f"partitioned=true in config.ini and restart the bot. The former table is "
+        f"kept as {migration.schema}.{migration.unpartitioned}."
+    )
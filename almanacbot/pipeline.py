@@ -0,0 +1,162 @@
+"""Pipeline stages decoupling tweet posting from storage acknowledgement"""
+
+import contextvars
+import logging
+import queue
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+from almanacbot import logs, tracing
+from almanacbot.storage import EphemerisStorage, PostRecord
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the acknowledgement stream.
+_CLOSE = object()
+
+
+class AcknowledgementWriter:
+    """
+    Background stage acknowledging posted ephemeris in batched storage updates.
+
+    The posting loop hands ids over through a bounded queue, which only blocks
+    it when the writer falls queue_size acknowledgements behind. The writer
+    takes whatever is queued, up to batch_size ids, and marks them all in a
+    single storage call. Posts to the history and partial deliveries to a
+    publishing target go through the same queue, so they are written before
+    the final acknowledgement.
+    """
+
+    def __init__(
+        self,
+        storage: EphemerisStorage,
+        queue_size: int = 100,
+        batch_size: int = 50,
+    ):
+        self._storage: EphemerisStorage = storage
+        self._batch_size: int = batch_size
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        # log records of the writer carry the run of the posting thread
+        self._thread: threading.Thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._run,),
+            name="acknowledgement-writer",
+            daemon=True,
+        )
+        self.acknowledged: List[int] = []
+        self.failed: List[int] = []
+        self.peak_depth: int = 0
+
+    def __enter__(self) -> "AcknowledgementWriter":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def depth(self) -> int:
+        """Number of acknowledgements waiting to be written."""
+        return self._queue.qsize()
+
+    def acknowledge(self, ephemeris_id: int) -> None:
+        """Queue an ephemeris id to be marked as tweeted."""
+        self._queue.put(ephemeris_id)
+        self.peak_depth = max(self.peak_depth, self._queue.qsize())
+
+    def acknowledge_many(self, ephemeris_ids: Sequence[int]) -> None:
+        """Queue ephemeris ids to be marked as tweeted in the same update."""
+        self._queue.put(list(ephemeris_ids))
+        self.peak_depth = max(self.peak_depth, self._queue.qsize())
+
+    def record(self, post: PostRecord) -> None:
+        """Queue a post to be appended to the post history."""
+        self._queue.put(post)
+        self.peak_depth = max(self.peak_depth, self._queue.qsize())
+
+    def deliver(self, ephemeris_id: int, target: str) -> None:
+        """Queue the delivery of an ephemeris to one publishing target."""
+        self._queue.put((ephemeris_id, target))
+        self.peak_depth = max(self.peak_depth, self._queue.qsize())
+
+    def close(self) -> None:
+        """Write every pending acknowledgement and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+
+    def _run(self) -> None:
+        with logs.stage("acknowledge"):
+            self._drain()
+
+    def _drain(self) -> None:
+        closing: bool = False
+        while not closing:
+            batch: List[int | List[int] | Tuple[int, str] | PostRecord] = []
+            item: Optional[object] = self._queue.get()
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(
+        self, batch: List[int | List[int] | Tuple[int, str] | PostRecord]
+    ) -> None:
+        with tracing.span("acknowledge", batch=len(batch)):
+            self._write_batch(batch)
+
+    def _write_batch(
+        self, batch: List[int | List[int] | Tuple[int, str] | PostRecord]
+    ) -> None:
+        posts: List[PostRecord] = [
+            item for item in batch if isinstance(item, PostRecord)
+        ]
+        if posts:
+            # the history is an audit trail, failing to write it does not
+            # fail the acknowledgements
+            try:
+                self._storage.record_posts(posts)
+                logger.debug("Recorded %d posts in the history.", len(posts))
+            except Exception:
+                logger.exception(
+                    "Failed to record %d posts in the history.", len(posts)
+                )
+        deliveries: List[Tuple[int, str]] = [
+            item for item in batch if isinstance(item, tuple)
+        ]
+        ephemeris_ids: List[int] = [
+            ephemeris_id
+            for item in batch
+            if isinstance(item, (int, list))
+            for ephemeris_id in (item if isinstance(item, list) else [item])
+        ]
+        if deliveries:
+            try:
+                self._storage.mark_many_delivered(deliveries)
+                logger.debug("Recorded %d deliveries: %s", len(deliveries), deliveries)
+            except Exception:
+                self.failed.extend(ephemeris_id for ephemeris_id, _ in deliveries)
+                logger.exception("Failed to record deliveries: %s", deliveries)
+        if ephemeris_ids:
+            try:
+                self._storage.mark_many_as_tweeted(ephemeris_ids)
+                self.acknowledged.extend(ephemeris_ids)
+                logger.debug(
+                    "Acknowledged %d tweeted ephemeris: %s",
+                    len(ephemeris_ids),
+                    ephemeris_ids,
+                )
+            except Exception:
+                self.failed.extend(ephemeris_ids)
+                logger.exception(
+                    "Failed to mark ephemeris as tweeted: %s", ephemeris_ids
+                )
@@ -1,25 +1,407 @@
+import dataclasses
 import datetime
-from typing import List
+import functools
+import logging
+import time
+from dataclasses import dataclass
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+)
 
+import psycopg
+from psycopg import errors, sql
 import sqlalchemy
 from sqlalchemy import (
+    TIMESTAMP,
+    BindParameter,
+    Delete,
+    Double,
+    Engine,
+    Integer,
     Select,
+    SmallInteger,
+    Update,
     and_,
+    any_,
+    bindparam,
+    case,
+    cast,
+    column,
     create_engine,
+    delete,
+    event,
     extract,
     func,
     insert,
+    literal_column,
     null,
     or_,
     select,
+    table,
+    update,
 )
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import TableClause
+
+from almanacbot import tracing
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import (
+    Delivery,
+    Ephemeris,
+    Location,
+    PostHistory,
+    RetryOutbox,
+    table_models,
+)
+from almanacbot.selection import ROUND_STEP, Scoring
+from almanacbot.storage import (
+    CopyRow,
+    DayStats,
+    EphemerisStorage,
+    InsertListener,
+    PostRecord,
+    RetryEntry,
+    TodayCounts,
+    row_template,
+    to_datetime,
+)
+from almanacbot.templates import TemplateInfo, analyze
+
+logger = logging.getLogger(__name__)
+
+# (month, day) pair, used to filter ephemeris by calendar day regardless of year
+MonthDay = Tuple[int, int]
+
+# Calendar days of two dates are the same or adjacent ones (Dec 31 and Jan 1
+# included) in the year of either date: Feb 28 and Mar 1 are adjacent, as in
+# non-leap years, and both are adjacent to Feb 29.
+_ADJACENT_DAYS = sql.SQL(
+    "(to_char({a}.date, 'MMDD') IN (to_char({b}.date - interval '1 day', 'MMDD'), "
+    "to_char({b}.date, 'MMDD'), to_char({b}.date + interval '1 day', 'MMDD')) "
+    "OR to_char({b}.date, 'MMDD') IN (to_char({a}.date - interval '1 day', 'MMDD'), "
+    "to_char({a}.date + interval '1 day', 'MMDD')))"
+)
+
+# Maximum seconds a replica may lag behind before reads go to the primary.
+DEFAULT_MAX_REPLICA_LAG: float = 10.0
+# Seconds between two checks of the replica lag.
+REPLICA_CHECK_INTERVAL: float = 5.0
+# Seconds of replay lag of a replica: 0 once it has replayed all the WAL
+# streamed to it, since the last replayed transaction otherwise (e.g. when
+# streaming stopped), and 0 for a server which is not a standby.
+_REPLICA_LAG = sqlalchemy.text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() AND EXISTS "
+    "(SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), "
+    "'Infinity') END"
+)
+
+# Parameters of the hot statements, bound on every execution. The ids are
+# sent as one array so that the SQL text does not depend on their number.
+_NOW: BindParameter = bindparam("now", type_=TIMESTAMP(timezone=True))
+_SINCE: BindParameter = bindparam("since", type_=TIMESTAMP(timezone=True))
+_UNTIL: BindParameter = bindparam("until", type_=TIMESTAMP(timezone=True))
+_IDS: BindParameter = bindparam("ids", type_=ARRAY(Integer))
+_LIMIT: BindParameter = bindparam("limit", type_=Integer)
+# Weights of the selection score, named after the Scoring fields.
+_WEIGHT: BindParameter = bindparam("weight", type_=Double)
+_PER_YEAR: BindParameter = bindparam("per_year", type_=Double)
+_MAX_YEARS: BindParameter = bindparam("max_years", type_=Integer)
+_ROUND_BONUS: BindParameter = bindparam("round_bonus", type_=Double)
+
+
+@dataclass(frozen=True)
+class _Statements:
+    """Statements of every run, built once per ephemeris table"""
+
+    today: Select
+    untweeted_today: Select
+    top_untweeted_today: Select
+    today_counts: Select
+    due_retries: Select
+    deliveries: Select
+    mark_tweeted: Update
+    lease_retries: Update
+    clear_retries: Delete
+    clear_deliveries: Delete
+
+
+@functools.cache
+def _statements(
+    ephemeris: Type[Ephemeris],
+    retry_outbox: Type[RetryOutbox],
+    delivery: Type[Delivery],
+) -> _Statements:
+    """
+    Build the hot statements of a table once, for the life of the process.
+
+    Reusing the same statement objects spares rebuilding them on every call
+    and lets SQLAlchemy find their compiled form in its cache. Their SQL text
+    never changes, so psycopg can prepare them on the server once they have
+    been executed prepare_threshold times on a connection.
+    """
+    today = and_(
+        extract("MONTH", ephemeris.date) == extract("MONTH", _NOW),
+        extract("DAY", ephemeris.date) == extract("DAY", _NOW),
+    )
+    if "month" in ephemeris.__table__.c:
+        # compared as the partition key type, so that the planner (or the
+        # executor, for generic plans) only scans the partition of the month
+        today = and_(
+            ephemeris.__table__.c.month
+            == cast(
+                extract("MONTH", func.timezone(literal_column("'UTC'"), _NOW)),
+                SmallInteger,
+            ),
+            today,
+        )
+    untweeted = or_(
+        ephemeris.last_tweeted_at.is_(None),
+        ephemeris.last_tweeted_at < func.date_trunc("day", _NOW),
+    )
+    # score of selection.Scoring, ranking the day's rows read through the
+    # month+day index so that only the top ones leave the server
+    year = cast(extract("YEAR", _NOW), Integer)
+    event_year = cast(extract("YEAR", ephemeris.date), Integer)
+    score = (
+        _WEIGHT * ephemeris.weight
+        + _PER_YEAR
+        * case(
+            (ephemeris.last_tweeted_at.is_(None), _MAX_YEARS),
+            else_=func.greatest(
+                0,
+                func.least(
+                    _MAX_YEARS,
+                    year - cast(extract("YEAR", ephemeris.last_tweeted_at), Integer),
+                ),
+            ),
+        )
+        + case(
+            (
+                and_(year - event_year > 0, (year - event_year) % ROUND_STEP == 0),
+                _ROUND_BONUS,
+            ),
+            else_=0.0,
+        )
+    )
+    return _Statements(
+        today=select(ephemeris).filter(today),
+        untweeted_today=select(ephemeris).filter(and_(today, untweeted)),
+        top_untweeted_today=select(ephemeris)
+        .filter(
+            and_(
+                today,
+                untweeted,
+                ~select(retry_outbox.ephemeris_id)
+                .where(retry_outbox.ephemeris_id == ephemeris.id)
+                .exists(),
+            )
+        )
+        .order_by(score.desc(), event_year, ephemeris.id)
+        .limit(_LIMIT),
+        today_counts=select(
+            func.count().filter(untweeted),
+            func.count().filter(ephemeris.last_tweeted_at >= _SINCE),
+        ).filter(today),
+        due_retries=(
+            select(ephemeris, retry_outbox.attempts)
+            .join(retry_outbox, retry_outbox.ephemeris_id == ephemeris.id)
+            .where(retry_outbox.next_attempt_at <= _NOW)
+            .order_by(retry_outbox.next_attempt_at)
+            .limit(_LIMIT)
+            # rows claimed by a concurrent run are skipped, not waited for
+            .with_for_update(of=retry_outbox, skip_locked=True)
+        ),
+        deliveries=select(delivery.ephemeris_id, delivery.target).where(
+            delivery.ephemeris_id == any_(_IDS)
+        ),
+        mark_tweeted=update(ephemeris)
+        .where(ephemeris.id == any_(_IDS))
+        .values(last_tweeted_at=_NOW)
+        .execution_options(synchronize_session=False),
+        lease_retries=update(retry_outbox)
+        .where(retry_outbox.ephemeris_id == any_(_IDS))
+        .values(next_attempt_at=_UNTIL)
+        .execution_options(synchronize_session=False),
+        clear_retries=delete(retry_outbox)
+        .where(retry_outbox.ephemeris_id == any_(_IDS))
+        .execution_options(synchronize_session=False),
+        clear_deliveries=delete(delivery)
+        .where(delivery.ephemeris_id == any_(_IDS))
+        .execution_options(synchronize_session=False),
+    )
+
+
+def _traced_connect(dialect, connection_record, cargs, cparams):
+    """Open DBAPI connections within a span, e.g. to time DNS and TLS."""
+    with tracing.span("postgresql.connect", host=cparams.get("host", "")):
+        return dialect.connect(*cargs, **cparams)
+
+
+def connect_engine(
+    user: str,
+    password: str,
+    hostname: str,
+    database: str,
+    logging_echo: bool,
+    prepare_threshold: Optional[int] = 5,
+) -> Engine:
+    """
+    Create the engine of a PostgreSQL server, whose connections are opened
+    within spans when tracing is enabled.
+
+    psycopg prepares a statement on the server once it has been executed
+    prepare_threshold times on a connection, never if it is None.
+
+    Sessions are in UTC, whatever the server default, so that the month and
+    day of dates are those of the partition key and of the clock.
+    """
+    engine: Engine = create_engine(
+        f"postgresql+psycopg://{user}:{password}@{hostname}/{database}",
+        echo=logging_echo,
+        connect_args={
+            "prepare_threshold": prepare_threshold,
+            "options": "-c TimeZone=UTC",
+        },
+    )
+    if tracing.enabled():
+        event.listen(engine, "do_connect", _traced_connect)
+    return engine
+
+
+@dataclass(frozen=True)
+class NearDuplicate:
+    """Loaded ephemeris whose text is similar to one of the same or adjacent day"""
+
+    ephemeris_id: int
+    date: datetime.datetime
+    text: str
+    # the similar ephemeris, stored before the load or loaded along with it
+    duplicate_of: int
+    duplicate_date: datetime.datetime
+    duplicate_text: str
+    # trigram similarity of both texts, from 0 to 1
+    similarity: float
+
+
+class _InsertListener(InsertListener):
+    """
+    LISTEN on a connection of its own, detached from the pool of the engine.
+
+    The insert trigger of the ephemeris table notifies, on the channel named
+    after the schema qualified table, the comma-separated ids of the rows
+    inserted for today: one notification per statement and per 500 rows.
+
+    A lost connection is opened again, and LISTENs again, on the next wait.
+    The notifications sent in between are lost, and their ephemeris left to
+    the scheduled runs.
+
+    Raises:
+        ValueError: if no trigger of the table notifies its inserts.
+    """
+
+    def __init__(self, engine: Engine, ephemeris_table: str, schema: Optional[str]):
+        self._engine: Engine = engine
+        self._ephemeris_table: str = ephemeris_table
+        self._schema: Optional[str] = schema
+        self._connection = None
+        self.channel: str = ""
+        self._connect()
+        driver = self._connection.driver_connection
+        if not driver.execute(
+            "SELECT EXISTS (SELECT FROM pg_trigger JOIN pg_proc"
+            " ON pg_proc.oid = pg_trigger.tgfoid"
+            " WHERE pg_trigger.tgrelid = (quote_ident(%s) || '.' || quote_ident(%s))"
+            "::regclass AND pg_proc.proname = 'notify_today_inserts'"
+            " AND pg_trigger.tgenabled <> 'D')",
+            (self._schema, self._ephemeris_table),
+        ).fetchone()[0]:
+            self.close()
+            raise ValueError(f"No trigger of {self.channel} notifies its inserts")
+
+    def _connect(self) -> None:
+        connection = self._engine.raw_connection()
+        connection.detach()
+        try:
+            driver = connection.driver_connection
+            driver.autocommit = True
+            if self._schema is None:
+                # the schema the table is found in through the search path
+                self._schema = driver.execute(
+                    "SELECT relnamespace::regnamespace::text FROM pg_class "
+                    "WHERE oid = %s::regclass",
+                    (self._ephemeris_table,),
+                ).fetchone()[0]
+            self.channel = f"{self._schema}.{self._ephemeris_table}"
+            driver.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        except BaseException:
+            connection.close()
+            raise
+        self._connection = connection
+
+    def wait(self, timeout: float) -> List[int]:
+        try:
+            if self._connection is None:
+                self._connect()
+                logger.info("Listening again on %s.", self.channel)
+            driver = self._connection.driver_connection
+            notifies: list = list(driver.notifies(timeout=timeout, stop_after=1))
+            if notifies:
+                # take the rest of the notifications of a bulk insert at once
+                notifies.extend(driver.notifies(timeout=0))
+        except (psycopg.OperationalError, sqlalchemy.exc.OperationalError):
+            logger.warning(
+                "Connection listening on %s lost, reconnecting in %.1fs...",
+                self.channel,
+                timeout,
+                exc_info=True,
+            )
+            self.close()
+            time.sleep(timeout)
+            return []
+        return [
+            int(ephemeris_id)
+            for notify in notifies
+            for ephemeris_id in notify.payload.split(",")
+        ]
+
+    def close(self) -> None:
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            try:
+                connection.close()
+            except psycopg.Error:
+                logger.debug("Error closing the listening connection.", exc_info=True)
 
-from almanacbot.ephemeris import Ephemeris
 
+class PostgreSQLClient(EphemerisStorage):
+    """
+    Class serving as PostgreSQL client
 
-class PostgreSQLClient:
-    """Class serving as PostgreSQL client"""
+    Serves one ephemeris table, in the given schema or else the search path.
+    Clients of several tables can share a single engine and connection pool.
+    A partitioned table is list-partitioned on the UTC month of date, which
+    the client writes on insert and filters on to prune the other months.
+    Clients not configured so still write it once they find the table
+    partitioned, e.g. after the switch of the migration tool.
+
+    With a replica engine, counts, day statistics and exports read from the
+    replica while it lags less than max_replica_lag seconds behind, and from
+    the primary otherwise. Writes, and the reads of the posting path, whose
+    tweet status must be current, always go to the primary.
+    """
 
     def __init__(
         self,
@@ -29,26 +411,65 @@ class PostgreSQLClient:
         database: str,
         ephemeris_table: str,
         logging_echo: bool,
+        schema: Optional[str] = None,
+        engine: Optional[Engine] = None,
+        now: Clock = utc_now,
+        prepare_threshold: Optional[int] = 5,
+        partitioned: bool = False,
+        replica: Optional[Engine] = None,
+        max_replica_lag: float = DEFAULT_MAX_REPLICA_LAG,
     ):
-        self.engine = create_engine(
-            f"postgresql+psycopg://{user}:{password}@{hostname}/{database}",
-            echo=logging_echo,
+        self.engine: Engine = engine or connect_engine(
+            user, password, hostname, database, logging_echo, prepare_threshold
         )
+        self.replica: Optional[Engine] = replica
+        self.max_replica_lag: float = max_replica_lag
+        self._replica_fresh: bool = False
+        self._replica_checked_at: Optional[float] = None
         self.ephemeris_table: str = ephemeris_table
+        self.schema: Optional[str] = schema
+        self.partitioned: bool = partitioned
+        # partitioned, as configured or as found on insert
+        self._writes_month: bool = partitioned
+        self._now: Clock = now
+        self._ephemeris: Type[Ephemeris]
+        self._retry_outbox: Type[RetryOutbox]
+        self._delivery: Type[Delivery]
+        self._post_history: Type[PostHistory]
+        (
+            self._ephemeris,
+            self._retry_outbox,
+            self._delivery,
+            self._post_history,
+        ) = table_models(ephemeris_table, schema, partitioned)
+        self._statements: _Statements = _statements(
+            self._ephemeris, self._retry_outbox, self._delivery
+        )
+        self._table: sql.Identifier = (
+            sql.Identifier(schema, ephemeris_table)
+            if schema
+            else sql.Identifier(ephemeris_table)
+        )
+        # materialized per (month, day, year tweeted or 0) counts of the table
+        self._day_stats: TableClause = table(
+            f"{ephemeris_table}_day_stats",
+            column("month"),
+            column("day"),
+            column("tweeted_year"),
+            column("events"),
+            schema=schema,
+        )
 
+    @tracing.traced("postgresql.get_today_ephemeris")
     def get_today_ephemeris(self) -> List[Ephemeris]:
         """Get all ephemeris entries for today using month+day matching."""
-        now = sqlalchemy.func.now()
-        query: Select = select(Ephemeris).filter(
-            and_(
-                extract("MONTH", Ephemeris.date) == extract("MONTH", now),
-                extract("DAY", Ephemeris.date) == extract("DAY", now),
-            )
-        )
         with Session(self.engine) as session:
-            ephs: List[Ephemeris] = session.scalars(query).all()
+            ephs: List[Ephemeris] = session.scalars(
+                self._statements.today, {"now": self._now()}
+            ).all()
             return ephs
 
+    @tracing.traced("postgresql.get_untweeted_today_ephemeris")
     def get_untweeted_today_ephemeris(self) -> List[Ephemeris]:
         """
         Get ephemeris entries for today that haven't been tweeted yet today.
@@ -56,41 +477,404 @@ class PostgreSQLClient:
         Uses month+day matching (handles leap years correctly) and checks
         that last_tweeted_at is either NULL or before today (idempotency).
         """
-        now = func.now()
-        today_start = func.date_trunc("day", now)
+        with Session(self.engine) as session:
+            ephs: List[Ephemeris] = session.scalars(
+                self._statements.untweeted_today, {"now": self._now()}
+            ).all()
+            return ephs
 
-        query: Select = select(Ephemeris).filter(
-            and_(
-                extract("MONTH", Ephemeris.date) == extract("MONTH", now),
-                extract("DAY", Ephemeris.date) == extract("DAY", now),
-                or_(
-                    Ephemeris.last_tweeted_at.is_(None),
-                    Ephemeris.last_tweeted_at < today_start,
-                ),
-            )
-        )
+    @tracing.traced("postgresql.get_top_untweeted_today_ephemeris", limit="limit")
+    def get_top_untweeted_today_ephemeris(
+        self, limit: int, scoring: Scoring
+    ) -> List[Ephemeris]:
+        """
+        Get today's best untweeted ephemeris, ranked by the server.
+
+        The score is computed over the rows of the month+day index and the
+        ORDER BY ... LIMIT is a bounded top-N sort, so days with thousands of
+        candidates only send and map the limit selected.
+        """
+        params: dict = {
+            "now": self._now(),
+            "limit": limit,
+            **dataclasses.asdict(scoring),
+        }
         with Session(self.engine) as session:
-            ephs: List[Ephemeris] = session.scalars(query).all()
+            ephs: List[Ephemeris] = session.scalars(
+                self._statements.top_untweeted_today, params
+            ).all()
             return ephs
 
+    @tracing.traced("postgresql.count_today_ephemeris")
+    def count_today_ephemeris(self, since: datetime.datetime) -> TodayCounts:
+        with Session(self.engine) as session:
+            untweeted, tweeted_since = session.execute(
+                self._statements.today_counts, {"now": self._now(), "since": since}
+            ).one()
+        return TodayCounts(untweeted=untweeted, tweeted_since=tweeted_since)
+
+    @tracing.traced("postgresql.mark_as_tweeted", ephemeris_id="ephemeris_id")
     def mark_as_tweeted(self, ephemeris_id: int) -> None:
         """Mark an ephemeris entry as tweeted with current UTC timestamp."""
         with Session(self.engine) as session:
-            eph = session.get(Ephemeris, ephemeris_id)
+            eph = session.get(self._ephemeris, ephemeris_id)
             if eph:
-                eph.last_tweeted_at = datetime.datetime.now(datetime.timezone.utc)
+                eph.last_tweeted_at = self._now()
+                session.execute(
+                    delete(self._retry_outbox).where(
+                        self._retry_outbox.ephemeris_id == ephemeris_id
+                    )
+                )
+                session.execute(
+                    delete(self._delivery).where(
+                        self._delivery.ephemeris_id == ephemeris_id
+                    )
+                )
                 session.commit()
 
-    def count_ephemeris(self) -> int:
+    @tracing.traced("postgresql.mark_many_as_tweeted", ephemeris_id="ephemeris_ids")
+    def mark_many_as_tweeted(self, ephemeris_ids: Sequence[int]) -> None:
+        """Mark several ephemeris entries as tweeted in a single UPDATE."""
+        params: dict = {"ids": list(ephemeris_ids), "now": self._now()}
+        with Session(self.engine) as session:
+            session.execute(self._statements.mark_tweeted, params)
+            session.execute(self._statements.clear_retries, params)
+            session.execute(self._statements.clear_deliveries, params)
+            session.commit()
+
+    @tracing.traced("postgresql.schedule_retry", ephemeris_id="ephemeris_id")
+    def schedule_retry(
+        self,
+        ephemeris_id: int,
+        attempts: int,
+        error_class: str,
+        error: str,
+        next_attempt_at: Optional[datetime.datetime],
+    ) -> None:
+        values: dict = {
+            "attempts": attempts,
+            "error_class": error_class,
+            "last_error": error,
+            "next_attempt_at": next_attempt_at,
+            "updated_at": self._now(),
+        }
+        stmnt = (
+            pg_insert(self._retry_outbox)
+            .values(ephemeris_id=ephemeris_id, **values)
+            .on_conflict_do_update(index_elements=["ephemeris_id"], set_=values)
+        )
+        with Session(self.engine) as session:
+            session.execute(stmnt)
+            if next_attempt_at is None:
+                session.execute(
+                    delete(self._delivery).where(
+                        self._delivery.ephemeris_id == ephemeris_id
+                    )
+                )
+            session.commit()
+
+    @tracing.traced("postgresql.claim_due_retries")
+    def claim_due_retries(
+        self, limit: int, lease: datetime.timedelta
+    ) -> List[RetryEntry]:
+        """
+        Claim due outbox entries through the partial next_attempt_at index.
+
+        The due rows are locked with FOR UPDATE SKIP LOCKED and leased in the
+        same transaction, so each of them goes to a single run.
+        """
+        now: datetime.datetime = self._now()
+        with Session(self.engine) as session:
+            entries: List[RetryEntry] = [
+                RetryEntry(ephemeris=eph, attempts=attempts)
+                for eph, attempts in session.execute(
+                    self._statements.due_retries, {"now": now, "limit": limit}
+                ).all()
+            ]
+            if entries:
+                session.execute(
+                    self._statements.lease_retries,
+                    {
+                        "ids": [entry.ephemeris.id for entry in entries],
+                        "until": now + lease,
+                    },
+                )
+                session.commit()
+            return entries
+
+    @tracing.traced("postgresql.claim_ephemeris", ephemeris_id="ephemeris_ids")
+    def claim_ephemeris(
+        self, ephemeris_ids: Sequence[int], lease: datetime.timedelta
+    ) -> List[int]:
+        """Insert the claims in one statement, skipping the ids in the outbox."""
+        if not ephemeris_ids:
+            return []
+        now: datetime.datetime = self._now()
+        stmnt = (
+            pg_insert(self._retry_outbox)
+            .values(
+                [
+                    {
+                        "ephemeris_id": ephemeris_id,
+                        "attempts": 0,
+                        "error_class": "",
+                        "next_attempt_at": now + lease,
+                        "updated_at": now,
+                    }
+                    for ephemeris_id in ephemeris_ids
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["ephemeris_id"])
+            .returning(self._retry_outbox.ephemeris_id)
+        )
+        with Session(self.engine) as session:
+            claimed: Set[int] = set(session.scalars(stmnt).all())
+            session.commit()
+        return [
+            ephemeris_id for ephemeris_id in ephemeris_ids if ephemeris_id in claimed
+        ]
+
+    @tracing.traced("postgresql.mark_many_delivered")
+    def mark_many_delivered(self, deliveries: Sequence[Tuple[int, str]]) -> None:
+        if not deliveries:
+            return
+        stmnt = (
+            pg_insert(self._delivery)
+            .values(
+                [
+                    {"ephemeris_id": ephemeris_id, "target": target}
+                    for ephemeris_id, target in deliveries
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["ephemeris_id", "target"])
+        )
+        with Session(self.engine) as session:
+            session.execute(stmnt)
+            session.commit()
+
+    @tracing.traced("postgresql.get_deliveries", ephemeris_id="ephemeris_ids")
+    def get_deliveries(self, ephemeris_ids: Sequence[int]) -> Dict[int, Set[str]]:
+        deliveries: Dict[int, Set[str]] = {}
+        with Session(self.engine) as session:
+            for ephemeris_id, target in session.execute(
+                self._statements.deliveries, {"ids": list(ephemeris_ids)}
+            ).all():
+                deliveries.setdefault(ephemeris_id, set()).add(target)
+        return deliveries
+
+    @tracing.traced("postgresql.record_posts")
+    def record_posts(self, posts: Sequence[PostRecord]) -> None:
+        if not posts:
+            return
         with Session(self.engine) as session:
-            stmnt = func.count(Ephemeris.id)
-            return session.execute(stmnt).scalar()
+            session.execute(
+                insert(self._post_history),
+                [
+                    {
+                        "ephemeris_id": post.ephemeris_id,
+                        "target": post.target,
+                        "post_id": post.post_id,
+                        "posted_at": post.posted_at,
+                        "latency": post.latency,
+                    }
+                    for post in posts
+                ],
+            )
+            session.commit()
+
+    @tracing.traced("postgresql.get_post_history", target="target")
+    def get_post_history(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        target: Optional[str] = None,
+    ) -> List[PostRecord]:
+        """Get posts through the BRIN index of post_history on posted_at."""
+        history: Type[PostHistory] = self._post_history
+        query: Select = (
+            select(history)
+            .where(history.posted_at >= start, history.posted_at < end)
+            .order_by(history.posted_at)
+        )
+        if target is not None:
+            query = query.where(history.target == target)
+        with Session(self.engine) as session:
+            return [
+                PostRecord(
+                    ephemeris_id=post.ephemeris_id,
+                    target=post.target,
+                    posted_at=post.posted_at,
+                    latency=post.latency,
+                    post_id=post.post_id,
+                )
+                for post in session.scalars(query)
+            ]
+
+    def listen_inserts(self) -> Optional[InsertListener]:
+        """
+        LISTEN to the notifications of the insert trigger of the table, or
+        return None if the table has no such trigger, e.g. a channel table
+        created without it.
+        """
+        try:
+            return _InsertListener(self.engine, self.ephemeris_table, self.schema)
+        except ValueError:
+            logger.warning(
+                "Inserts into %s are not notified: create its "
+                "notify_today_inserts trigger, as in the README.",
+                self.ephemeris_table,
+                exc_info=True,
+            )
+            return None
+
+    def close(self) -> None:
+        self.engine.dispose()
+        if self.replica is not None:
+            self.replica.dispose()
+
+    def _reader(self) -> Engine:
+        """
+        Engine of the reads which may lag behind: the replica, unless it lags
+        more than max_replica_lag seconds behind or cannot be reached. The
+        lag is checked at most every REPLICA_CHECK_INTERVAL seconds.
+        """
+        if self.replica is None:
+            return self.engine
+        checked_at: float = time.monotonic()
+        if (
+            self._replica_checked_at is None
+            or checked_at - self._replica_checked_at >= REPLICA_CHECK_INTERVAL
+        ):
+            self._replica_fresh = self._replica_is_fresh()
+            self._replica_checked_at = checked_at
+        return self.replica if self._replica_fresh else self.engine
+
+    def _replica_is_fresh(self) -> bool:
+        try:
+            with self.replica.connect() as connection:
+                lag: float = float(connection.execute(_REPLICA_LAG).scalar_one())
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.warning(
+                "Replica unreachable, reading from the primary.", exc_info=True
+            )
+            return False
+        if lag > self.max_replica_lag:
+            logger.warning(
+                "Replica %.1fs behind (max %.1fs), reading from the primary.",
+                lag,
+                self.max_replica_lag,
+            )
+            return False
+        return True
+
+    @tracing.traced("postgresql.count_ephemeris")
+    def count_ephemeris(self) -> int:
+        """
+        Sum the day statistics instead of counting every row of the table, or
+        count the rows of tables without the view, e.g. of older databases.
+        """
+        with Session(self._reader()) as session:
+            stmnt = select(func.coalesce(func.sum(self._day_stats.c.events), 0))
+            try:
+                return int(session.execute(stmnt).scalar())
+            except sqlalchemy.exc.ProgrammingError as exc:
+                if not isinstance(exc.orig, errors.UndefinedTable):
+                    raise
+        logger.warning(
+            "No %s view, counting the rows of %s.",
+            self._day_stats.name,
+            self.ephemeris_table,
+        )
+        with Session(self._reader()) as session:
+            return session.execute(
+                select(func.count()).select_from(self._ephemeris)
+            ).scalar_one()
+
+    @tracing.traced("postgresql.get_day_stats")
+    def get_day_stats(self) -> List[DayStats]:
+        stats: TableClause = self._day_stats
+        events = func.sum(stats.c.events)
+        query: Select = (
+            select(
+                stats.c.month,
+                stats.c.day,
+                events,
+                func.coalesce(
+                    events.filter(stats.c.tweeted_year < self._now().year), 0
+                ),
+            )
+            .group_by(stats.c.month, stats.c.day)
+            .order_by(stats.c.month, stats.c.day)
+        )
+        with Session(self._reader()) as session:
+            return [
+                DayStats(
+                    month=int(month),
+                    day=int(day),
+                    events=int(events),
+                    untweeted=int(untweeted),
+                )
+                for month, day, events, untweeted in session.execute(query).all()
+            ]
+
+    @tracing.traced("postgresql.refresh_day_stats")
+    def refresh_day_stats(self) -> None:
+        """Recompute the day statistics view, without blocking its readers."""
+        view: sql.Identifier = (
+            sql.Identifier(self.schema, self._day_stats.name)
+            if self.schema
+            else sql.Identifier(self._day_stats.name)
+        )
+        connection = self.engine.raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("REFRESH MATERIALIZED VIEW CONCURRENTLY {}").format(view)
+                )
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _is_partitioned(self) -> bool:
+        """
+        Whether inserts write the partition key: the table is configured as
+        partitioned, or found so in the catalog.
+        """
+        if not self._writes_month:
+            with self.engine.connect() as connection:
+                self._writes_month = bool(
+                    connection.execute(
+                        sqlalchemy.text(
+                            "SELECT relkind = 'p' FROM pg_class "
+                            "WHERE oid = CAST(:table AS regclass)"
+                        ),
+                        {"table": self._table.as_string()},
+                    ).scalar_one()
+                )
+            if self._writes_month:
+                logger.warning(
+                    "Table %s is partitioned: set partitioned=true and restart.",
+                    self.ephemeris_table,
+                )
+        return self._writes_month
 
+    @tracing.traced("postgresql.insert_ephemeris")
     def insert_ephemeris(self, eph: Ephemeris):
+        info: TemplateInfo = analyze(eph.text)
+        partitioned: bool = self._is_partitioned()
+        partition: dict = {"month": to_datetime(eph.date).month} if partitioned else {}
+        # unset weights take the column default
+        weight: dict = {"weight": eph.weight} if eph.weight is not None else {}
         with Session(self.engine) as session:
-            stmnt = insert(Ephemeris).values(
+            stmnt = insert(
+                table_models(self.ephemeris_table, self.schema, partitioned)[0]
+            ).values(
+                **partition,
+                **weight,
                 date=eph.date,
                 text=eph.text,
+                placeholders=" ".join(info.placeholders),
+                static_length=info.static_length,
                 location=(
                     sqlalchemy.func.point(eph.location.latitude, eph.location.longitude)
                     if eph.location is not None
@@ -99,3 +883,263 @@ class PostgreSQLClient:
             )
             session.execute(stmnt)
             session.commit()
+
+    @tracing.traced("postgresql.copy_ephemeris")
+    def copy_ephemeris(self, rows: Iterable[CopyRow]) -> int:
+        """
+        Bulk-insert (date, text, location) rows through a single COPY stream,
+        along with the metadata of their text templates, analyzed unless the
+        rows carry it.
+
+        The whole stream is committed as one transaction: either every row is
+        loaded or none is, e.g. if a text template is invalid.
+
+        Returns:
+            Number of rows copied.
+        """
+        columns: List[str] = [
+            "date",
+            "text",
+            "location",
+            "placeholders",
+            "static_length",
+        ]
+        partitioned: bool = self._is_partitioned()
+        if partitioned:
+            columns.append("month")
+        statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            self._table, sql.SQL(", ").join(map(sql.Identifier, columns))
+        )
+        copied: int = 0
+        connection = self.engine.raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                with cursor.copy(statement) as copy:
+                    for copy_row in rows:
+                        date, text, location = copy_row[:3]
+                        info: TemplateInfo = row_template(copy_row)
+                        row: tuple = (
+                            date,
+                            text,
+                            f"({location.latitude},{location.longitude})"
+                            if location is not None
+                            else None,
+                            " ".join(info.placeholders),
+                            info.static_length,
+                        )
+                        if partitioned:
+                            row += (to_datetime(date).month,)
+                        copy.write_row(row)
+                        copied += 1
+            connection.commit()
+        finally:
+            connection.close()
+        return copied
+
+    @property
+    def staging_table(self) -> str:
+        """Table the data loader copies into before near-duplicates are found."""
+        return f"{self.ephemeris_table}_staging"
+
+    def _identifier(self, name: str) -> sql.Identifier:
+        return (
+            sql.Identifier(self.schema, name) if self.schema else sql.Identifier(name)
+        )
+
+    def _execute(self, *statements: sql.Composable) -> int:
+        """Run statements in one transaction, returning the last row count."""
+        connection = self.engine.raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+                rowcount: int = cursor.rowcount
+            connection.commit()
+        finally:
+            connection.close()
+        return rowcount
+
+    @tracing.traced("postgresql.create_staging")
+    def create_staging(self) -> str:
+        """
+        Create an empty unlogged staging table with the columns of the table,
+        whose ids are drawn from the sequence of the table.
+
+        Returns:
+            The name of the staging table, in the schema of the table.
+        """
+        staging: sql.Identifier = self._identifier(self.staging_table)
+        self._execute(
+            sql.SQL(
+                "CREATE UNLOGGED TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)"
+            ).format(staging, self._table),
+            sql.SQL("TRUNCATE {}").format(staging),
+        )
+        return self.staging_table
+
+    @tracing.traced("postgresql.find_near_duplicates")
+    def find_near_duplicates(self, threshold: float) -> List[NearDuplicate]:
+        """
+        Find the staged ephemeris whose text has a trigram similarity of at
+        least threshold with an ephemeris of the same or an adjacent calendar
+        day, stored or staged before it. Most similar first.
+
+        Pairs are found by two joins on the pg_trgm `%` operator, served by
+        the trigram GIN indexes of the table and of the staging table.
+        """
+        staging: sql.Identifier = self._identifier(self.staging_table)
+        pairs = sql.SQL(
+            "SELECT s.id, s.date, s.text, d.id, d.date, d.text, "
+            "similarity(s.text, d.text) "
+            "FROM {} AS s JOIN {} AS d ON d.text % s.text AND {}"
+        )
+        adjacent = _ADJACENT_DAYS.format(a=sql.SQL("s"), b=sql.SQL("d"))
+        connection = self.engine.raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE INDEX IF NOT EXISTS {} ON {} "
+                        "USING gin (text gin_trgm_ops)"
+                    ).format(
+                        sql.Identifier(f"idx_{self.staging_table}_text_trgm"),
+                        staging,
+                    )
+                )
+                cursor.execute(sql.SQL("ANALYZE {}").format(staging))
+                cursor.execute(
+                    "SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                    (str(threshold),),
+                )
+                cursor.execute(
+                    sql.SQL(
+                        "{} UNION ALL {} AND d.id < s.id ORDER BY 7 DESC, 1, 4"
+                    ).format(
+                        pairs.format(staging, self._table, adjacent),
+                        pairs.format(staging, staging, adjacent),
+                    )
+                )
+                duplicates: List[NearDuplicate] = [
+                    NearDuplicate(*row) for row in cursor.fetchall()
+                ]
+            connection.commit()
+        finally:
+            connection.close()
+        return duplicates
+
+    @tracing.traced("postgresql.merge_staging")
+    def merge_staging(self) -> int:
+        """
+        Move the staged rows into the table in a single statement, and drop
+        the staging table.
+
+        Returns:
+            Number of rows moved.
+        """
+        staging: sql.Identifier = self._identifier(self.staging_table)
+        merged: int = self._execute(
+            sql.SQL("INSERT INTO {} SELECT * FROM {}").format(self._table, staging)
+        )
+        self._execute(sql.SQL("DROP TABLE {}").format(staging))
+        return merged
+
+    @staticmethod
+    def _export_query(
+        columns: sql.Composable,
+        from_day: Optional[MonthDay],
+        to_day: Optional[MonthDay],
+        tweeted: Optional[bool],
+        table: sql.Composable = sql.Identifier(Ephemeris.__tablename__),
+    ) -> Tuple[sql.Composed, List[int]]:
+        """
+        Build the SELECT used to export ephemeris, with its parameters.
+
+        A from_day later than to_day wraps around the end of the year, e.g.
+        12-20..01-10.
+        """
+        month_day = sql.SQL("(EXTRACT(MONTH FROM date), EXTRACT(DAY FROM date))")
+        conditions: List[sql.Composable] = []
+        params: List[int] = []
+        lower = sql.SQL("{} >= (%s, %s)").format(month_day)
+        upper = sql.SQL("{} <= (%s, %s)").format(month_day)
+        if from_day and to_day:
+            joiner = sql.SQL(" AND " if from_day <= to_day else " OR ")
+            conditions.append(sql.SQL("({})").format(joiner.join([lower, upper])))
+            params.extend([*from_day, *to_day])
+        elif from_day:
+            conditions.append(lower)
+            params.extend(from_day)
+        elif to_day:
+            conditions.append(upper)
+            params.extend(to_day)
+        if tweeted is not None:
+            conditions.append(
+                sql.SQL(
+                    "last_tweeted_at IS NOT NULL"
+                    if tweeted
+                    else "last_tweeted_at IS NULL"
+                )
+            )
+
+        query = sql.SQL("SELECT {} FROM {}").format(columns, table)
+        if conditions:
+            query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+        return query + sql.SQL(" ORDER BY id"), params
+
+    @tracing.traced("postgresql.copy_ephemeris_csv_to")
+    def copy_ephemeris_csv_to(
+        self,
+        output: BinaryIO,
+        from_day: Optional[MonthDay] = None,
+        to_day: Optional[MonthDay] = None,
+        tweeted: Optional[bool] = None,
+    ) -> None:
+        """
+        Stream ephemeris into output as `;`-delimited `date;text;location` CSV
+        with a header, the format read by the data loader.
+        """
+        query, params = self._export_query(
+            sql.SQL("date, text, location"), from_day, to_day, tweeted, self._table
+        )
+        statement = sql.SQL(
+            "COPY ({}) TO STDOUT WITH (FORMAT csv, DELIMITER ';', HEADER)"
+        ).format(query)
+        connection = self._reader().raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                with cursor.copy(statement, params) as copy:
+                    for data in copy:
+                        output.write(data)
+        finally:
+            connection.close()
+
+    def iter_ephemeris_rows(
+        self,
+        from_day: Optional[MonthDay] = None,
+        to_day: Optional[MonthDay] = None,
+        tweeted: Optional[bool] = None,
+    ) -> Iterator[Tuple[datetime.datetime, str, Optional[Location]]]:
+        """Stream typed (date, text, location) rows out of a COPY TO STDOUT."""
+        query, params = self._export_query(
+            sql.SQL("date, text, location[0], location[1]"),
+            from_day,
+            to_day,
+            tweeted,
+            self._table,
+        )
+        statement = sql.SQL("COPY ({}) TO STDOUT").format(query)
+        connection = self._reader().raw_connection()
+        try:
+            with connection.driver_connection.cursor() as cursor:
+                with cursor.copy(statement, params) as copy:
+                    copy.set_types(["timestamptz", "text", "float8", "float8"])
+                    for date, text, latitude, longitude in copy.rows():
+                        yield (
+                            date,
+                            text,
+                            Location(latitude, longitude)
+                            if latitude is not None
+                            else None,
+                        )
+        finally:
+            connection.close()
@@ -0,0 +1,572 @@
+"""Fan-out publishing of ephemeris to several accounts and social networks"""
+
+import abc
+import concurrent.futures
+import contextvars
+import datetime
+import logging
+import string
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import requests
+from babel import Locale
+from babel.dates import format_date
+
+from almanacbot import tracing
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import Ephemeris
+from almanacbot.maps import MediaCache
+from almanacbot.storage import PostRecord
+from almanacbot.templates import MAX_TWEET_LENGTH, PLACEHOLDERS, weighted_length
+
+logger = logging.getLogger(__name__)
+
+# How a target posts the ephemeris of a run: one post each, digests packing
+# several of them per post, or digests replying to each other in a thread.
+BUNDLE_MODES: Tuple[str, ...] = ("none", "digest", "thread")
+BUNDLE_SEPARATOR: str = "\n\n"
+
+
+def render_text(eph: Ephemeris, locale: Locale, today: datetime.date) -> str:
+    """
+    Substitute the ${date} and ${years_ago} placeholders of an ephemeris.
+
+    Only the placeholders found at ingest are computed, and texts without
+    any are returned as they are.
+    """
+    placeholders: Sequence[str] = (
+        PLACEHOLDERS if eph.placeholders is None else eph.placeholders.split()
+    )
+    if not placeholders and "$" not in eph.text:
+        return eph.text
+    values: Dict[str, object] = {}
+    if "date" in placeholders:
+        values["date"] = format_date(date=eph.date.date(), format="full", locale=locale)
+    if "years_ago" in placeholders:
+        values["years_ago"] = today.year - eph.date.year
+    return string.Template(eph.text).substitute(values)
+
+
+def idempotency_key(eph: Ephemeris, today: datetime.date) -> str:
+    """Key identifying the post of an ephemeris on a day, across retries."""
+    return f"almanac-{eph.id}-{today:%Y%m%d}"
+
+
+def pack(texts: Sequence[str], max_length: int) -> List[List[int]]:
+    """
+    Group consecutive texts into the fewest posts of at most max_length
+    weighted characters, once joined with BUNDLE_SEPARATOR.
+
+    Filling each post before starting the next one is optimal when the order
+    of the texts is kept. Texts longer than max_length are posted alone.
+
+    Returns:
+        The indexes of the texts of each post.
+    """
+    separator: int = weighted_length(BUNDLE_SEPARATOR)
+    groups: List[List[int]] = []
+    length: int = 0
+    for index, text in enumerate(texts):
+        text_length: int = weighted_length(text)
+        if groups and length + separator + text_length <= max_length:
+            groups[-1].append(index)
+            length += separator + text_length
+        else:
+            groups.append([index])
+            length = text_length
+    return groups
+
+
+class PublishTarget(abc.ABC):
+    """
+    Account on a social network ephemeris are posted to.
+
+    Each target has its own locale and a rate budget: posts are at least
+    min_interval seconds apart. Bundling targets pack the ephemeris of a run
+    into posts of up to max_length weighted characters (see BUNDLE_MODES).
+    Targets able to upload media attach a locator map to the posts of
+    ephemeris with a location, unless maps is False.
+    """
+
+    # time an uploaded media can be attached to posts for, None if forever
+    media_ttl: Optional[datetime.timedelta] = None
+    # whether an uploaded media can be attached to several posts
+    media_reusable: bool = True
+
+    def __init__(
+        self,
+        name: str,
+        locale: Locale,
+        min_interval: float = 0.0,
+        bundle: str = "none",
+        max_length: int = MAX_TWEET_LENGTH,
+        maps: bool = True,
+    ):
+        if bundle not in BUNDLE_MODES:
+            raise ValueError(f"Unknown bundle mode of target {name}: {bundle}")
+        self.name: str = name
+        self.locale: Locale = locale
+        self.min_interval: float = min_interval
+        self.bundle: str = bundle
+        self.max_length: int = max_length
+        self.maps: bool = maps
+
+    @property
+    def supports_media(self) -> bool:
+        return type(self).upload_media is not PublishTarget.upload_media
+
+    @abc.abstractmethod
+    def post(
+        self, text: str, key: str, reply_to: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Post a rendered text, raising on failure; key identifies the post.
+
+        Args:
+            text: text of the post.
+            key: idempotency key of the post.
+            reply_to: id of the post this one replies to, in a thread.
+
+        Returns:
+            The id of the post on the network, if known.
+
+        Targets supporting media also take the media_ids to attach.
+        """
+
+    def upload_media(self, image: bytes, mime_type: str, description: str) -> str:
+        """
+        Upload an image to attach to later posts, raising on failure.
+
+        Returns:
+            The id of the media on the network.
+        """
+        raise NotImplementedError(f"Target {self.name} does not support media")
+
+    def rejects_media(self, exc: Exception) -> bool:
+        """Whether a post failed because the network rejected its media ids."""
+        return False
+
+
+class MastodonTarget(PublishTarget):
+    """Mastodon account, posted to through the statuses API"""
+
+    # a media belongs to the status it is attached to, and further statuses
+    # attaching it are posted without it
+    media_reusable: bool = False
+
+    def __init__(
+        self,
+        name: str,
+        locale: Locale,
+        base_url: str,
+        access_token: str,
+        min_interval: float = 0.0,
+        timeout: float = 30.0,
+        bundle: str = "none",
+        max_length: int = MAX_TWEET_LENGTH,
+        maps: bool = True,
+    ):
+        super().__init__(name, locale, min_interval, bundle, max_length, maps)
+        self._url: str = f"{base_url.rstrip('/')}/api/v1/statuses"
+        self._media_url: str = f"{base_url.rstrip('/')}/api/v2/media"
+        self._access_token: str = access_token
+        self._timeout: float = timeout
+        self._session: requests.Session = requests.Session()
+
+    def post(
+        self,
+        text: str,
+        key: str,
+        reply_to: Optional[str] = None,
+        media_ids: Sequence[str] = (),
+    ) -> Optional[str]:
+        data: Dict[str, object] = {"status": text}
+        if reply_to is not None:
+            data["in_reply_to_id"] = reply_to
+        if media_ids:
+            data["media_ids[]"] = list(media_ids)
+        response = self._session.post(
+            self._url,
+            data=data,
+            headers={
+                "Authorization": f"Bearer {self._access_token}",
+                # Mastodon drops repeated posts with the same key
+                "Idempotency-Key": key,
+            },
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        return response.json().get("id")
+
+    def upload_media(self, image: bytes, mime_type: str, description: str) -> str:
+        response = self._session.post(
+            self._media_url,
+            files={"file": ("map.png", image, mime_type)},
+            data={"description": description},
+            headers={"Authorization": f"Bearer {self._access_token}"},
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        return str(response.json()["id"])
+
+    def rejects_media(self, exc: Exception) -> bool:
+        # unknown media ids fail the validation of the status
+        return (
+            isinstance(exc, requests.HTTPError)
+            and exc.response is not None
+            and exc.response.status_code == 422
+        )
+
+
+class WebhookTarget(PublishTarget):
+    """Generic HTTP endpoint receiving posts as JSON, e.g. a network bridge"""
+
+    def __init__(
+        self,
+        name: str,
+        locale: Locale,
+        url: str,
+        token: str = "",
+        min_interval: float = 0.0,
+        timeout: float = 30.0,
+        bundle: str = "none",
+        max_length: int = MAX_TWEET_LENGTH,
+    ):
+        super().__init__(name, locale, min_interval, bundle, max_length)
+        self._url: str = url
+        self._token: str = token
+        self._timeout: float = timeout
+        self._session: requests.Session = requests.Session()
+
+    def post(
+        self, text: str, key: str, reply_to: Optional[str] = None
+    ) -> Optional[str]:
+        headers: Dict[str, str] = {}
+        if self._token:
+            headers["Authorization"] = f"Bearer {self._token}"
+        payload: Dict[str, str] = {"text": text, "idempotency_key": key}
+        if reply_to is not None:
+            payload["in_reply_to"] = reply_to
+        response = self._session.post(
+            self._url,
+            json=payload,
+            headers=headers,
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        return None
+
+
+def create_target(target_conf: dict, now: Clock = utc_now) -> PublishTarget:
+    """Create the publishing target described by a [target:<name>] section."""
+    target_type: str = target_conf["type"]
+    locale: Locale = Locale.parse(target_conf["locale"])
+    if target_type == "twitter":
+        from almanacbot.twitter_client import TwitterClient
+
+        return TwitterClient(
+            bearer_token=target_conf["bearer_token"],
+            consumer_key=target_conf["consumer_key"],
+            consumer_secret=target_conf["consumer_secret"],
+            access_token_key=target_conf["access_token_key"],
+            access_token_secret=target_conf["access_token_secret"],
+            locale=locale,
+            name=target_conf["name"],
+            min_interval=target_conf["min_interval"],
+            bundle=target_conf.get("bundle", "none"),
+            max_length=target_conf.get("max_length", MAX_TWEET_LENGTH),
+            maps=target_conf.get("maps", True),
+            now=now,
+        )
+    if target_type == "mastodon":
+        return MastodonTarget(
+            name=target_conf["name"],
+            locale=locale,
+            base_url=target_conf["base_url"],
+            access_token=target_conf["access_token"],
+            min_interval=target_conf["min_interval"],
+            bundle=target_conf.get("bundle", "none"),
+            max_length=target_conf.get("max_length", MAX_TWEET_LENGTH),
+            maps=target_conf.get("maps", True),
+        )
+    if target_type == "webhook":
+        return WebhookTarget(
+            name=target_conf["name"],
+            locale=locale,
+            url=target_conf["url"],
+            token=target_conf.get("token", ""),
+            min_interval=target_conf["min_interval"],
+            bundle=target_conf.get("bundle", "none"),
+            max_length=target_conf.get("max_length", MAX_TWEET_LENGTH),
+        )
+    raise ValueError(f"Unknown publishing target type: {target_type}")
+
+
+class FanOutPublisher:
+    """
+    Posts ephemeris to every publishing target concurrently.
+
+    Each ephemeris is rendered once per locale. Every target then posts the
+    whole batch from its own worker thread, at its own pace, so a slow or
+    rate-limited target does not delay the others. Results are reported per
+    target as they happen, and once per ephemeris when every target is done.
+    Bundling targets post the batch in as few posts as they fit in. With a
+    media cache, posts of a single ephemeris with a location carry its map.
+    """
+
+    def __init__(
+        self,
+        targets: Sequence[PublishTarget],
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+        now: Clock = utc_now,
+        media: Optional[MediaCache] = None,
+    ):
+        names: List[str] = [target.name for target in targets]
+        if not targets or len(set(names)) != len(names):
+            raise ValueError(f"Publishing target names must be unique: {names}")
+        self.targets: List[PublishTarget] = list(targets)
+        self._sleep: Callable[[float], None] = sleep
+        self._clock: Callable[[], float] = clock
+        self._now: Clock = now
+        self.media: Optional[MediaCache] = media
+
+    def _post(
+        self,
+        target: PublishTarget,
+        bundle: Sequence[Ephemeris],
+        text: str,
+        key: str,
+        reply_to: Optional[str],
+        media_ids: List[str],
+    ) -> Optional[str]:
+        """
+        Post text with the map of bundle, if any. A map the target rejects,
+        e.g. once its media expired earlier than cached, is uploaded again and
+        the post sent once more.
+        """
+        if not media_ids:
+            return target.post(text, key, reply_to=reply_to)
+        try:
+            return target.post(text, key, reply_to=reply_to, media_ids=media_ids)
+        except Exception as exc:
+            if not target.rejects_media(exc):
+                raise
+            logger.warning(
+                "%s rejected the map of ephemeris id=%s, uploading it again",
+                target.name,
+                bundle[0].id,
+                exc_info=True,
+            )
+        self.media.evict(target, bundle[0].location)
+        media_ids = self._map_media(target, bundle)
+        if not media_ids:
+            return target.post(text, key, reply_to=reply_to)
+        return target.post(text, key, reply_to=reply_to, media_ids=media_ids)
+
+    def _map_media(
+        self, target: PublishTarget, bundle: Sequence[Ephemeris]
+    ) -> List[str]:
+        """
+        Media ids of the map of a post on target, if it has one.
+
+        Maps are best effort: a post goes without its map when it cannot be
+        rendered or uploaded.
+        """
+        if (
+            self.media is None
+            or len(bundle) != 1
+            or bundle[0].location is None
+            or not target.maps
+            or not target.supports_media
+        ):
+            return []
+        eph: Ephemeris = bundle[0]
+        try:
+            with tracing.span("map", target=target.name, ephemeris_id=eph.id):
+                return [self.media.media_id(target, eph.location)]
+        except Exception:
+            logger.exception(
+                "Failed to attach the map of ephemeris id=%s on %s, posting without it",
+                eph.id,
+                target.name,
+            )
+            return []
+
+    def publish(
+        self,
+        ephemeris: Sequence[Ephemeris],
+        delivered: Dict[int, Set[str]],
+        on_delivery: Callable[[Ephemeris, PostRecord], None],
+        on_complete: Callable[[List[Tuple[Ephemeris, Dict[str, Exception]]]], None],
+        dry_run: bool = False,
+        threads: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """
+        Post ephemeris to the targets they have not been delivered to yet.
+
+        Args:
+            ephemeris: ephemeris to post, in posting order.
+            delivered: names of the targets each ephemeris already reached.
+            on_delivery: called from the target's thread after each post,
+                with the record of each ephemeris for the post history.
+            on_complete: called once every target is done with ephemeris,
+                with the errors of the targets that failed. Ephemeris
+                completed by the same post, e.g. a digest, are reported in
+                a single call.
+            dry_run: log the posts instead of sending them.
+            threads: id of the last post of each thread bundling target,
+                which its first post replies to, e.g. to resume the thread
+                of the day after a failure.
+        """
+        today: datetime.date = self._now().date()
+        threads = threads or {}
+        pending: Dict[int, Set[str]] = {}
+        errors: Dict[int, Dict[str, Exception]] = {}
+        texts: Dict[Tuple[int, str], str] = {}
+        lock = threading.Lock()
+        for eph in ephemeris:
+            pending[eph.id] = {
+                target.name
+                for target in self.targets
+                if target.name not in delivered.get(eph.id, set())
+            }
+            errors[eph.id] = {}
+            for target in self.targets:
+                locale_key = (eph.id, str(target.locale))
+                if locale_key not in texts:
+                    try:
+                        with tracing.span(
+                            "render", ephemeris_id=eph.id, locale=locale_key[1]
+                        ):
+                            texts[locale_key] = render_text(eph, target.locale, today)
+                    except Exception as exc:
+                        logger.exception("Failed to render ephemeris id=%s", eph.id)
+                        for name in pending[eph.id]:
+                            errors[eph.id][name] = exc
+                        pending[eph.id] = set()
+                        break
+
+        # ephemeris failing to render or already everywhere complete right away
+        completed: List[Tuple[Ephemeris, Dict[str, Exception]]] = [
+            (eph, errors[eph.id]) for eph in ephemeris if not pending[eph.id]
+        ]
+        if completed:
+            on_complete(completed)
+
+        def done(
+            bundle: Sequence[Ephemeris],
+            target: PublishTarget,
+            exc: Optional[Exception],
+            latency: float = 0.0,
+            post_id: Optional[str] = None,
+        ):
+            if exc is None:
+                posted_at: datetime.datetime = self._now()
+                for eph in bundle:
+                    on_delivery(
+                        eph,
+                        PostRecord(eph.id, target.name, posted_at, latency, post_id),
+                    )
+            completed: List[Tuple[Ephemeris, Dict[str, Exception]]] = []
+            with lock:
+                for eph in bundle:
+                    if exc is not None:
+                        errors[eph.id][target.name] = exc
+                    pending[eph.id].discard(target.name)
+                    if not pending[eph.id]:
+                        completed.append((eph, errors[eph.id]))
+            if completed:
+                on_complete(completed)
+
+        def run_target(target: PublishTarget) -> None:
+            queued: List[Ephemeris] = [
+                eph for eph in ephemeris if target.name in pending[eph.id]
+            ]
+            locale: str = str(target.locale)
+            bundles: List[List[Ephemeris]] = (
+                [[eph] for eph in queued]
+                if target.bundle == "none"
+                else [
+                    [queued[index] for index in group]
+                    for group in pack(
+                        [texts[(eph.id, locale)] for eph in queued], target.max_length
+                    )
+                ]
+            )
+            reply_to: Optional[str] = (
+                threads.get(target.name) if target.bundle == "thread" else None
+            )
+            # a failed post breaks the thread, the rest is left to the retries
+            broken: Optional[Exception] = None
+            last_post: Optional[float] = None
+            for bundle in bundles:
+                ids: str = ", ".join(str(eph.id) for eph in bundle)
+                text: str = BUNDLE_SEPARATOR.join(
+                    texts[(eph.id, locale)] for eph in bundle
+                )
+                if broken is not None:
+                    done(bundle, target, broken)
+                    continue
+                if dry_run:
+                    logger.info(
+                        "[DRY-RUN] Would post to %s id=%s: %s", target.name, ids, text
+                    )
+                    done(bundle, target, None)
+                    continue
+                if last_post is not None:
+                    wait: float = last_post + target.min_interval - self._clock()
+                    if wait > 0:
+                        self._sleep(wait)
+                last_post = self._clock()
+                key: str = idempotency_key(bundle[0], today)
+                if len(bundle) > 1:
+                    key += f"+{len(bundle) - 1}"
+                media_ids: List[str] = self._map_media(target, bundle)
+                try:
+                    logger.info("Posting ephemeris id=%s to %s...", ids, target.name)
+                    with tracing.span(
+                        "post",
+                        target=target.name,
+                        ephemeris_id=[eph.id for eph in bundle],
+                        reply_to=reply_to or "",
+                    ):
+                        post_id: Optional[str] = self._post(
+                            target, bundle, text, key, reply_to, media_ids
+                        )
+                except Exception as exc:
+                    logger.exception(
+                        "Failed to post ephemeris id=%s to %s", ids, target.name
+                    )
+                    if target.bundle == "thread":
+                        broken = exc
+                    done(bundle, target, exc)
+                else:
+                    latency: float = self._clock() - last_post
+                    logger.info(
+                        "Posted ephemeris id=%s to %s in %.3fs",
+                        ids,
+                        target.name,
+                        latency,
+                    )
+                    if target.bundle == "thread" and post_id is not None:
+                        reply_to = str(post_id)
+                    done(
+                        bundle,
+                        target,
+                        None,
+                        latency,
+                        None if post_id is None else str(post_id),
+                    )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.targets), thread_name_prefix="publisher"
+        ) as executor:
+            # workers log with the run and stage of the caller
+            for future in [
+                executor.submit(contextvars.copy_context().run, run_target, target)
+                for target in self.targets
+            ]:
+                future.result()
@@ -0,0 +1,88 @@
+"""Retry policies of failed posts, by exception type"""
+
+import datetime
+import random
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+import requests
+import tweepy
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with jitter: base_delay * 2^(attempts-1), capped."""
+
+    base_delay: float
+    max_delay: float
+    max_attempts: int
+
+
+RATE_LIMIT_POLICY: RetryPolicy = RetryPolicy(60, 15 * 60, 12)
+SERVER_ERROR_POLICY: RetryPolicy = RetryPolicy(30, 15 * 60, 10)
+
+# Checked in order, so subclasses must come before their parents. A None
+# policy marks permanent failures that are kept in the outbox but not retried.
+RETRY_POLICIES: Tuple[Tuple[type, Optional[RetryPolicy]], ...] = (
+    (tweepy.TooManyRequests, RATE_LIMIT_POLICY),
+    (tweepy.TwitterServerError, SERVER_ERROR_POLICY),
+    # bad request, unauthorized, forbidden (e.g. duplicate content), not found
+    (tweepy.HTTPException, None),
+    (requests.RequestException, RetryPolicy(15, 10 * 60, 10)),
+    (tweepy.TweepyException, RetryPolicy(15, 10 * 60, 10)),
+    (Exception, RetryPolicy(60, 30 * 60, 5)),
+)
+
+
+def classify_status(status_code: int) -> Optional[RetryPolicy]:
+    """
+    Return the retry policy of an HTTP error status, as tweepy's exceptions
+    are classified: rate limits and server errors are retried, other client
+    errors (e.g. unauthorized, or unprocessable content) are permanent.
+    """
+    if status_code == 429:
+        return RATE_LIMIT_POLICY
+    if status_code >= 500:
+        return SERVER_ERROR_POLICY
+    return None
+
+
+def classify(exc: BaseException) -> Optional[RetryPolicy]:
+    """Return the retry policy of a posting error, None if it is permanent."""
+    # raised by raise_for_status() of the Mastodon and webhook targets
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return classify_status(exc.response.status_code)
+    for exc_type, policy in RETRY_POLICIES:
+        if isinstance(exc, exc_type):
+            return policy
+    return None
+
+
+def next_attempt_at(
+    exc: BaseException,
+    attempts: int,
+    now: datetime.datetime,
+    rand: Callable[[], float] = random.random,
+) -> Optional[datetime.datetime]:
+    """
+    Compute when to retry a post that has failed attempts times with exc.
+
+    Uses "equal jitter": half of the exponential delay is fixed and the other
+    half random, so retries of a burst of failures spread out without ever
+    coming back too early. Rate limit errors also wait for the reset time
+    announced by the API. Returns None when the post must not be retried.
+    """
+    policy: Optional[RetryPolicy] = classify(exc)
+    if policy is None or attempts >= policy.max_attempts:
+        return None
+
+    delay: float = min(policy.max_delay, policy.base_delay * 2 ** (attempts - 1))
+    retry_at: datetime.datetime = now + datetime.timedelta(
+        seconds=delay / 2 + rand() * delay / 2
+    )
+
+    reset_time: Optional[int] = getattr(exc, "reset_time", None)
+    if reset_time is not None:
+        reset_at = datetime.datetime.fromtimestamp(reset_time, datetime.timezone.utc)
+        retry_at = max(retry_at, reset_at)
+    return retry_at
@@ -0,0 +1,187 @@
+"""Staggered posting of a day's ephemeris across capped posting windows"""
+
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Collection, List, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from almanacbot.ephemeris import Ephemeris
+from almanacbot.selection import Scoring
+from almanacbot.storage import EphemerisStorage, TodayCounts
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PostingWindow:
+    """Local time range in which at most cap ephemeris are posted"""
+
+    start: datetime.time
+    end: datetime.time
+    cap: int
+
+    def __str__(self) -> str:
+        return f"{self.start:%H:%M}-{self.end:%H:%M}/{self.cap}"
+
+
+def parse_windows(value: str) -> List[PostingWindow]:
+    """
+    Parse comma-separated `HH:MM-HH:MM/cap` posting windows.
+
+    Windows must not cross midnight nor overlap, and are returned sorted.
+    """
+    windows: List[PostingWindow] = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            times, cap = item.split("/")
+            start, end = times.split("-")
+            window = PostingWindow(
+                start=datetime.time.fromisoformat(start.strip()),
+                end=datetime.time.fromisoformat(end.strip()),
+                cap=int(cap),
+            )
+        except ValueError as e:
+            raise ValueError(f"Invalid posting window: {item}", e) from e
+        if window.start >= window.end or window.cap < 1:
+            raise ValueError(f"Invalid posting window: {item}")
+        windows.append(window)
+
+    windows.sort(key=lambda window: window.start)
+    for previous, window in zip(windows, windows[1:]):
+        if window.start < previous.end:
+            raise ValueError(f"Overlapping posting windows: {previous}, {window}")
+    return windows
+
+
+class PostingSchedule:
+    """
+    Spreads a day's untweeted ephemeris across posting windows.
+
+    The bot is run every few minutes and each run posts its share of the open
+    window: the cap is released evenly over the window, so by the time t into
+    it at most cap * t / duration + 1 ephemeris have been posted. Nothing is
+    posted outside the windows. Without windows, at most daily_cap ephemeris
+    are posted a (local) day, as soon as possible, or every untweeted one when
+    daily_cap is 0.
+
+    Whenever a cap leaves ephemeris behind, the ones posted are the best
+    scored by scoring: weighted ones, round anniversaries and the ones not
+    posted for the longest time, so that the winners rotate over the years.
+    """
+
+    def __init__(
+        self,
+        windows: Sequence[PostingWindow] = (),
+        timezone: str = "UTC",
+        daily_cap: int = 0,
+        scoring: Scoring = Scoring(),
+    ):
+        self.windows: List[PostingWindow] = list(windows)
+        try:
+            self.timezone: ZoneInfo = ZoneInfo(timezone)
+        except (ValueError, ZoneInfoNotFoundError) as e:
+            raise ValueError(f"Unknown schedule timezone: {timezone}", e) from e
+        if daily_cap < 0:
+            raise ValueError(f"Invalid daily cap: {daily_cap}")
+        self.daily_cap: int = daily_cap
+        self.scoring: Scoring = scoring
+
+    def open_window(
+        self, now: datetime.datetime
+    ) -> Optional[Tuple[PostingWindow, datetime.datetime, datetime.datetime]]:
+        """Get the window open at now, with its start and end datetimes."""
+        local_now: datetime.datetime = now.astimezone(self.timezone)
+        for window in self.windows:
+            start = datetime.datetime.combine(
+                local_now.date(), window.start, tzinfo=self.timezone
+            )
+            end = datetime.datetime.combine(
+                local_now.date(), window.end, tzinfo=self.timezone
+            )
+            if start <= local_now < end:
+                return window, start, end
+        return None
+
+    def remaining_cap(self, now: datetime.datetime) -> int:
+        """Cap of the open window and the windows still to come today."""
+        local_time: datetime.time = now.astimezone(self.timezone).time()
+        return sum(window.cap for window in self.windows if local_time < window.end)
+
+    def plan(
+        self,
+        storage: EphemerisStorage,
+        now: datetime.datetime,
+        exclude: Collection[int] = (),
+    ) -> List[Ephemeris]:
+        """
+        Select the untweeted ephemeris to post now, by score.
+
+        Only the number of today's ephemeris and the selected ones are read
+        from the storage, which ranks the day's candidates itself.
+
+        Args:
+            storage: storage of today's ephemeris.
+            now: current time.
+            exclude: ids of ephemeris posted anyway, e.g. due retries, which
+                are neither counted nor planned.
+        """
+        if not self.windows and not self.daily_cap:
+            return [
+                eph
+                for eph in storage.get_untweeted_today_ephemeris()
+                if eph.id not in exclude
+            ]
+
+        if self.windows:
+            open_window = self.open_window(now)
+            if open_window is None:
+                logger.info(
+                    "Outside posting windows, ephemeris left for later windows: %s",
+                    ", ".join(str(w) for w in self.windows),
+                )
+                return []
+            window, start, end = open_window
+            counts: TodayCounts = storage.count_today_ephemeris(start)
+            elapsed: float = (now - start) / (end - start)
+            allowed: int = min(window.cap, int(window.cap * elapsed) + 1)
+            remaining_cap: int = self.remaining_cap(now) - counts.tweeted_since
+            period: str = f"Posting window {window}"
+        else:
+            day_start: datetime.datetime = now.astimezone(self.timezone).replace(
+                hour=0, minute=0, second=0, microsecond=0
+            )
+            counts = storage.count_today_ephemeris(day_start)
+            allowed = self.daily_cap
+            remaining_cap = self.daily_cap - counts.tweeted_since
+            period = f"Daily cap {self.daily_cap}"
+        quota: int = max(0, allowed - counts.tweeted_since)
+
+        if counts.untweeted > remaining_cap:
+            logger.warning(
+                "%d untweeted ephemeris exceed the remaining posting cap of %d today.",
+                counts.untweeted,
+                remaining_cap,
+            )
+
+        planned: List[Ephemeris] = []
+        if quota:
+            # excluded ones may be among the best, fetch enough to skip them
+            planned = [
+                eph
+                for eph in storage.get_top_untweeted_today_ephemeris(
+                    quota + len(exclude), self.scoring
+                )
+                if eph.id not in exclude
+            ][:quota]
+        logger.info(
+            "%s: %d posted, %d of %d untweeted ephemeris planned now.",
+            period,
+            counts.tweeted_since,
+            len(planned),
+            counts.untweeted,
+        )
+        return planned
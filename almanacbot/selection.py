@@ -0,0 +1,85 @@
+"""Weighted selection of a day's ephemeris, rotating the ones posted lately"""
+
+import datetime
+import heapq
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Protocol, Tuple, TypeVar
+
+# Anniversaries multiple of this many years are round ones, e.g. 25, 50, 75.
+ROUND_STEP: int = 25
+
+
+class Candidate(Protocol):
+    """Ephemeris, or storage record, scored for selection"""
+
+    id: int
+    date: datetime.datetime
+    last_tweeted_at: Optional[datetime.datetime]
+    weight: float
+
+
+C = TypeVar("C", bound=Candidate)
+
+
+@dataclass(frozen=True)
+class Scoring:
+    """
+    Weights of the score ranking a day's candidates, the sum of:
+
+    - weight times the priority weight of the ephemeris (1 by default),
+    - per_year times the years since the ephemeris was last posted, counted
+      up to max_years, and as max_years when it was never posted,
+    - round_bonus for round anniversaries (years ago multiple of ROUND_STEP).
+
+    Ties go to the oldest events, then to the lowest ids.
+    """
+
+    weight: float = 1.0
+    per_year: float = 1.0
+    max_years: int = 10
+    round_bonus: float = 10.0
+
+    def score(
+        self, weight: float, event_year: int, posted_year: Optional[int], year: int
+    ) -> float:
+        """Score of an ephemeris of event_year, last posted in posted_year."""
+        years_since: int = (
+            self.max_years
+            if posted_year is None
+            else max(0, min(self.max_years, year - posted_year))
+        )
+        years_ago: int = year - event_year
+        round_anniversary: bool = years_ago > 0 and years_ago % ROUND_STEP == 0
+        return (
+            self.weight * weight
+            + self.per_year * years_since
+            + (self.round_bonus if round_anniversary else 0.0)
+        )
+
+    def rank(self, candidate: Candidate, year: int) -> Tuple[float, int, int]:
+        """Sort key of candidate in year, the best one first."""
+        posted: Optional[datetime.datetime] = candidate.last_tweeted_at
+        return (
+            -self.score(
+                candidate.weight,
+                candidate.date.year,
+                None if posted is None else posted.year,
+                year,
+            ),
+            candidate.date.year,
+            candidate.id,
+        )
+
+
+def top(
+    candidates: Iterable[C], limit: int, scoring: Scoring, today: datetime.date
+) -> List[C]:
+    """
+    The limit best candidates, best first, scoring each of them once.
+
+    A bounded heap keeps the selection O(n log limit), so days with thousands
+    of candidates are not sorted whole to post a few of them.
+    """
+    return heapq.nsmallest(
+        limit, candidates, key=lambda candidate: scoring.rank(candidate, today.year)
+    )
@@ -0,0 +1,189 @@
+"""Replays the bot day after day on a simulated clock, against fake targets"""
+
+import calendar
+import datetime
+import logging
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import typer
+from babel import Locale
+
+from almanacbot.almanacbot import AlmanacBot, Channel
+from almanacbot.clock import SimulatedClock
+from almanacbot.ephemeris import Location
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.publisher import FanOutPublisher, PublishTarget
+from almanacbot.templates import MAX_TWEET_LENGTH, weighted_length
+
+logger = logging.getLogger(__name__)
+
+
+class CountingTarget(PublishTarget):
+    """Publishing target counting posts instead of sending them"""
+
+    def __init__(self, name: str, locale: Locale):
+        super().__init__(name, locale)
+        self.posts: int = 0
+        self.too_long: int = 0
+
+    def post(
+        self, text: str, key: str, reply_to: Optional[str] = None
+    ) -> Optional[str]:
+        self.posts += 1
+        if weighted_length(text) > MAX_TWEET_LENGTH:
+            self.too_long += 1
+        return str(self.posts)
+
+
+@dataclass
+class DayReport:
+    """Outcome of the simulated runs of one day"""
+
+    day: datetime.date
+    # ephemeris of the day, every one of them should be posted once
+    due: int
+    posted: int
+    # posted again by a second run of the same day, should be 0
+    reposted: int
+    latency: float
+    # Feb 29 ephemeris never due this year, reported on Feb 28 of non-leap years
+    skipped: int = 0
+
+    @property
+    def consistent(self) -> bool:
+        return self.posted == self.due and self.reposted == 0
+
+
+def random_corpus(
+    rows: int, seed: int = 0
+) -> Iterator[Tuple[datetime.datetime, str, Optional[Location]]]:
+    """Random events over every calendar day of two centuries, Feb 29 included."""
+    generator = random.Random(seed)
+    start = datetime.datetime(1800, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    for i in range(rows):
+        yield (
+            start + datetime.timedelta(days=generator.randrange(365 * 200)),
+            f"Event {i}, on ${{date}}, ${{years_ago}} years ago.",
+            None,
+        )
+
+
+def simulate(
+    bot: AlmanacBot,
+    clock: SimulatedClock,
+    first: datetime.date,
+    last: datetime.date,
+    at: datetime.time = datetime.time(12),
+) -> Iterator[DayReport]:
+    """
+    Run the bot on every day from first to last, at the given UTC time.
+
+    Each day is run twice: the second run should find nothing left to post.
+    Feb 29 ephemeris, never due in non-leap years, are counted on Feb 28.
+    """
+    day: datetime.date = first
+    while day <= last:
+        clock.now = datetime.datetime.combine(day, at, tzinfo=datetime.timezone.utc)
+        due: int = sum(
+            len(channel.storage.get_today_ephemeris()) for channel in bot.channels
+        )
+        skipped: int = 0
+        if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+            skipped = sum(
+                stats.events
+                for channel in bot.channels
+                for stats in channel.storage.get_day_stats()
+                if (stats.month, stats.day) == (2, 29)
+            )
+        started: float = time.perf_counter()
+        posted: int = bot.run()
+        latency: float = time.perf_counter() - started
+        yield DayReport(
+            day=day,
+            due=due,
+            posted=posted,
+            reposted=bot.run(),
+            latency=latency,
+            skipped=skipped,
+        )
+        day += datetime.timedelta(days=1)
+
+
+def main(
+    paths: List[str] = typer.Argument(
+        None,
+        help="CSV, JSONL or Parquet corpus files, or directories containing them "
+        "[default: init_db.csv]",
+    ),
+    from_date: datetime.datetime = typer.Option(
+        ..., "--from", formats=["%Y-%m-%d"], help="First simulated day"
+    ),
+    to_date: datetime.datetime = typer.Option(
+        ..., "--to", formats=["%Y-%m-%d"], help="Last simulated day"
+    ),
+    at: str = typer.Option("12:00", help="UTC time of the daily run"),
+    rows: int = typer.Option(
+        0, help="Simulate a random corpus of this many rows instead of files"
+    ),
+    locale: str = typer.Option("ca_ES", help="Locale of the simulated target"),
+    quiet: bool = typer.Option(False, help="Only print the summary"),
+):
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        run_at: datetime.time = datetime.time.fromisoformat(at)
+        target = CountingTarget("simulated", Locale.parse(locale))
+    except ValueError as exc:
+        print(f"Invalid simulation parameters: {exc}")
+        raise typer.Exit(2)
+    if to_date < from_date:
+        print(f"The simulation ends before it starts: {from_date} > {to_date}")
+        raise typer.Exit(2)
+
+    clock = SimulatedClock(from_date.replace(tzinfo=datetime.timezone.utc))
+    started: float = time.perf_counter()
+    if rows:
+        storage = MemoryStorage(random_corpus(rows), now=clock)
+    else:
+        storage = MemoryStorage.from_files(paths or ["init_db.csv"], now=clock)
+    print(
+        f"Loaded {storage.count_ephemeris()} ephemeris in "
+        f"{time.perf_counter() - started:.2f}s."
+    )
+    bot = AlmanacBot.from_channels(
+        [Channel("simulated", storage, FanOutPublisher([target], now=clock))],
+        now=clock,
+    )
+
+    reports: List[DayReport] = []
+    # Feb 29 ephemeris never posted, per non-leap year
+    skipped: Dict[int, int] = {}
+    for report in simulate(bot, clock, from_date.date(), to_date.date(), run_at):
+        reports.append(report)
+        if report.skipped:
+            skipped[report.day.year] = report.skipped
+        if not quiet or not report.consistent:
+            print(
+                f"{report.day}: {report.posted}/{report.due} posted, "
+                f"{report.reposted} reposted in {report.latency * 1000:.1f}ms"
+                f"{'' if report.consistent else ' INCONSISTENT'}"
+                f"{f', {report.skipped} Feb 29 skipped' if report.skipped else ''}"
+            )
+
+    latencies: List[float] = sorted(report.latency for report in reports)
+    inconsistent: int = sum(not report.consistent for report in reports)
+    print(
+        f"Simulated {len(reports)} days in {sum(latencies):.2f}s: "
+        f"{sum(report.posted for report in reports)} posts "
+        f"({target.too_long} too long), {inconsistent} inconsistent days, "
+        f"run latency p50 {statistics.median(latencies) * 1000:.1f}ms, "
+        f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f}ms, "
+        f"max {latencies[-1] * 1000:.1f}ms."
+    )
+    for year, count in skipped.items():
+        print(f"{year}: {count} Feb 29 ephemeris never posted, not a leap year.")
+    if inconsistent:
+        raise typer.Exit(1)
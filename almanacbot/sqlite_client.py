@@ -0,0 +1,437 @@
+import datetime
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import Ephemeris, Location
+from almanacbot.selection import ROUND_STEP, Scoring
+from almanacbot.storage import (
+    CopyRow,
+    DayStats,
+    EphemerisStorage,
+    PostRecord,
+    RetryEntry,
+    TodayCounts,
+    row_template,
+    to_datetime,
+)
+from almanacbot.templates import TemplateInfo
+
+SCHEMA: str = """
+    CREATE TABLE IF NOT EXISTS ephemeris (
+        id INTEGER PRIMARY KEY,
+        date TEXT NOT NULL,
+        month_day INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        latitude REAL DEFAULT NULL,
+        longitude REAL DEFAULT NULL,
+        last_tweeted_at TEXT DEFAULT NULL,
+        placeholders TEXT DEFAULT NULL,
+        static_length INTEGER DEFAULT NULL,
+        weight REAL NOT NULL DEFAULT 1
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_ephemeris_month_day ON ephemeris (month_day);
+
+    CREATE TABLE IF NOT EXISTS retry_outbox (
+        ephemeris_id INTEGER PRIMARY KEY,
+        attempts INTEGER NOT NULL,
+        error_class TEXT NOT NULL,
+        last_error TEXT DEFAULT NULL,
+        next_attempt_at TEXT DEFAULT NULL,
+        updated_at TEXT NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_retry_outbox_next_attempt_at
+    ON retry_outbox (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS delivery (
+        ephemeris_id INTEGER NOT NULL,
+        target TEXT NOT NULL,
+        delivered_at TEXT NOT NULL,
+        PRIMARY KEY (ephemeris_id, target)
+    );
+
+    CREATE TABLE IF NOT EXISTS post_history (
+        ephemeris_id INTEGER NOT NULL,
+        target TEXT NOT NULL,
+        post_id TEXT DEFAULT NULL,
+        posted_at TEXT NOT NULL,
+        latency REAL NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_post_history_posted_at ON post_history (posted_at);
+"""
+
+SELECT_COLUMNS: str = (
+    "ephemeris.id, ephemeris.date, ephemeris.text, ephemeris.latitude,"
+    " ephemeris.longitude, ephemeris.last_tweeted_at, ephemeris.placeholders,"
+    " ephemeris.static_length, ephemeris.weight"
+)
+
+# Columns added to the ephemeris table since its first release.
+ADDED_COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("placeholders", "TEXT DEFAULT NULL"),
+    ("static_length", "INTEGER DEFAULT NULL"),
+    ("weight", "REAL NOT NULL DEFAULT 1"),
+)
+
+# Score of selection.Scoring, for the year given and years stored as UTC text.
+SCORE: str = (
+    ":weight * weight"
+    " + :per_year * CASE WHEN last_tweeted_at IS NULL THEN :max_years"
+    " ELSE max(0, min(:max_years,"
+    " :year - CAST(substr(last_tweeted_at, 1, 4) AS INTEGER))) END"
+    " + CASE WHEN :year - CAST(substr(date, 1, 4) AS INTEGER) > 0"
+    f" AND (:year - CAST(substr(date, 1, 4) AS INTEGER)) % {ROUND_STEP} = 0"
+    " THEN :round_bonus ELSE 0 END"
+)
+
+
+def to_text(value: datetime.datetime) -> str:
+    """Format an aware datetime so that text comparisons are chronological."""
+    return value.astimezone(datetime.timezone.utc).isoformat(timespec="microseconds")
+
+
+def month_day_key(value: datetime.date) -> int:
+    """Encode the calendar day of value as month * 100 + day."""
+    return value.month * 100 + value.day
+
+
+class SQLiteClient(EphemerisStorage):
+    """
+    Class serving as embedded SQLite storage, for small and edge deployments.
+
+    Dates are stored as UTC ISO 8601 strings, so they compare chronologically,
+    next to an indexed month*100+day column used for today's lookups.
+    """
+
+    def __init__(self, path: str, now: Clock = utc_now):
+        self._now: Clock = now
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection = sqlite3.connect(
+            path, timeout=60, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        columns: Set[str] = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(ephemeris)")
+        }
+        for column, definition in ADDED_COLUMNS:
+            if column not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE ephemeris ADD COLUMN {column} {definition}"
+                )
+
+    @staticmethod
+    def _to_ephemeris(row: tuple) -> Ephemeris:
+        (
+            eph_id,
+            date,
+            text,
+            latitude,
+            longitude,
+            last_tweeted_at,
+            placeholders,
+            static_length,
+            weight,
+        ) = row
+        return Ephemeris(
+            id=eph_id,
+            date=datetime.datetime.fromisoformat(date),
+            text=text,
+            location=Location(latitude, longitude) if latitude is not None else None,
+            last_tweeted_at=(
+                datetime.datetime.fromisoformat(last_tweeted_at)
+                if last_tweeted_at
+                else None
+            ),
+            placeholders=placeholders,
+            static_length=static_length,
+            weight=weight,
+        )
+
+    def _query(self, query: str, params: tuple | dict) -> List[Ephemeris]:
+        with self._lock:
+            rows: List[tuple] = self._connection.execute(query, params).fetchall()
+        return [self._to_ephemeris(row) for row in rows]
+
+    def get_today_ephemeris(self) -> List[Ephemeris]:
+        return self._query(
+            f"SELECT {SELECT_COLUMNS} FROM ephemeris WHERE month_day = ? ORDER BY id",
+            (month_day_key(self._now()),),
+        )
+
+    def get_untweeted_today_ephemeris(self) -> List[Ephemeris]:
+        now: datetime.datetime = self._now()
+        today_start: datetime.datetime = now.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        return self._query(
+            f"SELECT {SELECT_COLUMNS} FROM ephemeris"
+            " WHERE month_day = ?"
+            " AND (last_tweeted_at IS NULL OR last_tweeted_at < ?)"
+            " ORDER BY id",
+            (month_day_key(now), to_text(today_start)),
+        )
+
+    def get_top_untweeted_today_ephemeris(
+        self, limit: int, scoring: Scoring
+    ) -> List[Ephemeris]:
+        now: datetime.datetime = self._now()
+        today_start: datetime.datetime = now.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        return self._query(
+            f"SELECT {SELECT_COLUMNS} FROM ephemeris"
+            " WHERE month_day = :month_day"
+            " AND (last_tweeted_at IS NULL OR last_tweeted_at < :today_start)"
+            " AND id NOT IN (SELECT ephemeris_id FROM retry_outbox)"
+            f" ORDER BY {SCORE} DESC, CAST(substr(date, 1, 4) AS INTEGER), id"
+            " LIMIT :limit",
+            {
+                "month_day": month_day_key(now),
+                "today_start": to_text(today_start),
+                "year": now.year,
+                "limit": limit,
+                "weight": scoring.weight,
+                "per_year": scoring.per_year,
+                "max_years": scoring.max_years,
+                "round_bonus": scoring.round_bonus,
+            },
+        )
+
+    def count_today_ephemeris(self, since: datetime.datetime) -> TodayCounts:
+        now: datetime.datetime = self._now()
+        today_start: datetime.datetime = now.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        with self._lock:
+            untweeted, tweeted_since = self._connection.execute(
+                "SELECT"
+                " coalesce(sum(last_tweeted_at IS NULL OR last_tweeted_at < ?), 0),"
+                " coalesce(sum(last_tweeted_at >= ?), 0)"
+                " FROM ephemeris WHERE month_day = ?",
+                (to_text(today_start), to_text(since), month_day_key(now)),
+            ).fetchone()
+        return TodayCounts(untweeted=untweeted, tweeted_since=tweeted_since)
+
+    def mark_as_tweeted(self, ephemeris_id: int) -> None:
+        self.mark_many_as_tweeted([ephemeris_id])
+
+    def mark_many_as_tweeted(self, ephemeris_ids: Sequence[int]) -> None:
+        now: str = to_text(self._now())
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE ephemeris SET last_tweeted_at = ? WHERE id = ?",
+                [(now, ephemeris_id) for ephemeris_id in ephemeris_ids],
+            )
+            self._connection.executemany(
+                "DELETE FROM retry_outbox WHERE ephemeris_id = ?",
+                [(ephemeris_id,) for ephemeris_id in ephemeris_ids],
+            )
+            self._connection.executemany(
+                "DELETE FROM delivery WHERE ephemeris_id = ?",
+                [(ephemeris_id,) for ephemeris_id in ephemeris_ids],
+            )
+
+    def schedule_retry(
+        self,
+        ephemeris_id: int,
+        attempts: int,
+        error_class: str,
+        error: str,
+        next_attempt_at: Optional[datetime.datetime],
+    ) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO retry_outbox"
+                " (ephemeris_id, attempts, error_class, last_error, next_attempt_at,"
+                " updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    ephemeris_id,
+                    attempts,
+                    error_class,
+                    error,
+                    to_text(next_attempt_at) if next_attempt_at else None,
+                    to_text(self._now()),
+                ),
+            )
+            if next_attempt_at is None:
+                self._connection.execute(
+                    "DELETE FROM delivery WHERE ephemeris_id = ?", (ephemeris_id,)
+                )
+
+    def claim_due_retries(
+        self, limit: int, lease: datetime.timedelta
+    ) -> List[RetryEntry]:
+        now: datetime.datetime = self._now()
+        with self._lock, self._connection:
+            # the write lock is taken before reading, so that processes sharing
+            # the database file claim their due rows in turn
+            self._connection.execute("BEGIN IMMEDIATE")
+            rows: List[tuple] = self._connection.execute(
+                f"SELECT {SELECT_COLUMNS}, retry_outbox.attempts FROM retry_outbox"
+                " JOIN ephemeris ON ephemeris.id = retry_outbox.ephemeris_id"
+                " WHERE retry_outbox.next_attempt_at <= ?"
+                " ORDER BY retry_outbox.next_attempt_at LIMIT ?",
+                (to_text(now), limit),
+            ).fetchall()
+            self._connection.executemany(
+                "UPDATE retry_outbox SET next_attempt_at = ? WHERE ephemeris_id = ?",
+                [(to_text(now + lease), row[0]) for row in rows],
+            )
+        return [
+            RetryEntry(ephemeris=self._to_ephemeris(row[:-1]), attempts=row[-1])
+            for row in rows
+        ]
+
+    def claim_ephemeris(
+        self, ephemeris_ids: Sequence[int], lease: datetime.timedelta
+    ) -> List[int]:
+        now: datetime.datetime = self._now()
+        claimed: List[int] = []
+        with self._lock, self._connection:
+            for ephemeris_id in ephemeris_ids:
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO retry_outbox"
+                    " (ephemeris_id, attempts, error_class, next_attempt_at,"
+                    " updated_at) VALUES (?, 0, '', ?, ?)",
+                    (ephemeris_id, to_text(now + lease), to_text(now)),
+                )
+                if cursor.rowcount:
+                    claimed.append(ephemeris_id)
+        return claimed
+
+    def mark_many_delivered(self, deliveries: Sequence[Tuple[int, str]]) -> None:
+        now: str = to_text(self._now())
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO delivery (ephemeris_id, target, delivered_at)"
+                " VALUES (?, ?, ?)",
+                [(ephemeris_id, target, now) for ephemeris_id, target in deliveries],
+            )
+
+    def get_deliveries(self, ephemeris_ids: Sequence[int]) -> Dict[int, Set[str]]:
+        deliveries: Dict[int, Set[str]] = {}
+        with self._lock:
+            for ephemeris_id in ephemeris_ids:
+                for (target,) in self._connection.execute(
+                    "SELECT target FROM delivery WHERE ephemeris_id = ?",
+                    (ephemeris_id,),
+                ):
+                    deliveries.setdefault(ephemeris_id, set()).add(target)
+        return deliveries
+
+    def record_posts(self, posts: Sequence[PostRecord]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO post_history"
+                " (ephemeris_id, target, post_id, posted_at, latency)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        post.ephemeris_id,
+                        post.target,
+                        post.post_id,
+                        to_text(post.posted_at),
+                        post.latency,
+                    )
+                    for post in posts
+                ],
+            )
+
+    def get_post_history(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        target: Optional[str] = None,
+    ) -> List[PostRecord]:
+        query: str = (
+            "SELECT ephemeris_id, target, post_id, posted_at, latency"
+            " FROM post_history WHERE posted_at >= ? AND posted_at < ?"
+        )
+        params: tuple = (to_text(start), to_text(end))
+        if target is not None:
+            query += " AND target = ?"
+            params += (target,)
+        with self._lock:
+            rows: List[tuple] = self._connection.execute(
+                query + " ORDER BY posted_at", params
+            ).fetchall()
+        return [
+            PostRecord(
+                ephemeris_id=ephemeris_id,
+                target=name,
+                post_id=post_id,
+                posted_at=datetime.datetime.fromisoformat(posted_at),
+                latency=latency,
+            )
+            for ephemeris_id, name, post_id, posted_at, latency in rows
+        ]
+
+    def count_ephemeris(self) -> int:
+        with self._lock:
+            row: tuple = self._connection.execute(
+                "SELECT count(*) FROM ephemeris"
+            ).fetchone()
+        return row[0]
+
+    def get_day_stats(self) -> List[DayStats]:
+        year_start: datetime.datetime = self._now().replace(
+            month=1, day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        with self._lock:
+            rows: List[tuple] = self._connection.execute(
+                "SELECT month_day, count(*),"
+                " sum(last_tweeted_at IS NULL OR last_tweeted_at < ?)"
+                " FROM ephemeris GROUP BY month_day ORDER BY month_day",
+                (to_text(year_start),),
+            ).fetchall()
+        return [
+            DayStats(
+                month=key // 100, day=key % 100, events=events, untweeted=untweeted
+            )
+            for key, events, untweeted in rows
+        ]
+
+    def insert_ephemeris(self, eph: Ephemeris) -> None:
+        self._copy([(eph.date, eph.text, eph.location)], eph.weight)
+
+    def copy_ephemeris(self, rows: Iterable[CopyRow]) -> int:
+        return self._copy(rows)
+
+    def _copy(self, rows: Iterable[CopyRow], weight: Optional[float] = None) -> int:
+        """Insert rows with the priority weight given, the column default if None."""
+        if weight is None:
+            weight = 1.0
+
+        def to_params(row: CopyRow) -> tuple:
+            date, text, location = row[:3]
+            date = to_datetime(date)
+            info: TemplateInfo = row_template(row)
+            return (
+                to_text(date),
+                month_day_key(date),
+                text,
+                location.latitude if location is not None else None,
+                location.longitude if location is not None else None,
+                " ".join(info.placeholders),
+                info.static_length,
+                weight,
+            )
+
+        with self._lock, self._connection:
+            cursor = self._connection.executemany(
+                "INSERT INTO ephemeris (date, month_day, text, latitude, longitude,"
+                " placeholders, static_length, weight)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                map(to_params, rows),
+            )
+            return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,343 @@
+"""Storage backend abstraction shared by the PostgreSQL, SQLite and memory backends"""
+
+import abc
+import datetime
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from zoneinfo import ZoneInfo
+
+from almanacbot.clock import Clock, utc_now
+from almanacbot.ephemeris import Ephemeris, Location
+from almanacbot.selection import Scoring
+from almanacbot.templates import TemplateInfo, analyze
+
+
+@dataclass
+class RetryEntry:
+    """Ephemeris whose post failed, due to be retried"""
+
+    ephemeris: Ephemeris
+    attempts: int
+
+
+@dataclass(frozen=True)
+class PostRecord:
+    """Post of an ephemeris to one publishing target, kept in the post history"""
+
+    ephemeris_id: int
+    target: str
+    posted_at: datetime.datetime
+    # seconds the target took to post
+    latency: float
+    # id of the post on the network, when the target reports it
+    post_id: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class DayStats:
+    """Ephemeris of one calendar day"""
+
+    month: int
+    day: int
+    events: int
+    # not tweeted since the first of January of the current year
+    untweeted: int
+
+
+@dataclass(frozen=True)
+class TodayCounts:
+    """Today's ephemeris, by tweet status"""
+
+    untweeted: int
+    # tweeted since the start of the period counted, e.g. a posting window
+    tweeted_since: int
+
+
+class InsertListener(abc.ABC):
+    """Notifications of the ephemeris inserted for today, by any process"""
+
+    @abc.abstractmethod
+    def wait(self, timeout: float) -> List[int]:
+        """
+        Wait up to timeout seconds for a notification, returning the ids of the
+        ephemeris inserted for today since the previous call, if any.
+        """
+
+    def close(self) -> None:
+        """Stop listening and release the resources of the listener."""
+
+
+# (date, text, location) row of a bulk insert, optionally followed by the
+# TemplateInfo of its text
+CopyRow = (
+    Tuple[datetime.datetime | str, str, Optional[Location]]
+    | Tuple[datetime.datetime | str, str, Optional[Location], TemplateInfo]
+)
+
+
+class EphemerisStorage(abc.ABC):
+    """Operations the bot and the data loader need from an ephemeris storage"""
+
+    @abc.abstractmethod
+    def get_today_ephemeris(self) -> List[Ephemeris]:
+        """Get all ephemeris entries for today using month+day matching."""
+
+    @abc.abstractmethod
+    def get_untweeted_today_ephemeris(self) -> List[Ephemeris]:
+        """Get ephemeris entries for today that haven't been tweeted yet today."""
+
+    @abc.abstractmethod
+    def get_top_untweeted_today_ephemeris(
+        self, limit: int, scoring: Scoring
+    ) -> List[Ephemeris]:
+        """
+        Get today's limit untweeted ephemeris of highest score, best first.
+
+        Only the ones selected are loaded: the day's candidates are read
+        through the calendar day index and ranked by the backend. Ephemeris in
+        the retry outbox are left to the retries.
+        """
+
+    @abc.abstractmethod
+    def count_today_ephemeris(self, since: datetime.datetime) -> TodayCounts:
+        """Count today's untweeted ephemeris, and the ones tweeted since since."""
+
+    @abc.abstractmethod
+    def mark_as_tweeted(self, ephemeris_id: int) -> None:
+        """Mark an ephemeris entry as tweeted with current UTC timestamp."""
+
+    def mark_many_as_tweeted(self, ephemeris_ids: Sequence[int]) -> None:
+        """Mark several ephemeris entries as tweeted, in a single update if possible."""
+        for ephemeris_id in ephemeris_ids:
+            self.mark_as_tweeted(ephemeris_id)
+
+    @abc.abstractmethod
+    def schedule_retry(
+        self,
+        ephemeris_id: int,
+        attempts: int,
+        error_class: str,
+        error: str,
+        next_attempt_at: Optional[datetime.datetime],
+    ) -> None:
+        """
+        Record a failed post in the retry outbox, replacing any previous entry.
+
+        A None next_attempt_at keeps the entry for inspection without retrying
+        it, and forgets the partial deliveries of the ephemeris. Marking the
+        ephemeris as tweeted removes its entry.
+        """
+
+    @abc.abstractmethod
+    def claim_due_retries(
+        self, limit: int, lease: datetime.timedelta
+    ) -> List[RetryEntry]:
+        """
+        Claim up to limit outbox entries whose next attempt is due, oldest first.
+
+        Their next attempt is atomically pushed lease ahead, so that concurrent
+        runs skip them until they are retried and marked as tweeted or
+        rescheduled, or until the lease expires, e.g. when a run crashed.
+        """
+
+    @abc.abstractmethod
+    def claim_ephemeris(
+        self, ephemeris_ids: Sequence[int], lease: datetime.timedelta
+    ) -> List[int]:
+        """
+        Claim the ephemeris a run is about to post, returning the ids claimed.
+
+        A claim is an outbox entry without attempts, due lease ahead: the ids
+        already in the outbox, e.g. claimed by a concurrent run, are left out,
+        and the retries post the ephemeris of a run that crashed before
+        marking them as tweeted or scheduling their retry.
+        """
+
+    @abc.abstractmethod
+    def mark_many_delivered(self, deliveries: Sequence[Tuple[int, str]]) -> None:
+        """
+        Record (ephemeris id, target name) pairs posted to a publishing target.
+
+        Partial deliveries are kept until the ephemeris reaches every target
+        and is marked as tweeted, so that retries skip the targets done.
+        """
+
+    @abc.abstractmethod
+    def get_deliveries(self, ephemeris_ids: Sequence[int]) -> Dict[int, Set[str]]:
+        """Get the targets each of the ephemeris has been partially delivered to."""
+
+    @abc.abstractmethod
+    def record_posts(self, posts: Sequence[PostRecord]) -> None:
+        """Append posts to the post history, which is never updated."""
+
+    @abc.abstractmethod
+    def get_post_history(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        target: Optional[str] = None,
+    ) -> List[PostRecord]:
+        """Get the posts made from start (included) to end, oldest first."""
+
+    @abc.abstractmethod
+    def count_ephemeris(self) -> int:
+        """Count all the stored ephemeris entries, as of the last statistics refresh."""
+
+    @abc.abstractmethod
+    def get_day_stats(self) -> List[DayStats]:
+        """
+        Count the ephemeris of every calendar day having any, in calendar order.
+
+        Backends precomputing the statistics return them as of their last
+        refresh_day_stats().
+        """
+
+    def refresh_day_stats(self) -> None:
+        """Bring precomputed day statistics up to date, e.g. after a load."""
+
+    @abc.abstractmethod
+    def insert_ephemeris(self, eph: Ephemeris) -> None:
+        """Insert a single ephemeris entry."""
+
+    @abc.abstractmethod
+    def copy_ephemeris(self, rows: Iterable[CopyRow]) -> int:
+        """
+        Bulk-insert (date, text, location) rows in a single transaction.
+
+        Rows may carry the TemplateInfo of their text as a fourth value, e.g.
+        rows validated by the data loader, which is then not analyzed again.
+        """
+
+    def listen_inserts(self) -> Optional[InsertListener]:
+        """
+        Start listening for the ephemeris inserted for today, or return None if
+        the backend cannot notify them.
+        """
+        return None
+
+    def close(self) -> None:
+        """Release the resources (connections, files) held by the storage."""
+
+
+def row_template(row: CopyRow) -> TemplateInfo:
+    """TemplateInfo of the text of a row, analyzed unless the row carries it."""
+    return row[3] if len(row) > 3 else analyze(row[1])
+
+
+def to_datetime(value: datetime.datetime | str) -> datetime.datetime:
+    """
+    Convert a loader date value into an aware datetime.
+
+    Besides ISO 8601, accepts the `YYYY-MM-DD HH:MM Area/City` form of the CSV
+    corpus. Naive values are taken as UTC, like the PostgreSQL session does.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            local_value, _, zone = value.rpartition(" ")
+            value = datetime.datetime.fromisoformat(local_value).replace(
+                tzinfo=ZoneInfo(zone)
+            )
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def get_channel(config: dict, name: Optional[str] = None) -> dict:
+    """Get a channel configuration by name, the first channel by default."""
+    for channel in config["channels"]:
+        if name is None or channel["name"] == name:
+            return channel
+    raise ValueError(f"Unknown channel: {name}")
+
+
+def create_storage(
+    config: dict,
+    channel: Optional[dict] = None,
+    engine=None,
+    now: Clock = utc_now,
+    replica=None,
+) -> EphemerisStorage:
+    """
+    Create the storage backend selected in the [storage] configuration.
+
+    A channel configuration overrides the table, schema and partitioning
+    (postgresql), the path (sqlite) or the corpus (memory) of the backend
+    section. PostgreSQL clients created with the same engine and replica
+    engine share their connection pools; the replica engine is created from
+    the [postgresql_replica] section if there is one. Today is the day of
+    the now clock.
+    """
+    backend: str = config["storage"]["backend"]
+    channel = channel or {}
+    if backend == "postgresql":
+        from almanacbot.postgresql_client import (
+            DEFAULT_MAX_REPLICA_LAG,
+            PostgreSQLClient,
+            connect_engine,
+        )
+
+        replica_conf: Optional[dict] = config.get("postgresql_replica")
+        if replica is None and replica_conf:
+            replica = connect_engine(
+                user=replica_conf["user"],
+                password=replica_conf["password"],
+                hostname=replica_conf["hostname"],
+                database=replica_conf["database"],
+                logging_echo=bool(config["postgresql"]["logging_echo"]),
+                prepare_threshold=config["postgresql"].get("prepare_threshold", 5),
+            )
+
+        return PostgreSQLClient(
+            user=config["postgresql"]["user"],
+            password=config["postgresql"]["password"],
+            hostname=config["postgresql"]["hostname"],
+            database=config["postgresql"]["database"],
+            ephemeris_table=channel.get(
+                "ephemeris_table", config["postgresql"]["ephemeris_table"]
+            ),
+            logging_echo=bool(config["postgresql"]["logging_echo"]),
+            schema=channel.get("schema", config["postgresql"].get("schema")),
+            engine=engine,
+            now=now,
+            prepare_threshold=config["postgresql"].get("prepare_threshold", 5),
+            partitioned=channel.get(
+                "partitioned", config["postgresql"].get("partitioned", False)
+            ),
+            replica=replica,
+            max_replica_lag=(
+                replica_conf["max_lag"] if replica_conf else DEFAULT_MAX_REPLICA_LAG
+            ),
+        )
+    if backend == "sqlite":
+        from almanacbot.sqlite_client import SQLiteClient
+
+        return SQLiteClient(path=channel.get("path", config["sqlite"]["path"]), now=now)
+    if backend == "memory":
+        from almanacbot.memory_storage import MemoryStorage
+
+        return MemoryStorage.from_files(
+            channel.get("corpus", config["memory"]["corpus"]), now=now
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def create_channel_storages(
+    config: dict, now: Clock = utc_now
+) -> Dict[str, EphemerisStorage]:
+    """
+    Create the storage of every channel, sharing one PostgreSQL engine and
+    one replica engine.
+    """
+    storages: Dict[str, EphemerisStorage] = {}
+    engine = None
+    replica = None
+    for channel in config["channels"]:
+        storage: EphemerisStorage = create_storage(
+            config, channel, engine, now, replica
+        )
+        engine = getattr(storage, "engine", None)
+        replica = getattr(storage, "replica", None)
+        storages[channel["name"]] = storage
+    return storages
@@ -0,0 +1,119 @@
+"""Validation and metadata of ephemeris text templates"""
+
+import datetime
+import functools
+import re
+import string
+import unicodedata
+from dataclasses import dataclass
+from typing import Iterable, Tuple
+
+from babel import Locale
+from babel.dates import format_date
+
+# Placeholders substituted when an ephemeris is rendered.
+PLACEHOLDERS: Tuple[str, ...] = ("date", "years_ago")
+MAX_TWEET_LENGTH: int = 280
+# Every URL counts as a t.co link of this length.
+URL_LENGTH: int = 23
+# Code points weighing 1 in tweet lengths, any other weighs 2 (twitter-text v3).
+_LIGHT_RANGES: Tuple[Tuple[int, int], ...] = (
+    (0, 4351),
+    (8192, 8205),
+    (8208, 8223),
+    (8242, 8247),
+)
+_URL = re.compile(r"https?://\S+")
+# years_ago is at most MAXYEAR - MINYEAR
+_YEARS_AGO_LENGTH: int = len(str(datetime.MAXYEAR - datetime.MINYEAR))
+
+
+class TemplateError(ValueError):
+    """Ephemeris text that cannot be rendered"""
+
+
+@dataclass(frozen=True)
+class TemplateInfo:
+    """
+    Metadata of an ephemeris text, precomputed at ingest.
+
+    placeholders are the placeholders used, in order of appearance, and
+    static_length is the weighted length of the text without them.
+    """
+
+    placeholders: Tuple[str, ...]
+    static_length: int
+
+    def max_length(self, locales: Iterable[Locale]) -> int:
+        """Worst-case weighted length of the text rendered in any of locales."""
+        widths = {
+            "date": max(map(date_max_length, locales), default=0),
+            "years_ago": _YEARS_AGO_LENGTH,
+        }
+        return self.static_length + sum(widths[name] for name in self.placeholders)
+
+
+def weighted_length(text: str) -> int:
+    """Length of text as counted by Twitter: URLs are 23, most CJK and emoji 2."""
+    text = unicodedata.normalize("NFC", text)
+    length: int = 0
+    position: int = 0
+    for url in _URL.finditer(text):
+        length += _characters_length(text[position : url.start()]) + URL_LENGTH
+        position = url.end()
+    return length + _characters_length(text[position:])
+
+
+def _characters_length(text: str) -> int:
+    return sum(
+        1 if any(start <= ord(char) <= end for start, end in _LIGHT_RANGES) else 2
+        for char in text
+    )
+
+
+@functools.cache
+def date_max_length(locale: Locale) -> int:
+    """Weighted length of the longest full date in locale."""
+    # every month of a leap year starts on each weekday at least once
+    first: datetime.date = datetime.date(2024, 1, 1)
+    return max(
+        weighted_length(
+            format_date(
+                date=first + datetime.timedelta(days=day), format="full", locale=locale
+            )
+        )
+        for day in range(366)
+    )
+
+
+def analyze(text: str) -> TemplateInfo:
+    """
+    Parse an ephemeris text, checking its placeholders.
+
+    Raises:
+        TemplateError: on a malformed `$` or a placeholder other than
+            ${date} and ${years_ago}.
+    """
+    placeholders: list = []
+    static: list = []
+    position: int = 0
+    for match in string.Template.pattern.finditer(text):
+        static.append(text[position : match.start()])
+        position = match.end()
+        if match.group("escaped") is not None:
+            static.append("$")
+            continue
+        name: str = match.group("named") or match.group("braced")
+        if name is None:
+            raise TemplateError(
+                f"Malformed placeholder at position {match.start()}: "
+                f"{text[match.start() : match.start() + 10]!r}"
+            )
+        if name not in PLACEHOLDERS:
+            raise TemplateError(f"Unknown placeholder: ${{{name}}}")
+        placeholders.append(name)
+    static.append(text[position:])
+    return TemplateInfo(
+        placeholders=tuple(placeholders),
+        static_length=weighted_length("".join(static)),
+    )
@@ -0,0 +1,314 @@
+"""Spans timing the stages of a run, exported as OTLP/JSON to a file or collector"""
+
+import abc
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, TypeVar
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable)
+
+SERVICE_NAME: str = "almanac-bot"
+# Finished spans kept in memory before they are exported.
+DEFAULT_BATCH_SIZE: int = 512
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "span", default=None
+)
+
+
+@dataclass
+class Span:
+    """Timed operation of a trace, nested in the span current when it started"""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    # nanoseconds since the epoch
+    start: int
+    end: int = 0
+    attributes: Dict[str, object] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, key: str, value: object) -> None:
+        """Tag the span, e.g. with a result only known within it."""
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        """The span in the OTLP/JSON encoding."""
+        otlp: dict = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            otlp["parentSpanId"] = self.parent_id
+        return otlp
+
+
+def _otlp_value(value: object) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return {"arrayValue": {"values": [_otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def export_request(spans: Sequence[Span]) -> dict:
+    """OTLP ExportTraceServiceRequest, in its JSON encoding, of spans."""
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class SpanExporter(abc.ABC):
+    """Destination of finished spans"""
+
+    @abc.abstractmethod
+    def export(self, spans: Sequence[Span]) -> None:
+        """Send a batch of spans, raising on failure."""
+
+    def close(self) -> None:
+        """Release the resources of the exporter."""
+
+
+class FileExporter(SpanExporter):
+    """
+    Appends each batch as a line of OTLP/JSON, the format read by the
+    OpenTelemetry Collector's otlpjsonfile receiver.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+
+    def export(self, spans: Sequence[Span]) -> None:
+        with open(self.path, "a", encoding="UTF-8") as traces:
+            traces.write(json.dumps(export_request(spans), ensure_ascii=False))
+            traces.write("\n")
+
+
+class OtlpHttpExporter(SpanExporter):
+    """Posts each batch to the OTLP/HTTP endpoint of a collector, e.g. Jaeger"""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.endpoint: str = endpoint
+        self.timeout: float = timeout
+        self._session: requests.Session = requests.Session()
+
+    def export(self, spans: Sequence[Span]) -> None:
+        response = self._session.post(
+            self.endpoint, json=export_request(spans), timeout=self.timeout
+        )
+        response.raise_for_status()
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class Tracer:
+    """
+    Creates spans and exports them in batches of batch_size, and on flush.
+
+    Spans nest through a context variable, so threads started with a copy of
+    the context, like the publisher's, continue the trace of their caller.
+    """
+
+    def __init__(self, exporter: SpanExporter, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.exporter: SpanExporter = exporter
+        self.batch_size: int = batch_size
+        self._finished: List[Span] = []
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def start(self, name: str, attributes: Dict[str, object]) -> Span:
+        parent: Optional[Span] = _current.get()
+        return Span(
+            name=name,
+            trace_id=(
+                parent.trace_id if parent else f"{self._random.getrandbits(128):032x}"
+            ),
+            span_id=f"{self._random.getrandbits(64):016x}",
+            parent_id=parent.span_id if parent else None,
+            start=time.time_ns(),
+            attributes=attributes,
+        )
+
+    def finish(self, span: Span) -> None:
+        span.end = time.time_ns()
+        with self._lock:
+            self._finished.append(span)
+            full: bool = len(self._finished) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Export the finished spans; export errors are logged, not raised."""
+        with self._lock:
+            spans, self._finished = self._finished, []
+        if not spans:
+            return
+        try:
+            self.exporter.export(spans)
+        except Exception:
+            logger.exception("Failed to export %d spans.", len(spans))
+
+    def close(self) -> None:
+        self.flush()
+        self.exporter.close()
+
+
+class _ActiveSpan:
+    """Context manager making a new span current within its block"""
+
+    __slots__ = ("_tracer", "_span", "_token")
+
+    def __init__(self, tracer: Tracer, name: str, attributes: Dict[str, object]):
+        self._tracer: Tracer = tracer
+        self._span: Span = tracer.start(name, attributes)
+
+    def __enter__(self) -> Span:
+        self._token: contextvars.Token = _current.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        _current.reset(self._token)
+        if exc is not None:
+            self._span.error = f"{exc_type.__name__}: {exc}"
+        self._tracer.finish(self._span)
+        return False
+
+
+class _NoSpan:
+    """Span of disabled tracing, doing nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+    def set(self, key: str, value: object) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+_tracer: Optional[Tracer] = None
+
+
+def configure(
+    destination: Optional[str], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Optional[Tracer]:
+    """
+    Export spans to destination, an http(s) URL of an OTLP/HTTP traces
+    endpoint or the path of an OTLP/JSON lines file. Tracing is disabled
+    when it is empty, making spans no-ops. Spans left are flushed at exit.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        atexit.unregister(_tracer.close)
+        _tracer = None
+    if not destination:
+        return None
+    exporter: SpanExporter = (
+        OtlpHttpExporter(destination)
+        if destination.startswith(("http://", "https://"))
+        else FileExporter(destination)
+    )
+    _tracer = Tracer(exporter, batch_size)
+    atexit.register(_tracer.close)
+    logger.info("Exporting traces to %s.", destination)
+    return _tracer
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attributes: object) -> _ActiveSpan | _NoSpan:
+    """
+    Context manager timing its block as a span, child of the current one.
+
+    With tracing disabled it is a shared no-op object, so that instrumented
+    code pays one function call.
+    """
+    if _tracer is None:
+        return _NO_SPAN
+    return _ActiveSpan(_tracer, name, attributes)
+
+
+def traced(name: str, **arguments: str) -> Callable[[F], F]:
+    """
+    Decorator timing each call of a function as a span.
+
+    Args:
+        name: name of the spans.
+        arguments: span attributes taken from the arguments of each call,
+            e.g. ephemeris_id="eph_id" tags spans with the eph_id argument.
+    """
+
+    def decorate(function: F) -> F:
+        signature: inspect.Signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            attributes: Dict[str, object] = {}
+            if arguments:
+                bound = signature.bind(*args, **kwargs)
+                for attribute, argument in arguments.items():
+                    if bound.arguments.get(argument) is not None:
+                        attributes[attribute] = bound.arguments[argument]
+            with _ActiveSpan(_tracer, name, attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def flush() -> None:
+    """Export the spans finished so far, e.g. at the end of a run."""
+    if _tracer is not None:
+        _tracer.flush()
@@ -1,20 +1,26 @@
 import datetime
+import io
 import logging
-import string
+from typing import Optional, Sequence
 # from typing import List
 
 from babel import Locale
-from babel.dates import format_date
 import tweepy
 
+from almanacbot.clock import Clock, utc_now
 from almanacbot.ephemeris import Ephemeris
+from almanacbot.publisher import PublishTarget, render_text
+from almanacbot.templates import MAX_TWEET_LENGTH
 
 logger = logging.getLogger(__name__)
 
 
-class TwitterClient:
+class TwitterClient(PublishTarget):
     """Class serving as Twitter API client"""
 
+    # media uploaded are attachable for 24 hours, an hour is kept in reserve
+    media_ttl: Optional[datetime.timedelta] = datetime.timedelta(hours=23)
+
     def __init__(
         self,
         bearer_token: str,
@@ -23,8 +29,15 @@ class TwitterClient:
         access_token_key: str,
         access_token_secret: str,
         locale: Locale,
+        name: str = "twitter",
+        min_interval: float = 0.0,
+        bundle: str = "none",
+        max_length: int = MAX_TWEET_LENGTH,
+        maps: bool = True,
+        now: Clock = utc_now,
     ):
-        self.locale = locale
+        super().__init__(name, locale, min_interval, bundle, max_length, maps)
+        self._now: Clock = now
 
         # Twitter API v2 client
         self._client_v2: tweepy.Client = tweepy.Client(
@@ -35,8 +48,12 @@ class TwitterClient:
             access_token_secret=access_token_secret,
         )
 
-        # Twitter API v1 client
-        # self._client_v1: tweepy.API = tweepy.API(tweepy.OAuth2BearerHandler(bearer_token))
+        # Twitter API v1.1 client, media are only uploaded through it
+        self._client_v1: tweepy.API = tweepy.API(
+            tweepy.OAuth1UserHandler(
+                consumer_key, consumer_secret, access_token_key, access_token_secret
+            )
+        )
 
     def tweet_ephemeris(self, eph: Ephemeris) -> None:
         # tplace: tweepy.Place = None
@@ -58,21 +75,40 @@ class TwitterClient:
         # )
 
         # post tweet without place ID (geolocation)
-        logger.info(f"Tweeting ephemeris: {eph}")
-        self._client_v2.create_tweet(
-            text=TwitterClient._process_tweet_text(eph, self.locale),
+        logger.info("Tweeting ephemeris id=%s", eph.id)
+        self.post(
+            TwitterClient._process_tweet_text(eph, self.locale, self._now().date()),
+            key="",
         )
 
-    @staticmethod
-    def _process_tweet_text(eph: Ephemeris, locale: Locale) -> str:
-        today = datetime.datetime.now(datetime.timezone.utc)
-        template = string.Template(eph.text)
+    def post(
+        self,
+        text: str,
+        key: str,
+        reply_to: Optional[str] = None,
+        media_ids: Sequence[str] = (),
+    ) -> Optional[str]:
+        # the API has no idempotency key, duplicate content is rejected instead
+        response: tweepy.Response = self._client_v2.create_tweet(
+            text=text, in_reply_to_tweet_id=reply_to, media_ids=list(media_ids) or None
+        )
+        return response.data["id"]
+
+    def upload_media(self, image: bytes, mime_type: str, description: str) -> str:
+        media = self._client_v1.media_upload(filename="map.png", file=io.BytesIO(image))
+        self._client_v1.create_media_metadata(media.media_id_string, description)
+        return media.media_id_string
 
-        values = {
-            "date": format_date(date=eph.date.date(), format="full", locale=locale),
-            "years_ago": today.year - eph.date.year,
-        }
+    def rejects_media(self, exc: Exception) -> bool:
+        # e.g. "Your media IDs are invalid." once they expired
+        return isinstance(exc, tweepy.BadRequest)
+
+    @staticmethod
+    def _process_tweet_text(
+        eph: Ephemeris, locale: Locale, today: datetime.date
+    ) -> str:
+        text: str = render_text(eph, locale, today)
 
-        logger.debug(f"Processed ephemeris text: {template.substitute(values)}")
+        logger.debug("Processed ephemeris text: %s", text)
 
-        return template.substitute(values)
+        return text
@@ -0,0 +1,156 @@
+"""Latency of today's queries on a plain and on a month-partitioned table.
+
+Run with: uv run python benchmarks/partition_latency.py --rows 1000000
+
+Runs against the database used by the integration tests (POSTGRES_*
+environment variables), in a scratch `almanac_bench` schema dropped at the
+end. Both tables get the same corpus; every query is then run for days spread
+over the year, so that the partitioned table is pruned to a different
+partition each time.
+"""
+
+import datetime
+import os
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import typer
+from psycopg import sql
+
+from almanacbot.partitioning import create_partitioned_table
+from almanacbot.postgresql_client import PostgreSQLClient
+
+SCHEMA: str = "almanac_bench"
+
+
+def corpus(rows: int) -> List[tuple]:
+    """Random events spread over every calendar day."""
+    start = datetime.datetime(1800, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    return [
+        (
+            start + datetime.timedelta(days=random.randrange(365 * 220)),
+            f"Event {i}, ${{years_ago}} years ago.",
+            None,
+        )
+        for i in range(rows)
+    ]
+
+
+def client(table: str, partitioned: bool, clock: List[datetime.datetime]):
+    return PostgreSQLClient(
+        user=os.environ.get("POSTGRES_USER", "almanac"),
+        password=os.environ.get("POSTGRES_PASSWORD", "almanac"),
+        hostname=os.environ.get("POSTGRES_HOST", "localhost"),
+        database=os.environ.get("POSTGRES_DB", "almanac"),
+        ephemeris_table=table,
+        logging_echo=False,
+        schema=SCHEMA,
+        now=lambda: clock[0],
+        partitioned=partitioned,
+    )
+
+
+def execute(storage: PostgreSQLClient, *statements: sql.Composable) -> None:
+    connection = storage.engine.raw_connection()
+    try:
+        with connection.driver_connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def create_tables(storage: PostgreSQLClient) -> None:
+    flat = sql.Identifier(SCHEMA, "flat")
+    execute(
+        storage,
+        sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(SCHEMA)),
+        sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(SCHEMA)),
+        sql.SQL(
+            "CREATE TABLE {} (id serial primary key, "
+            "date timestamp with time zone not null, text text not null, "
+            "location point default null, "
+            "last_tweeted_at timestamp with time zone default null, "
+            "placeholders text default null, static_length integer default null, "
+            "weight double precision not null default 1)"
+        ).format(flat),
+        sql.SQL(
+            "CREATE INDEX ON {} (EXTRACT(MONTH FROM date), EXTRACT(DAY FROM date))"
+        ).format(flat),
+    )
+    connection = storage.engine.raw_connection()
+    try:
+        with connection.driver_connection.cursor() as cursor:
+            create_partitioned_table(cursor, SCHEMA, "partitioned")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def benchmark(
+    name: str,
+    storage: PostgreSQLClient,
+    clock: List[datetime.datetime],
+    days: int,
+    calls: int,
+) -> None:
+    queries: Dict[str, Callable[[], object]] = {
+        "today": storage.get_today_ephemeris,
+        "untweeted": storage.get_untweeted_today_ephemeris,
+    }
+    first_day = datetime.datetime(2024, 1, 1, 8, tzinfo=datetime.timezone.utc)
+    for query, call in queries.items():
+        latencies: List[float] = []
+        for day in range(days):
+            clock[0] = first_day + datetime.timedelta(days=day * 366 // days)
+            for _ in range(calls):
+                started = time.perf_counter()
+                call()
+                latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        print(
+            f"{name:>12} {query:>10}: "
+            f"median {statistics.median(latencies) * 1000:7.3f} ms, "
+            f"p99 {latencies[int(0.99 * (len(latencies) - 1))] * 1000:7.3f} ms"
+        )
+
+
+def main(
+    rows: int = typer.Option(1_000_000, help="Corpus size"),
+    days: int = typer.Option(12, help="Days of the year queried"),
+    calls: int = typer.Option(100, help="Calls per query and day"),
+):
+    clock: List[datetime.datetime] = [datetime.datetime.now(datetime.timezone.utc)]
+    storages: Dict[str, PostgreSQLClient] = {
+        "plain": client("flat", False, clock),
+        "partitioned": client("partitioned", True, clock),
+    }
+    create_tables(storages["plain"])
+    events: List[tuple] = corpus(rows)
+    for name, storage in storages.items():
+        started = time.perf_counter()
+        storage.copy_ephemeris(events)
+        execute(
+            storage,
+            sql.SQL("ANALYZE {}").format(
+                sql.Identifier(SCHEMA, storage.ephemeris_table)
+            ),
+        )
+        print(f"{name:>12} loaded in {time.perf_counter() - started:.1f}s")
+
+    for name, storage in storages.items():
+        benchmark(name, storage, clock, days, calls)
+
+    execute(
+        storages["plain"],
+        sql.SQL("DROP SCHEMA {} CASCADE").format(sql.Identifier(SCHEMA)),
+    )
+    for storage in storages.values():
+        storage.close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
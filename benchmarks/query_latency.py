@@ -0,0 +1,92 @@
+"""Per-call latency of the hot PostgreSQL queries in a long-lived process.
+
+Run with: uv run python benchmarks/query_latency.py --rows 100000
+
+Runs against the database used by the integration tests (POSTGRES_*
+environment variables), whose ephemeris table is emptied first. Every query
+is called many times on one engine, as in a bot serving several channels,
+with and without server-side prepared statements.
+"""
+
+import datetime
+import os
+import random
+import statistics
+import time
+from typing import Callable, Dict, List, Optional
+
+import typer
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from almanacbot.postgresql_client import PostgreSQLClient
+
+
+def corpus(rows: int) -> List[tuple]:
+    """Random events spread over every calendar day."""
+    start = datetime.datetime(1800, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    return [
+        (
+            start + datetime.timedelta(days=random.randrange(365 * 220)),
+            f"Event {i}, ${{years_ago}} years ago.",
+            None,
+        )
+        for i in range(rows)
+    ]
+
+
+def client(prepare_threshold: Optional[int]) -> PostgreSQLClient:
+    return PostgreSQLClient(
+        user=os.environ.get("POSTGRES_USER", "almanac"),
+        password=os.environ.get("POSTGRES_PASSWORD", "almanac"),
+        hostname=os.environ.get("POSTGRES_HOST", "localhost"),
+        database=os.environ.get("POSTGRES_DB", "almanac"),
+        ephemeris_table="ephemeris",
+        logging_echo=False,
+        prepare_threshold=prepare_threshold,
+    )
+
+
+def benchmark(name: str, storage: PostgreSQLClient, calls: int) -> None:
+    ids: List[int] = [eph.id for eph in storage.get_today_ephemeris()]
+    queries: Dict[str, Callable[[], object]] = {
+        "today": storage.get_today_ephemeris,
+        "untweeted": storage.get_untweeted_today_ephemeris,
+        "retries": lambda: storage.claim_due_retries(50, datetime.timedelta(0)),
+        "deliveries": lambda: storage.get_deliveries(ids),
+    }
+    for query, call in queries.items():
+        latencies: List[float] = []
+        for _ in range(calls):
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+        first: float = latencies[0]
+        latencies.sort()
+        print(
+            f"{name:>12} {query:>10}: "
+            f"first {first * 1000:7.3f} ms | "
+            f"median {statistics.median(latencies) * 1000:7.3f} ms, "
+            f"p99 {latencies[int(0.99 * (calls - 1))] * 1000:7.3f} ms"
+        )
+
+
+def main(
+    rows: int = typer.Option(100_000, help="Corpus size"),
+    calls: int = typer.Option(1_000, help="Calls per query"),
+):
+    loader = client(prepare_threshold=None)
+    with Session(loader.engine) as session:
+        session.execute(text("DELETE FROM almanac.ephemeris"))
+        session.commit()
+    loader.copy_ephemeris(corpus(rows))
+    loader.close()
+
+    for name, prepare_threshold in (("unprepared", None), ("prepared", 0)):
+        storage = client(prepare_threshold)
+        benchmark(name, storage, calls)
+        storage.close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,121 @@
+"""Latency of the selection of a capped day's best ephemeris.
+
+Run with: uv run python benchmarks/selection_latency.py --candidates 5000
+
+Compares loading every untweeted ephemeris of a crowded day and ranking them
+in Python with the storage ranking them itself, for the memory and SQLite
+backends, and PostgreSQL with --postgresql, against the database used by the
+integration tests (POSTGRES_* environment variables). Its ephemeris table is
+emptied first.
+"""
+
+import calendar
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Callable, List
+
+import typer
+
+from almanacbot.selection import Scoring, top
+from almanacbot.storage import EphemerisStorage
+
+
+def crowded_day(candidates: int, rows: int) -> List[tuple]:
+    """candidates events of today, among rows random events of the year."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    years = [
+        year
+        for year in range(1800, now.year)
+        if (now.month, now.day) != (2, 29) or calendar.isleap(year)
+    ]
+    return [
+        (
+            now.replace(year=random.choice(years), hour=12),
+            f"Event {i}, ${{years_ago}} years ago.",
+            None,
+        )
+        for i in range(candidates)
+    ] + [
+        (
+            datetime.datetime(1800, 1, 1, 12, tzinfo=datetime.timezone.utc)
+            + datetime.timedelta(days=random.randrange(365 * 220)),
+            f"Event {i}.",
+            None,
+        )
+        for i in range(rows)
+    ]
+
+
+def median_ms(select: Callable[[], list], runs: int) -> float:
+    latencies: List[float] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        select()
+        latencies.append(time.perf_counter() - started)
+    return statistics.median(latencies) * 1000
+
+
+def benchmark(name: str, storage: EphemerisStorage, limit: int, runs: int) -> None:
+    scoring = Scoring()
+    today = datetime.date.today()
+    load_all = median_ms(
+        lambda: top(storage.get_untweeted_today_ephemeris(), limit, scoring, today),
+        runs,
+    )
+    ranked = median_ms(
+        lambda: storage.get_top_untweeted_today_ephemeris(limit, scoring), runs
+    )
+    print(
+        f"{name:>10}: load and rank {load_all:8.2f} ms | "
+        f"ranked by the storage {ranked:8.2f} ms"
+    )
+
+
+def main(
+    candidates: int = typer.Option(5_000, help="Ephemeris of today"),
+    rows: int = typer.Option(100_000, help="Ephemeris of the other days"),
+    limit: int = typer.Option(20, help="Ephemeris selected"),
+    runs: int = typer.Option(20, help="Runs per backend"),
+    postgresql: bool = typer.Option(False, help="Benchmark PostgreSQL too"),
+):
+    rows_data = crowded_day(candidates, rows)
+
+    from almanacbot.memory_storage import MemoryStorage
+    from almanacbot.sqlite_client import SQLiteClient
+
+    benchmark("memory", MemoryStorage(rows_data), limit, runs)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = SQLiteClient(os.path.join(tmp_dir, "almanac.db"))
+        client.copy_ephemeris(rows_data)
+        benchmark("sqlite", client, limit, runs)
+        client.close()
+
+    if postgresql:
+        from sqlalchemy import text
+        from sqlalchemy.orm import Session
+
+        from almanacbot.postgresql_client import PostgreSQLClient
+
+        client = PostgreSQLClient(
+            user=os.environ.get("POSTGRES_USER", "almanac"),
+            password=os.environ.get("POSTGRES_PASSWORD", "almanac"),
+            hostname=os.environ.get("POSTGRES_HOST", "localhost"),
+            database=os.environ.get("POSTGRES_DB", "almanac"),
+            ephemeris_table="ephemeris",
+            logging_echo=False,
+        )
+        with Session(client.engine) as session:
+            session.execute(text("DELETE FROM almanac.ephemeris"))
+            session.commit()
+        client.copy_ephemeris(rows_data)
+        benchmark("postgresql", client, limit, runs)
+        client.close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,99 @@
+"""Startup and per-run latency of the storage backends.
+
+Run with: uv run python benchmarks/storage_latency.py --rows 100000
+
+The PostgreSQL backend is benchmarked too with --postgresql, against the
+database used by the integration tests (POSTGRES_* environment variables).
+Its ephemeris table is emptied first.
+"""
+
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Callable, List
+
+import typer
+
+from almanacbot.storage import EphemerisStorage
+
+
+def corpus(rows: int) -> List[tuple]:
+    """Random events spread over every calendar day."""
+    start = datetime.datetime(1800, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    return [
+        (
+            start + datetime.timedelta(days=random.randrange(365 * 220)),
+            f"Event {i}, ${{years_ago}} years ago.",
+            None,
+        )
+        for i in range(rows)
+    ]
+
+
+def benchmark(name: str, factory: Callable[[], EphemerisStorage], runs: int) -> None:
+    started = time.perf_counter()
+    storage = factory()
+    storage.count_ephemeris()
+    startup = time.perf_counter() - started
+
+    latencies: List[float] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for eph in storage.get_untweeted_today_ephemeris():
+            storage.mark_as_tweeted(eph.id)
+        latencies.append(time.perf_counter() - started)
+    storage.close()
+
+    print(
+        f"{name:>10}: startup {startup * 1000:8.2f} ms | "
+        f"run median {statistics.median(latencies) * 1000:8.2f} ms, "
+        f"max {max(latencies) * 1000:8.2f} ms"
+    )
+
+
+def main(
+    rows: int = typer.Option(100_000, help="Corpus size"),
+    runs: int = typer.Option(20, help="Runs per backend"),
+    postgresql: bool = typer.Option(False, help="Benchmark PostgreSQL too"),
+):
+    rows_data = corpus(rows)
+
+    from almanacbot.sqlite_client import SQLiteClient
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "almanac.db")
+        loader = SQLiteClient(path)
+        loader.copy_ephemeris(rows_data)
+        loader.close()
+        benchmark("sqlite", lambda: SQLiteClient(path), runs)
+
+    if postgresql:
+        from sqlalchemy import text
+        from sqlalchemy.orm import Session
+
+        from almanacbot.postgresql_client import PostgreSQLClient
+
+        def factory() -> PostgreSQLClient:
+            return PostgreSQLClient(
+                user=os.environ.get("POSTGRES_USER", "almanac"),
+                password=os.environ.get("POSTGRES_PASSWORD", "almanac"),
+                hostname=os.environ.get("POSTGRES_HOST", "localhost"),
+                database=os.environ.get("POSTGRES_DB", "almanac"),
+                ephemeris_table="ephemeris",
+                logging_echo=False,
+            )
+
+        loader = factory()
+        with Session(loader.engine) as session:
+            session.execute(text("DELETE FROM almanac.ephemeris"))
+            session.commit()
+        loader.copy_ephemeris(rows_data)
+        loader.close()
+        benchmark("postgresql", factory, runs)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,18 +1,129 @@
 #!/usr/bin/env bash
 set -e
 
-psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
-    -- create schema and ephemeris table
-    CREATE SCHEMA almanac;
+# ALMANAC_PARTITIONED=true creates the ephemeris table list-partitioned by the
+# UTC month of date, for corpora of tens of millions of events
+if [ "${ALMANAC_PARTITIONED:-false}" = "true" ]; then
+    EPHEMERIS_TABLE="
+    CREATE TABLE almanac.ephemeris (
+        id serial,
+        date timestamp with time zone not null,
+        month smallint not null,
+        text text not null,
+        location point default null,
+        last_tweeted_at timestamp with time zone default null,
+        placeholders text default null,
+        static_length integer default null,
+        weight double precision not null default 1,
+        primary key (id, month)
+     ) PARTITION BY LIST (month);
+    $(for month in 01 02 03 04 05 06 07 08 09 10 11 12; do
+        echo "CREATE TABLE almanac.ephemeris_$month PARTITION OF almanac.ephemeris FOR VALUES IN ($((10#$month)));"
+    done)"
+else
+    EPHEMERIS_TABLE="
     CREATE TABLE almanac.ephemeris (
         id serial primary key,
         date timestamp with time zone not null,
         text text not null,
         location point default null,
-        last_tweeted_at timestamp with time zone default null
-     );
+        last_tweeted_at timestamp with time zone default null,
+        placeholders text default null,
+        static_length integer default null,
+        weight double precision not null default 1
+     );"
+fi
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+    -- create schema and ephemeris table
+    CREATE SCHEMA almanac;
+    $EPHEMERIS_TABLE
 
     -- create index for efficient month+day queries
     CREATE INDEX idx_ephemeris_month_day
     ON almanac.ephemeris (EXTRACT(MONTH FROM date), EXTRACT(DAY FROM date));
+
+    -- trigram index on text, to find near-duplicates of the events loaded
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX idx_ephemeris_text_trgm
+    ON almanac.ephemeris USING gin (text gin_trgm_ops);
+
+    -- notify the ids of the rows inserted for today in UTC, as the bot reads
+    -- them, once per statement so that bulk loads send a handful of
+    -- notifications instead of one per row
+    CREATE FUNCTION almanac.notify_today_inserts() RETURNS trigger
+    LANGUAGE plpgsql AS \$\$
+    DECLARE
+        ids text;
+    BEGIN
+        FOR ids IN
+            SELECT string_agg(id::text, ',')
+            FROM (
+                SELECT id, (row_number() OVER (ORDER BY id) - 1) / 500 AS chunk
+                FROM inserted
+                WHERE EXTRACT(MONTH FROM date AT TIME ZONE 'UTC')
+                      = EXTRACT(MONTH FROM now() AT TIME ZONE 'UTC')
+                  AND EXTRACT(DAY FROM date AT TIME ZONE 'UTC')
+                      = EXTRACT(DAY FROM now() AT TIME ZONE 'UTC')
+            ) AS today
+            GROUP BY chunk
+        LOOP
+            PERFORM pg_notify(TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME, ids);
+        END LOOP;
+        RETURN NULL;
+    END
+    \$\$;
+
+    CREATE TRIGGER ephemeris_notify_today_inserts
+    AFTER INSERT ON almanac.ephemeris
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION almanac.notify_today_inserts();
+
+    -- create retry outbox of failed posts
+    CREATE TABLE almanac.retry_outbox (
+        ephemeris_id integer primary key,
+        attempts integer not null,
+        error_class text not null,
+        last_error text default null,
+        next_attempt_at timestamp with time zone default null,
+        updated_at timestamp with time zone not null default now()
+     );
+
+    -- create partial index so that retry passes only read due rows
+    CREATE INDEX idx_retry_outbox_next_attempt_at
+    ON almanac.retry_outbox (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+
+    -- create partial deliveries of ephemeris posted to several targets
+    CREATE TABLE almanac.delivery (
+        ephemeris_id integer not null,
+        target text not null,
+        delivered_at timestamp with time zone not null default now(),
+        primary key (ephemeris_id, target)
+     );
+
+    -- create append-only history of the posts
+    CREATE TABLE almanac.post_history (
+        ephemeris_id integer not null,
+        target text not null,
+        post_id text default null,
+        posted_at timestamp with time zone not null,
+        latency double precision not null
+     );
+
+    -- create BRIN index for time range scans, rows being appended in time order
+    CREATE INDEX idx_post_history_posted_at
+    ON almanac.post_history USING brin (posted_at);
+
+    -- create calendar day statistics, refreshed by the data loader
+    CREATE MATERIALIZED VIEW almanac.ephemeris_day_stats AS
+    SELECT EXTRACT(MONTH FROM date)::integer AS month,
+           EXTRACT(DAY FROM date)::integer AS day,
+           COALESCE(EXTRACT(YEAR FROM last_tweeted_at)::integer, 0) AS tweeted_year,
+           count(*) AS events
+    FROM almanac.ephemeris
+    GROUP BY 1, 2, 3;
+
+    -- create unique index so that the view can be refreshed concurrently
+    CREATE UNIQUE INDEX idx_ephemeris_day_stats
+    ON almanac.ephemeris_day_stats (month, day, tweeted_year);
 EOSQL
@@ -1,10 +1,92 @@
 """Shared test fixtures for almanac-bot tests."""
 
 import datetime
+from typing import Callable, List
+from unittest.mock import MagicMock, patch
 
 import pytest
+from babel import Locale
 
+from almanacbot.almanacbot import AlmanacBot, Channel
+from almanacbot.clock import utc_now
 from almanacbot.ephemeris import Ephemeris, Location
+from almanacbot.postgresql_client import PostgreSQLClient
+from almanacbot.publisher import FanOutPublisher, PublishTarget
+from almanacbot.scheduler import PostingSchedule
+
+
+@pytest.fixture
+def bot_with_mocks():
+    """Create an AlmanacBot instance with mocked dependencies."""
+    with patch.object(AlmanacBot, "__init__", lambda x: None):
+        bot = AlmanacBot()
+        bot.locale = Locale.parse("ca_ES")
+        target = MagicMock(spec=PublishTarget)
+        target.name = "twitter"
+        target.locale = bot.locale
+        target.min_interval = 0.0
+        target.bundle = "none"
+        bot.channels = [Channel("default", MagicMock(), FanOutPublisher([target]))]
+        bot.ack_queue_size = 100
+        bot.ack_batch_size = 50
+        bot.retry_batch_size = 50
+        bot.retry_lease = datetime.timedelta(minutes=15)
+        bot.schedule = PostingSchedule()
+        bot.now = utc_now
+        bot.channels[0].storage.claim_due_retries.return_value = []
+        bot.channels[0].storage.claim_ephemeris.side_effect = lambda ids, lease: ids
+        yield bot
+
+
+@pytest.fixture
+def mock_create_engine():
+    """Mock the engines of the PostgreSQL clients created during the test."""
+    with patch("almanacbot.postgresql_client.create_engine") as create_engine:
+        yield create_engine
+
+
+@pytest.fixture
+def make_postgresql_client(mock_create_engine) -> Callable[..., PostgreSQLClient]:
+    """Factory of PostgreSQL clients of a table, sharing one mocked engine."""
+
+    def make_client(ephemeris_table: str = "ephemeris", **kwargs) -> PostgreSQLClient:
+        return PostgreSQLClient(
+            user="test",
+            password="test",
+            hostname="localhost",
+            database="test",
+            ephemeris_table=ephemeris_table,
+            logging_echo=False,
+            **kwargs,
+        )
+
+    return make_client
+
+
+@pytest.fixture
+def mock_session():
+    """Mock the ORM sessions of the PostgreSQL clients."""
+    session = MagicMock()
+    session.__enter__ = MagicMock(return_value=session)
+    session.__exit__ = MagicMock(return_value=False)
+    with patch("almanacbot.postgresql_client.Session", return_value=session):
+        yield session
+
+
+@pytest.fixture
+def raw_cursor(mock_create_engine) -> MagicMock:
+    """Cursor of the raw connections of the mocked PostgreSQL engine."""
+    connection = mock_create_engine.return_value.raw_connection.return_value
+    return connection.driver_connection.cursor.return_value.__enter__.return_value
+
+
+@pytest.fixture
+def executed_sql(raw_cursor) -> Callable[[], List[str]]:
+    """SQL text of the statements executed so far by the raw cursor."""
+    return lambda: [
+        call.args[0].as_string() if hasattr(call.args[0], "as_string") else call.args[0]
+        for call in raw_cursor.execute.call_args_list
+    ]
 
 
 @pytest.fixture
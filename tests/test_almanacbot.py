@@ -1,61 +1,80 @@
 """Tests for the AlmanacBot main module."""
 
 import datetime
-from unittest.mock import MagicMock, patch
+import threading
+from unittest.mock import MagicMock
 
 import pytest
-from babel import Locale
 
-from almanacbot.almanacbot import AlmanacBot
+
+from almanacbot.almanacbot import Channel
 from almanacbot.ephemeris import Ephemeris
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.publisher import FanOutPublisher, PublishTarget
+from almanacbot.scheduler import PostingSchedule, parse_windows
+from almanacbot.storage import RetryEntry, TodayCounts
+from tests.test_publisher import FakeTarget
+
+
+def make_ephemeris(eph_id: int) -> Ephemeris:
+    return Ephemeris(
+        id=eph_id,
+        date=datetime.datetime(1950, 6, 1, 12, 0, tzinfo=datetime.timezone.utc),
+        text="Event ${years_ago} years ago.",
+    )
+
+
+def channel_storage(bot) -> MagicMock:
+    """Storage of the only channel of the bot."""
+    return bot.channels[0].storage
+
+
+def post(bot) -> MagicMock:
+    """Post method of the only publishing target of the bot."""
+    return bot.channels[0].publisher.targets[0].post
+
+
+def acknowledged_ids(storage: MagicMock) -> list:
+    """Ids marked as tweeted through the acknowledgement writer."""
+    return [
+        ephemeris_id
+        for call in storage.mark_many_as_tweeted.call_args_list
+        for ephemeris_id in call.args[0]
+    ]
 
 
 class TestRun:
     """Tests for the main run() method."""
 
-    @pytest.fixture
-    def bot_with_mocks(self):
-        """Create an AlmanacBot instance with mocked dependencies."""
-        with patch.object(AlmanacBot, "__init__", lambda x: None):
-            bot = AlmanacBot()
-            bot.postgresql_client = MagicMock()
-            bot.twitter_client = MagicMock()
-            bot.locale = Locale.parse("ca_ES")
-            yield bot
-
     def test_returns_zero_when_no_ephemeris(self, bot_with_mocks):
         """Should return 0 when no ephemeris for today."""
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = []
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = []
 
         result = bot_with_mocks.run()
 
         assert result == 0
-        bot_with_mocks.twitter_client.tweet_ephemeris.assert_not_called()
+        post(bot_with_mocks).assert_not_called()
 
     def test_tweets_all_ephemeris(self, bot_with_mocks):
         """Should tweet each ephemeris and mark as tweeted."""
-        mock_eph = MagicMock(spec=Ephemeris)
-        mock_eph.id = 1
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        mock_eph = make_ephemeris(1)
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph
         ]
 
         result = bot_with_mocks.run()
 
         assert result == 1
-        bot_with_mocks.twitter_client.tweet_ephemeris.assert_called_once_with(mock_eph)
-        bot_with_mocks.postgresql_client.mark_as_tweeted.assert_called_once_with(1)
+        post(bot_with_mocks).assert_called_once()
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == [1]
 
     def test_tweets_multiple_ephemeris(self, bot_with_mocks):
         """Should tweet all ephemeris entries for the day."""
-        mock_eph1 = MagicMock(spec=Ephemeris)
-        mock_eph1.id = 1
-        mock_eph2 = MagicMock(spec=Ephemeris)
-        mock_eph2.id = 2
-        mock_eph3 = MagicMock(spec=Ephemeris)
-        mock_eph3.id = 3
-
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        mock_eph1 = make_ephemeris(1)
+        mock_eph2 = make_ephemeris(2)
+        mock_eph3 = make_ephemeris(3)
+
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph1,
             mock_eph2,
             mock_eph3,
@@ -64,8 +83,8 @@ class TestRun:
         result = bot_with_mocks.run()
 
         assert result == 3
-        assert bot_with_mocks.twitter_client.tweet_ephemeris.call_count == 3
-        assert bot_with_mocks.postgresql_client.mark_as_tweeted.call_count == 3
+        assert post(bot_with_mocks).call_count == 3
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == [1, 2, 3]
 
     def test_dry_run_does_not_tweet(self, bot_with_mocks):
         """Dry run should log but not tweet or mark as tweeted."""
@@ -76,28 +95,26 @@ class TestRun:
             location=None,
             last_tweeted_at=None,
         )
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph
         ]
 
         result = bot_with_mocks.run(dry_run=True)
 
         assert result == 1
-        bot_with_mocks.twitter_client.tweet_ephemeris.assert_not_called()
-        bot_with_mocks.postgresql_client.mark_as_tweeted.assert_not_called()
+        post(bot_with_mocks).assert_not_called()
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == []
 
     def test_continues_on_tweet_failure(self, bot_with_mocks):
         """Should continue with next ephemeris if one fails."""
-        mock_eph1 = MagicMock(spec=Ephemeris)
-        mock_eph1.id = 1
-        mock_eph2 = MagicMock(spec=Ephemeris)
-        mock_eph2.id = 2
+        mock_eph1 = make_ephemeris(1)
+        mock_eph2 = make_ephemeris(2)
 
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph1,
             mock_eph2,
         ]
-        bot_with_mocks.twitter_client.tweet_ephemeris.side_effect = [
+        post(bot_with_mocks).side_effect = [
             Exception("API error"),
             None,
         ]
@@ -106,40 +123,117 @@ class TestRun:
 
         # Only the second succeeded
         assert result == 1
-        assert bot_with_mocks.postgresql_client.mark_as_tweeted.call_count == 1
-        bot_with_mocks.postgresql_client.mark_as_tweeted.assert_called_once_with(2)
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == [2]
 
     def test_does_not_mark_failed_tweet(self, bot_with_mocks):
         """Should not mark as tweeted if the tweet fails."""
-        mock_eph = MagicMock(spec=Ephemeris)
-        mock_eph.id = 1
+        mock_eph = make_ephemeris(1)
 
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph
         ]
-        bot_with_mocks.twitter_client.tweet_ephemeris.side_effect = Exception(
-            "API error"
-        )
+        post(bot_with_mocks).side_effect = Exception("API error")
 
         result = bot_with_mocks.run()
 
         assert result == 0
-        bot_with_mocks.postgresql_client.mark_as_tweeted.assert_not_called()
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == []
+
+
+class TestRetryOutbox:
+    """Tests for the retry of failed tweets."""
+
+    def test_failed_tweet_is_scheduled_for_retry(self, bot_with_mocks):
+        """A failed tweet should be written to the retry outbox."""
+        mock_eph = make_ephemeris(1)
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
+            mock_eph
+        ]
+        post(bot_with_mocks).side_effect = ConnectionError("network down")
+
+        bot_with_mocks.run()
+
+        ephemeris_id, attempts, error_class, error, retry_at = channel_storage(
+            bot_with_mocks
+        ).schedule_retry.call_args.args
+        assert (ephemeris_id, attempts, error_class, error) == (
+            1,
+            1,
+            "ConnectionError",
+            "network down",
+        )
+        assert retry_at > datetime.datetime.now(datetime.timezone.utc)
+
+    def test_due_retries_are_tweeted_once(self, bot_with_mocks):
+        """Due retries should be tweeted first, without duplicating today's."""
+        retried = make_ephemeris(1)
+        today = make_ephemeris(2)
+        channel_storage(bot_with_mocks).claim_due_retries.return_value = [
+            RetryEntry(ephemeris=retried, attempts=2)
+        ]
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
+            retried,
+            today,
+        ]
+
+        result = bot_with_mocks.run()
+
+        assert result == 2
+        assert acknowledged_ids(channel_storage(bot_with_mocks)) == [1, 2]
+
+    def test_retry_attempts_are_counted(self, bot_with_mocks):
+        """A retry failing again should be rescheduled with one more attempt."""
+        retried = make_ephemeris(1)
+        channel_storage(bot_with_mocks).claim_due_retries.return_value = [
+            RetryEntry(ephemeris=retried, attempts=2)
+        ]
+        post(bot_with_mocks).side_effect = TimeoutError()
+
+        bot_with_mocks.run(retry_only=True)
+
+        assert channel_storage(bot_with_mocks).schedule_retry.call_args.args[1] == 3
+        channel_storage(
+            bot_with_mocks
+        ).get_untweeted_today_ephemeris.assert_not_called()
+
+    def test_dry_runs_do_not_hold_retries(self, bot_with_mocks):
+        """Retries claimed by dry runs should stay due for the next real run."""
+        bot_with_mocks.run(dry_run=True, retry_only=True)
+        bot_with_mocks.run(retry_only=True)
+
+        assert [
+            call.args
+            for call in channel_storage(bot_with_mocks).claim_due_retries.call_args_list
+        ] == [(50, datetime.timedelta(0)), (50, datetime.timedelta(minutes=15))]
+
+    def test_ephemeris_claimed_by_another_run_are_skipped(self, bot_with_mocks):
+        """Runs overlapping should post each ephemeris once, retries apart."""
+        storage = channel_storage(bot_with_mocks)
+        storage.claim_due_retries.return_value = [
+            RetryEntry(ephemeris=make_ephemeris(1), attempts=1)
+        ]
+        storage.get_untweeted_today_ephemeris.return_value = [
+            make_ephemeris(2),
+            make_ephemeris(3),
+        ]
+        # another run claimed ephemeris 2 first
+        storage.claim_ephemeris.side_effect = lambda ids, lease: [
+            eph_id for eph_id in ids if eph_id != 2
+        ]
+
+        result = bot_with_mocks.run()
+
+        assert result == 2
+        assert storage.claim_ephemeris.call_args.args == (
+            [2, 3],
+            datetime.timedelta(minutes=15),
+        )
+        assert acknowledged_ids(storage) == [1, 3]
 
 
 class TestDryRunOutput:
     """Tests for dry-run mode output."""
 
-    @pytest.fixture
-    def bot_with_mocks(self):
-        """Create an AlmanacBot instance with mocked dependencies."""
-        with patch.object(AlmanacBot, "__init__", lambda x: None):
-            bot = AlmanacBot()
-            bot.postgresql_client = MagicMock()
-            bot.twitter_client = MagicMock()
-            bot.locale = Locale.parse("ca_ES")
-            yield bot
-
     def test_dry_run_processes_template(self, bot_with_mocks, caplog):
         """Dry run should process the tweet template correctly."""
         import logging
@@ -153,7 +247,7 @@ class TestDryRunOutput:
             location=None,
             last_tweeted_at=None,
         )
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph
         ]
 
@@ -166,29 +260,223 @@ class TestDryRunOutput:
 class TestIdempotency:
     """Tests for idempotency behavior."""
 
-    @pytest.fixture
-    def bot_with_mocks(self):
-        """Create an AlmanacBot instance with mocked dependencies."""
-        with patch.object(AlmanacBot, "__init__", lambda x: None):
-            bot = AlmanacBot()
-            bot.postgresql_client = MagicMock()
-            bot.twitter_client = MagicMock()
-            bot.locale = Locale.parse("ca_ES")
-            yield bot
-
     def test_second_run_finds_no_ephemeris(self, bot_with_mocks):
         """Second run should find no untweeted ephemeris after first run."""
-        mock_eph = MagicMock(spec=Ephemeris)
-        mock_eph.id = 1
+        mock_eph = make_ephemeris(1)
 
         # First run returns ephemeris
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = [
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = [
             mock_eph
         ]
         first_result = bot_with_mocks.run()
         assert first_result == 1
 
         # Second run returns empty (simulating database state after marking)
-        bot_with_mocks.postgresql_client.get_untweeted_today_ephemeris.return_value = []
+        channel_storage(bot_with_mocks).get_untweeted_today_ephemeris.return_value = []
         second_result = bot_with_mocks.run()
         assert second_result == 0
+
+
+class TestMemoryBackend:
+    """Tests running the bot on top of the in-memory storage."""
+
+    def test_full_year_simulation(self, bot_with_mocks):
+        """Every event of a leap year should be tweeted once, on its day."""
+        start = datetime.datetime(2024, 1, 1, 8, 0, tzinfo=datetime.timezone.utc)
+        clock = [start]
+        storage = MemoryStorage(
+            [
+                (start.replace(year=2000) + datetime.timedelta(days=day), "Event", None)
+                for day in range(366)
+            ],
+            now=lambda: clock[0],
+        )
+        bot = bot_with_mocks
+        bot.channels[0].storage = storage
+
+        tweets_sent = 0
+        for day in range(366):
+            clock[0] = start + datetime.timedelta(days=day)
+            tweets_sent += bot.run()
+            assert bot.run() == 0
+
+        assert tweets_sent == 366
+        assert post(bot).call_count == 366
+
+
+class TestListen:
+    """Tests for posting the ephemeris inserted while the bot listens."""
+
+    def test_posts_inserted_ephemeris_at_once(self, bot_with_mocks):
+        """Only the inserted ephemeris should be posted, outside the schedule."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        storage = MemoryStorage([(now, "Planned.", None)])
+        bot = bot_with_mocks
+        bot.channels[0].storage = storage
+        bot.schedule = PostingSchedule(parse_windows("00:00-00:01/1"))
+        stop = threading.Event()
+        posted = []
+        listening = threading.Thread(
+            target=lambda: posted.append(bot.listen(timeout=0.01, stop=stop))
+        )
+
+        listening.start()
+        storage.insert_ephemeris(Ephemeris(date=now.replace(year=1990), text="New."))
+        storage.insert_ephemeris(
+            Ephemeris(date=now - datetime.timedelta(days=2), text="Old.")
+        )
+        while not post(bot).called:
+            listening.join(0.01)
+        stop.set()
+        listening.join()
+
+        assert posted == [1]
+        assert [call.args[0] for call in post(bot).call_args_list] == ["New."]
+        assert [eph.text for eph in storage.get_untweeted_today_ephemeris()] == [
+            "Planned."
+        ]
+
+    def test_requires_a_notifying_storage(self, bot_with_mocks):
+        """Listening should fail when no channel storage can notify inserts."""
+        bot_with_mocks.channels[0].storage.listen_inserts.return_value = None
+
+        with pytest.raises(ValueError):
+            bot_with_mocks.listen(timeout=0.01)
+
+
+class TestPostingSchedule:
+    """Tests for the staggered posting of today's ephemeris."""
+
+    def test_only_planned_ephemeris_are_tweeted(self, bot_with_mocks):
+        """Only the open window's share should be tweeted, retries included."""
+        retried = make_ephemeris(1)
+        channel_storage(bot_with_mocks).claim_due_retries.return_value = [
+            RetryEntry(ephemeris=retried, attempts=1)
+        ]
+        storage = channel_storage(bot_with_mocks)
+        storage.count_today_ephemeris.return_value = TodayCounts(
+            untweeted=41, tweeted_since=0
+        )
+        storage.get_top_untweeted_today_ephemeris.return_value = [
+            Ephemeris(id=eph_id, date=datetime.datetime(1950, 6, 1), text="Event.")
+            for eph_id in range(1, 3)
+        ]
+        bot_with_mocks.schedule = PostingSchedule(parse_windows("00:00-23:59/1"))
+
+        result = bot_with_mocks.run()
+
+        assert result == 2
+        assert acknowledged_ids(storage) == [1, 2]
+        # the retry is skipped among the best scored, not counted in the cap
+        assert storage.get_top_untweeted_today_ephemeris.call_args.args[0] == 2
+
+
+class TestFanOut:
+    """Tests for the publication to several targets."""
+
+    def test_partial_failure_retries_pending_targets(self, bot_with_mocks):
+        """Targets reached should be recorded and the others retried."""
+        storage = MemoryStorage(
+            [(datetime.datetime.now(datetime.timezone.utc), "Event.", None)]
+        )
+        bot = bot_with_mocks
+        bot.channels[0].storage = storage
+        up, down = MagicMock(spec=PublishTarget), MagicMock(spec=PublishTarget)
+        for target, name in ((up, "up"), (down, "down")):
+            target.name, target.locale, target.min_interval = name, bot.locale, 0.0
+            target.bundle = "none"
+        down.post.side_effect = ConnectionError("down")
+        bot.channels[0].publisher = FanOutPublisher([up, down])
+        eph_id = storage.get_today_ephemeris()[0].id
+
+        assert bot.run() == 0
+        assert storage.get_deliveries([eph_id]) == {eph_id: {"up"}}
+        assert storage.get_untweeted_today_ephemeris()[0].id == eph_id
+
+        # the retry is due once its backoff has elapsed
+        down.post.side_effect = None
+        storage.schedule_retry(
+            eph_id,
+            1,
+            "ConnectionError",
+            "down",
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+        assert bot.run(retry_only=True) == 1
+        assert up.post.call_count == 1
+        assert down.post.call_count == 2
+        assert storage.get_deliveries([eph_id]) == {}
+        assert storage.get_untweeted_today_ephemeris() == []
+
+    def test_posts_are_recorded_in_history(self, bot_with_mocks):
+        """Every post should be appended to the history, with its post id."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        storage = MemoryStorage([(now, "Event.", None)])
+        bot = bot_with_mocks
+        bot.channels[0].storage = storage
+        post(bot).return_value = "1234"
+
+        assert bot.run() == 1
+        assert bot.run(dry_run=True) == 0
+
+        history = storage.get_post_history(
+            now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=1)
+        )
+        assert [(p.ephemeris_id, p.target, p.post_id) for p in history] == [
+            (storage.get_today_ephemeris()[0].id, "twitter", "1234")
+        ]
+        assert history[0].latency >= 0
+
+    def test_threads_resume_from_the_last_post(self, bot_with_mocks):
+        """Retried ephemeris should continue the thread of the day."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        storage = MemoryStorage(
+            [(now, "One.", None), (now, "Two.", None), (now, "Six.", None)]
+        )
+        target = FakeTarget("thread", bundle="thread", max_length=4, fail={"Two."})
+        bot = bot_with_mocks
+        bot.channels[0].storage = storage
+        bot.channels[0].publisher = FanOutPublisher([target])
+
+        assert bot.run() == 1
+        assert target.replies == [None]
+
+        target._fail.clear()
+        for entry in storage.get_untweeted_today_ephemeris():
+            storage.schedule_retry(entry.id, 1, "ConnectionError", "down", now)
+        assert bot.run(retry_only=True) == 2
+        assert target.posts == ["One.", "Two.", "Six."]
+        assert target.replies == [None, "thread-1", "thread-2"]
+
+
+class TestChannels:
+    """Tests for serving several channels from one run."""
+
+    def test_each_channel_posts_to_its_targets(self, bot_with_mocks):
+        """Every channel should post its own ephemeris to its own targets."""
+        bot = bot_with_mocks
+        now = datetime.datetime.now(datetime.timezone.utc)
+        catalan, english = MagicMock(spec=PublishTarget), MagicMock(spec=PublishTarget)
+        for target, name in ((catalan, "catalan"), (english, "english")):
+            target.name, target.locale, target.min_interval = name, bot.locale, 0.0
+            target.bundle = "none"
+        bot.channels = [
+            Channel(
+                "barcelona",
+                MemoryStorage([(now, "Barcelona.", None)]),
+                FanOutPublisher([catalan]),
+            ),
+            Channel(
+                "london",
+                MemoryStorage([(now, "London.", None), (now, "Thames.", None)]),
+                FanOutPublisher([english]),
+            ),
+        ]
+
+        assert bot.run() == 3
+        assert [call.args[0] for call in catalan.post.call_args_list] == ["Barcelona."]
+        assert [call.args[0] for call in english.post.call_args_list] == [
+            "London.",
+            "Thames.",
+        ]
+        assert bot.run() == 0
@@ -0,0 +1,61 @@
+"""Tests for the calendar coverage report."""
+
+from almanacbot.coverage import heat_table, summarize
+from almanacbot.storage import DayStats
+
+
+STATS = [
+    DayStats(month=1, day=1, events=40, untweeted=0),
+    DayStats(month=2, day=29, events=1, untweeted=1),
+    DayStats(month=12, day=31, events=5, untweeted=2),
+]
+
+
+class TestSummarize:
+    """Tests for finding empty, sparse and crowded days."""
+
+    def test_classifies_every_calendar_day(self):
+        """Every one of the 366 days should be counted once at most."""
+        coverage = summarize(STATS, few=3, many=10)
+
+        assert (coverage.events, coverage.untweeted) == (46, 3)
+        assert len(coverage.empty) == 363
+        assert "02-28" in coverage.empty
+        assert coverage.sparse == ["02-29"]
+        assert coverage.crowded == ["01-01"]
+
+    def test_crowded_days_are_optional(self):
+        """A many of 0 should not report crowded days."""
+        assert summarize(STATS, few=3, many=0).crowded == []
+
+
+class TestHeatTable:
+    """Tests for the day by month table."""
+
+    def test_lays_out_days_by_month(self):
+        """Rows should be days of the month and columns months."""
+        lines = heat_table(STATS)
+
+        assert len(lines) == 32
+        assert lines[0].split() == [
+            "Jan",
+            "Feb",
+            "Mar",
+            "Apr",
+            "May",
+            "Jun",
+            "Jul",
+            "Aug",
+            "Sep",
+            "Oct",
+            "Nov",
+            "Dec",
+        ]
+        assert lines[1].split()[:3] == ["1", "40", "-"]
+        assert lines[29].split()[:3] == ["29", "-", "1"]
+        # Feb 30 and 31 are blank, Dec 31 is the last cell of its row
+        assert lines[31].split() == ["31", "-", "-", "-", "-", "-", "-", "5"]
+
+    def test_shows_untweeted_events(self):
+        """The untweeted counts should replace the events on request."""
+        assert heat_table(STATS, untweeted=True)[31].split()[-1] == "2"
@@ -0,0 +1,145 @@
+"""Tests for the data exporter."""
+
+import datetime
+from unittest.mock import MagicMock
+
+import pytest
+import typer
+from psycopg import sql
+
+from almanacbot import data_exporter, data_loader
+from almanacbot.ephemeris import Location
+from almanacbot.postgresql_client import PostgreSQLClient
+
+ROWS = [
+    (
+        datetime.datetime(1899, 11, 29, 12, 0, tzinfo=datetime.timezone.utc),
+        "El ${date}, avui fa ${years_ago} anys; sí.",
+        Location(41.38, 2.17),
+    ),
+    (
+        datetime.datetime(2000, 2, 29, 12, 0, tzinfo=datetime.timezone.utc),
+        "Leap year event.",
+        None,
+    ),
+]
+
+
+def read_back(path: str) -> list:
+    """Read an exported file back through the data loader readers."""
+    reader = data_loader.get_reader(path)
+    return [
+        row
+        for file_range in reader.split(path, data_loader.DEFAULT_CHUNK_SIZE)
+        for row in reader.read(file_range, batch_size=1)
+    ]
+
+
+@pytest.fixture
+def psql_client():
+    client = MagicMock(spec=PostgreSQLClient)
+    client.iter_ephemeris_rows.side_effect = lambda *args: iter(ROWS)
+    return client
+
+
+class TestExportQuery:
+    """Tests for the export query filters."""
+
+    def test_no_filters(self):
+        """Without filters the whole table should be exported."""
+        query, params = PostgreSQLClient._export_query(
+            sql.SQL("date"), None, None, None
+        )
+
+        assert query.as_string(None) == 'SELECT date FROM "ephemeris" ORDER BY id'
+        assert params == []
+
+    def test_channel_table(self):
+        """The table of the channel exported should be queried."""
+        query, _ = PostgreSQLClient._export_query(
+            sql.SQL("date"), None, None, None, sql.Identifier("almanac", "london")
+        )
+
+        assert 'FROM "almanac"."london"' in query.as_string(None)
+
+    def test_day_range_and_status(self):
+        """A day range should be bounded on both sides."""
+        query, params = PostgreSQLClient._export_query(
+            sql.SQL("date"), (3, 1), (3, 31), True
+        )
+
+        assert " AND " in query.as_string(None)
+        assert "last_tweeted_at IS NOT NULL" in query.as_string(None)
+        assert params == [3, 1, 3, 31]
+
+    def test_day_range_wraps_around_year_end(self):
+        """A range starting after it ends should wrap around the year end."""
+        query, params = PostgreSQLClient._export_query(
+            sql.SQL("date"), (12, 20), (1, 10), None
+        )
+
+        assert " OR " in query.as_string(None)
+        assert params == [12, 20, 1, 10]
+
+
+class TestWriters:
+    """Tests for the output format writers."""
+
+    @pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+    def test_jsonl_round_trips_through_loader(self, psql_client, tmp_path, suffix):
+        """Exported JSONL should be loadable, compressed or not."""
+        if suffix == ".zst":
+            pytest.importorskip("zstandard")
+        path = str(tmp_path / f"export.jsonl{suffix}")
+
+        data_exporter.get_writer(path).write(psql_client, path, None, None, None, 10)
+
+        rows = read_back(path)
+        assert [(text, location) for _, text, location in rows] == [
+            (text, location) for _, text, location in ROWS
+        ]
+        assert rows[0][0] == ROWS[0][0].isoformat()
+
+    def test_csv_writer_streams_copy_output(self, psql_client, tmp_path):
+        """The CSV writer should copy the COPY output into a loadable file."""
+        psql_client.copy_ephemeris_csv_to.side_effect = lambda output, *args: (
+            output.write(b"date;text;location\n"),
+            output.write(b'1899-11-29 12:00:00+00;"a;b";"(41.38,2.17)"\n'),
+        )
+        path = str(tmp_path / "export.csv.gz")
+
+        data_exporter.get_writer(path).write(
+            psql_client, path, (1, 1), (2, 1), False, 10
+        )
+
+        psql_client.copy_ephemeris_csv_to.assert_called_once()
+        assert read_back(path) == [
+            ("1899-11-29 12:00:00+00", "a;b", Location(41.38, 2.17))
+        ]
+
+    def test_parquet_round_trips_through_loader(self, psql_client, tmp_path):
+        """Exported Parquet should be loadable with typed columns."""
+        pytest.importorskip("pyarrow")
+        path = str(tmp_path / "export.parquet")
+
+        data_exporter.get_writer(path).write(psql_client, path, None, None, None, 1)
+
+        assert read_back(path) == ROWS
+
+    def test_unsupported_format(self):
+        """Unknown output formats should raise ValueError."""
+        with pytest.raises(ValueError):
+            data_exporter.get_writer("export.xml.gz")
+
+
+class TestParseMonthDay:
+    """Tests for the MM-DD option parser."""
+
+    def test_parses_leap_day(self):
+        """Feb 29 should be accepted."""
+        assert data_exporter.parse_month_day("02-29") == (2, 29)
+
+    def test_rejects_invalid_day(self):
+        """Invalid days should be rejected."""
+        with pytest.raises(typer.BadParameter):
+            data_exporter.parse_month_day("02-30")
@@ -0,0 +1,285 @@
+"""Tests for the data loader."""
+
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+import almanacbot.storage
+from almanacbot import compression, data_loader
+from almanacbot.data_loader import FileRange
+from almanacbot.ephemeris import Location
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.postgresql_client import NearDuplicate
+
+CSV_CONTENT = (
+    "date;text;location\n"
+    "1899-11-29 12:00 Europe/Madrid;Event ${years_ago} years ago;(41.38,2.17)\n"
+    "1950-01-01 12:00 UTC;Another event;\n"
+    "1960-02-29 12:00 UTC;Leap event;(1.0,2.0)\n"
+    "1970-12-31 12:00 UTC;Last event;\n"
+)
+CONFIG = {"targets": [{"name": "twitter", "type": "twitter", "locale": "ca_ES"}]}
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "init_db.csv"
+    path.write_text(CSV_CONTENT, encoding="UTF-8")
+    return str(path)
+
+
+class TestSplitFile:
+    """Tests for line-aligned byte range splitting."""
+
+    def test_single_range_for_small_file(self, csv_file):
+        """A file smaller than the chunk size should be a single range."""
+        ranges = data_loader.split_file(csv_file)
+
+        assert ranges == [FileRange(csv_file, 0, len(CSV_CONTENT))]
+
+    def test_ranges_are_contiguous_and_line_aligned(self, csv_file):
+        """Ranges should cover the whole file and start at line boundaries."""
+        ranges = data_loader.split_file(csv_file, chunk_size=10)
+
+        assert len(ranges) > 1
+        assert ranges[0].start == 0
+        assert ranges[-1].end == len(CSV_CONTENT)
+        for previous, current in zip(ranges, ranges[1:]):
+            assert previous.end == current.start
+            assert CSV_CONTENT[current.start - 1] == "\n"
+
+    def test_ranges_yield_every_record_once(self, csv_file):
+        """Reading all ranges should yield each record exactly once."""
+        lines = [
+            line
+            for file_range in data_loader.split_file(csv_file, chunk_size=7)
+            for line in data_loader.read_lines(file_range, skip_header=True)
+        ]
+
+        assert lines == CSV_CONTENT.splitlines(keepends=True)[1:]
+
+    def test_empty_file_has_no_ranges(self, tmp_path):
+        """An empty file should not produce any range."""
+        path = tmp_path / "empty.csv"
+        path.write_text("")
+
+        assert data_loader.split_file(str(path)) == []
+
+
+class TestCollectInputFiles:
+    """Tests for input path expansion."""
+
+    def test_expands_directories(self, tmp_path):
+        """Directories should expand to their sorted CSV files."""
+        (tmp_path / "b.csv").write_text("")
+        (tmp_path / "a.csv").write_text("")
+        (tmp_path / "notes.txt").write_text("")
+
+        files = data_loader.collect_input_files([str(tmp_path), "other.csv"])
+
+        assert files == [
+            str(tmp_path / "a.csv"),
+            str(tmp_path / "b.csv"),
+            "other.csv",
+        ]
+
+
+class TestLoadRange:
+    """Tests for a single loader worker."""
+
+    def test_copies_parsed_rows(self, csv_file):
+        """Should COPY every parsed row of the range."""
+        copied = []
+
+        def copy_ephemeris(rows):
+            copied.extend(rows)
+            return len(copied)
+
+        with patch.object(data_loader, "create_storage") as create_storage:
+            create_storage.return_value.copy_ephemeris.side_effect = copy_ephemeris
+            result = data_loader.load_range(CONFIG, FileRange(csv_file, 0, 10_000))
+
+        assert result.error is None
+        assert result.rows == 4
+        assert copied[0][:3] == (
+            "1899-11-29 12:00 Europe/Madrid",
+            "Event ${years_ago} years ago",
+            Location(41.38, 2.17),
+        )
+        assert copied[1][2] is None
+
+    def test_templates_are_analyzed_once(self, csv_file):
+        """The storage should reuse the template analysis of the validation."""
+        storage = MemoryStorage()
+
+        with (
+            patch.object(data_loader, "create_storage", return_value=storage),
+            patch.object(
+                almanacbot.storage, "analyze", side_effect=AssertionError
+            ) as analyze,
+        ):
+            result = data_loader.load_range(CONFIG, FileRange(csv_file, 0, 10_000))
+
+        assert result.error is None
+        assert result.rows == 4
+        analyze.assert_not_called()
+        assert storage.count_ephemeris() == 4
+
+    def test_reports_worker_errors(self, csv_file):
+        """Errors should be reported in the result instead of raised."""
+        with patch.object(data_loader, "create_storage") as create_storage:
+            create_storage.return_value.copy_ephemeris.side_effect = ValueError("boom")
+            result = data_loader.load_range(CONFIG, FileRange(csv_file, 0, 10_000))
+
+        assert result.rows == 0
+        assert result.error == "ValueError: boom"
+
+    def test_rejects_invalid_and_too_long_templates(self, tmp_path):
+        """Rows that could not be rendered or posted should not be loaded."""
+        path = tmp_path / "init_db.csv"
+        path.write_text(
+            "date;text;location\n"
+            "1950-06-01 12:00 UTC;Valid event on ${date};\n"
+            "1950-06-02 12:00 UTC;Typo in ${yeras_ago};\n"
+            f"1950-06-03 12:00 UTC;{'Long ' * 50}on ${{date}};\n",
+            encoding="UTF-8",
+        )
+        copied = []
+
+        def copy_ephemeris(rows):
+            copied.extend(rows)
+            return len(copied)
+
+        with patch.object(data_loader, "create_storage") as create_storage:
+            create_storage.return_value.copy_ephemeris.side_effect = copy_ephemeris
+            result = data_loader.load_range(CONFIG, FileRange(str(path), 0, 10_000))
+
+        assert [row[1] for row in copied] == ["Valid event on ${date}"]
+        assert result.rejected == [
+            "1950-06-02 12:00 UTC: Unknown placeholder: ${yeras_ago}",
+            "1950-06-03 12:00 UTC: up to 287 characters once rendered, "
+            "over the limit of 280",
+        ]
+
+    def test_channel_locales(self):
+        """Templates should be checked in the locales of the channel targets."""
+        config = {
+            "targets": [
+                {"name": "twitter", "locale": "ca_ES"},
+                {"name": "mastodon", "locale": "es_ES"},
+                {"name": "bridge", "locale": "ca_ES"},
+            ]
+        }
+
+        assert data_loader.channel_locales(config) == ["ca_ES", "es_ES"]
+        assert data_loader.channel_locales(config, {"targets": ["bridge"]}) == ["ca_ES"]
+
+
+class TestReaders:
+    """Tests for the pluggable input format readers."""
+
+    def test_reader_is_chosen_by_extension(self):
+        """Readers should be looked up by file extension."""
+        assert isinstance(data_loader.get_reader("a.csv"), data_loader.CsvReader)
+        assert isinstance(data_loader.get_reader("a.JSONL"), data_loader.JsonlReader)
+        assert isinstance(
+            data_loader.get_reader("a.parquet"), data_loader.ParquetReader
+        )
+
+    def test_unsupported_extension_raises(self):
+        """Unknown formats should raise ValueError."""
+        with pytest.raises(ValueError):
+            data_loader.get_reader("a.xlsx")
+
+    def test_csv_reader_parses_location(self, csv_file):
+        """The CSV reader should parse the location column."""
+        reader = data_loader.get_reader(csv_file)
+        rows = [
+            row
+            for file_range in reader.split(csv_file, chunk_size=16)
+            for row in reader.read(file_range, batch_size=2)
+        ]
+
+        assert len(rows) == 4
+        assert rows[0][2] == Location(41.38, 2.17)
+        assert rows[1][2] is None
+
+    def test_jsonl_reader(self, tmp_path):
+        """The JSONL reader should read one record per line."""
+        path = tmp_path / "corpus.jsonl"
+        path.write_text(
+            '{"date": "2020-09-23", "text": "sample_text", '
+            '"location": {"latitude": 1.0, "longitude": 2.0}}\n'
+            "\n"
+            '{"date": "2021-09-23", "text": "no location", "location": null}\n',
+            encoding="UTF-8",
+        )
+        reader = data_loader.get_reader(str(path))
+        rows = [
+            row
+            for file_range in reader.split(str(path), chunk_size=8)
+            for row in reader.read(file_range, batch_size=2)
+        ]
+
+        assert rows == [
+            ("2020-09-23", "sample_text", Location(1.0, 2.0)),
+            ("2021-09-23", "no location", None),
+        ]
+
+    def test_parquet_reader_reads_typed_columns(self, tmp_path):
+        """The Parquet reader should yield typed values, split by row groups."""
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+
+        dates = [
+            datetime.datetime(1900 + i, 1, 1, tzinfo=datetime.timezone.utc)
+            for i in range(5)
+        ]
+        table = pa.table(
+            {
+                "date": pa.array(dates, type=pa.timestamp("us", tz="UTC")),
+                "text": [f"event {i}" for i in range(5)],
+                "location": pa.array(
+                    [{"latitude": 1.0, "longitude": 2.0}, None, None, None, None],
+                    type=pa.struct(
+                        [("latitude", pa.float64()), ("longitude", pa.float64())]
+                    ),
+                ),
+            }
+        )
+        path = str(tmp_path / "corpus.parquet")
+        pq.write_table(table, path, row_group_size=2)
+
+        reader = data_loader.get_reader(path)
+        file_ranges = reader.split(path, chunk_size=1)
+        rows = [
+            row
+            for file_range in file_ranges
+            for row in reader.read(file_range, batch_size=1)
+        ]
+
+        assert len(file_ranges) == 3
+        assert [row[0] for row in rows] == dates
+        assert rows[0][2] == Location(1.0, 2.0)
+        assert all(row[2] is None for row in rows[1:])
+
+
+class TestWriteReview:
+    """Tests for the near-duplicate report."""
+
+    @pytest.mark.parametrize("name", ["review.csv", "review.csv.gz"])
+    def test_writes_a_row_per_pair(self, tmp_path, name):
+        date = datetime.datetime(1992, 7, 25, tzinfo=datetime.timezone.utc)
+        duplicate = NearDuplicate(12, date, "Games; open", 3, date, "Games open", 0.8)
+        path = str(tmp_path / name)
+
+        assert data_loader.write_review(path, [duplicate]) == 1
+
+        with compression.open_file(path, "rb") as review:
+            lines = review.read().decode("utf-8").splitlines()
+        assert lines == [
+            "similarity;id;date;text;duplicate_of;duplicate_date;duplicate_text",
+            '0.800;12;1992-07-25T00:00:00+00:00;"Games; open";3;'
+            "1992-07-25T00:00:00+00:00;Games open",
+        ]
@@ -195,3 +195,84 @@ class TestDatabaseIntegration:
 
         result = db_client.get_today_ephemeris()
         assert len(result) == 0
+
+    def test_days_are_utc_in_a_non_utc_session(self, db_client, clean_db):
+        """The day should be the UTC one, whatever the server time zone."""
+        from sqlalchemy import text
+        from sqlalchemy.orm import Session
+
+        from almanacbot.ephemeris import Ephemeris
+        from almanacbot.postgresql_client import PostgreSQLClient
+
+        with Session(db_client.engine) as session:
+            session.execute(text("ALTER ROLE CURRENT_USER SET TimeZone = 'Etc/GMT-2'"))
+            session.commit()
+        try:
+            # already Feb 1 in the server time zone
+            client = PostgreSQLClient(
+                user=os.environ.get("POSTGRES_USER", "almanac"),
+                password=os.environ.get("POSTGRES_PASSWORD", "almanac"),
+                hostname=os.environ.get("POSTGRES_HOST", "localhost"),
+                database=os.environ.get("POSTGRES_DB", "almanac"),
+                ephemeris_table="ephemeris",
+                logging_echo=False,
+                now=lambda: datetime.datetime(
+                    2025, 1, 31, 23, 30, tzinfo=datetime.timezone.utc
+                ),
+            )
+            client.insert_ephemeris(
+                Ephemeris(
+                    date=datetime.datetime(
+                        1950, 1, 31, 21, 0, tzinfo=datetime.timezone.utc
+                    ),
+                    text="Event of Jan 31.",
+                )
+            )
+
+            assert [eph.text for eph in client.get_today_ephemeris()] == [
+                "Event of Jan 31."
+            ]
+            client.close()
+        finally:
+            with Session(db_client.engine) as session:
+                session.execute(text("ALTER ROLE CURRENT_USER RESET TimeZone"))
+                session.commit()
+
+
+class TestCopyIntegration:
+    """Round-trip tests for the COPY based loader and exporter."""
+
+    def test_csv_export_round_trips_through_copy(self, db_client, clean_db):
+        """CSV exported with COPY TO should load back with COPY FROM."""
+        import csv
+        import io
+
+        from almanacbot.data_loader import parse_csv_row
+        from almanacbot.ephemeris import Location
+
+        db_client.copy_ephemeris(
+            [
+                ("1899-11-29 12:00 Europe/Madrid", "Event; with delimiter", None),
+                ("2000-02-29 12:00 UTC", "Leap event", Location(1.0, 2.0)),
+            ]
+        )
+        output = io.BytesIO()
+        db_client.copy_ephemeris_csv_to(output, from_day=(2, 1), to_day=(2, 29))
+
+        lines = output.getvalue().decode("UTF-8").splitlines()
+        rows = [parse_csv_row(row) for row in csv.reader(lines[1:], delimiter=";")]
+        assert lines[0] == "date;text;location"
+        assert [(text, location) for _, text, location in rows] == [
+            ("Leap event", Location(1.0, 2.0))
+        ]
+
+        assert db_client.copy_ephemeris(rows) == 1
+        db_client.refresh_day_stats()
+        assert db_client.count_ephemeris() == 3
+
+    def test_iter_rows_filters_by_status(self, db_client, clean_db):
+        """Typed export rows should honour the tweet status filter."""
+        db_client.copy_ephemeris([("1950-01-01 12:00 UTC", "Untweeted", None)])
+
+        assert len(list(db_client.iter_ephemeris_rows(tweeted=False))) == 1
+        assert list(db_client.iter_ephemeris_rows(tweeted=True)) == []
@@ -0,0 +1,133 @@
+"""Tests for the queued, structured logging setup."""
+
+import json
+import logging
+import threading
+
+import pytest
+
+from almanacbot import logs
+from almanacbot.publisher import FanOutPublisher
+from tests.test_publisher import FakeTarget, make_ephemeris, publish
+
+
+class RecordingHandler(logging.Handler):
+    """Handler keeping the formatted records and the threads writing them."""
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.lines = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+@pytest.fixture
+def queued():
+    """Logger whose handler was moved behind a queue."""
+    handler = RecordingHandler()
+    handler.setFormatter(logging.Formatter("[%(run_id)s %(stage)s] %(message)s"))
+    log = logging.getLogger("almanacbot.tests.logs")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    log.addHandler(handler)
+    listeners = logs.enqueue_handlers([log])
+    yield log, handler, listeners
+    for listener in listeners:
+        listener.stop()
+    log.handlers.clear()
+
+
+def flush(listeners):
+    for listener in listeners:
+        listener.stop()
+
+
+class TestEnqueueHandlers:
+    """Tests for moving handler I/O off the logging threads."""
+
+    def test_handlers_run_on_the_listener_thread(self, queued):
+        """Handlers should be called from the listener thread."""
+        log, handler, listeners = queued
+
+        log.info("Posted ephemeris id=%s", 1)
+        flush(listeners)
+
+        assert [line.split("] ")[1] for line in handler.lines] == [
+            "Posted ephemeris id=1"
+        ]
+        assert threading.current_thread().name not in handler.threads
+
+    def test_records_carry_run_and_stage(self, queued):
+        """Records should carry the run id and stage of the emitting context."""
+        log, handler, listeners = queued
+
+        run_id = logs.start_run("run-1")
+        with logs.stage("publish"):
+            log.info("Posting...")
+        log.info("Done.")
+        flush(listeners)
+
+        assert run_id == "run-1"
+        assert handler.lines == ["[run-1 publish] Posting...", "[run-1 -] Done."]
+
+    def test_disabled_levels_are_not_formatted(self, queued):
+        """Arguments of disabled log calls should never be formatted."""
+        log, handler, listeners = queued
+
+        class Expensive:
+            def __str__(self):
+                raise AssertionError("formatted")
+
+        log.debug("Ephemeris: %s", Expensive())
+        flush(listeners)
+
+        assert handler.lines == []
+
+    def test_publisher_workers_keep_the_context(self, queued):
+        """Records of publisher threads should carry the caller's stage."""
+        log, handler, listeners = queued
+        publisher_logger = logging.getLogger("almanacbot.publisher")
+        publisher_logger.addHandler(log.handlers[0])
+        publisher_logger.setLevel(logging.INFO)
+
+        try:
+            with logs.stage("publish"):
+                publish(FanOutPublisher([FakeTarget("twitter")]), make_ephemeris(1))
+        finally:
+            publisher_logger.removeHandler(log.handlers[0])
+            publisher_logger.setLevel(logging.NOTSET)
+        flush(listeners)
+
+        assert handler.lines
+        assert all(" publish] " in line for line in handler.lines)
+
+
+class TestJsonFormatter:
+    """Tests for the JSON log records."""
+
+    def test_formats_fields_and_exception(self):
+        """Records should be one JSON object with context and traceback."""
+        handler = RecordingHandler()
+        log = logging.getLogger("almanacbot.tests.json")
+        log.propagate = False
+        log.addHandler(handler)
+        listeners = logs.enqueue_handlers([log], json_format=True)
+
+        logs.start_run("run-2")
+        with logs.stage("acknowledge"):
+            try:
+                raise ConnectionError("down")
+            except ConnectionError:
+                log.exception("Failed to mark ephemeris as tweeted: %s", [1, 2])
+        flush(listeners)
+        log.handlers.clear()
+
+        entry = json.loads(handler.lines[0])
+        assert entry["level"] == "ERROR"
+        assert entry["logger"] == "almanacbot.tests.json"
+        assert entry["message"] == "Failed to mark ephemeris as tweeted: [1, 2]"
+        assert (entry["run_id"], entry["stage"]) == ("run-2", "acknowledge")
+        assert "ConnectionError: down" in entry["exception"]
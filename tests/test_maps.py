@@ -0,0 +1,186 @@
+"""Tests for the locator maps and their media cache."""
+
+import datetime
+import json
+import struct
+import zlib
+
+import pytest
+
+from almanacbot.ephemeris import Location
+from almanacbot.maps import (
+    LAND,
+    MARKER,
+    OCEAN,
+    PALETTE,
+    MediaCache,
+    load_coastlines,
+    render_locator,
+)
+from tests.test_publisher import MediaTarget
+
+
+def decode(png: bytes) -> tuple:
+    """Width, height and palette index rows of an unfiltered palette PNG."""
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks, offset = {}, 8
+    while offset < len(png):
+        (length,) = struct.unpack(">I", png[offset : offset + 4])
+        kind = png[offset + 4 : offset + 8]
+        data = png[offset + 8 : offset + 8 + length]
+        (crc,) = struct.unpack(">I", png[offset + 8 + length : offset + 12 + length])
+        assert crc == zlib.crc32(kind + data)
+        chunks[kind] = data
+        offset += 12 + length
+    width, height, depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+    assert (depth, color_type) == (8, 3)
+    assert chunks[b"PLTE"] == bytes(value for color in PALETTE for value in color)
+    raw = zlib.decompress(chunks[b"IDAT"])
+    rows = [raw[y * (width + 1) + 1 : (y + 1) * (width + 1)] for y in range(height)]
+    return width, height, rows
+
+
+def pixel(rows, longitude: float, latitude: float, width: int = 360) -> int:
+    """Palette index at a place of a whole-world map."""
+    scale = width / 360
+    return rows[int((90 - latitude) * scale)][int((longitude + 180) * scale)]
+
+
+class TestRenderLocator:
+    """Tests for the rendering of locator maps."""
+
+    def test_draws_the_world_and_the_location(self):
+        """Land, ocean and the marker should be where they are on Earth."""
+        width, height, rows = decode(render_locator(Location(41.4, 2.2)))
+
+        assert (width, height) == (360, 180)
+        assert pixel(rows, 20, 5) == LAND  # Africa
+        assert pixel(rows, -30, 0) == OCEAN  # Atlantic
+        assert pixel(rows, 50, 42) == OCEAN  # Caspian Sea, a hole of Eurasia
+        assert pixel(rows, 2.2, 41.4) == MARKER
+
+    def test_zooms_on_the_location(self):
+        """Maps spanning fewer degrees should be centered on the location."""
+        _, _, rows = decode(render_locator(Location(-33.9, 151.2), span=60))
+
+        # clamped to the antimeridian, Sydney is 29 degrees from the east edge
+        assert rows[90][int(31 * 6)] == MARKER
+
+    def test_rejects_spans_out_of_the_world(self):
+        with pytest.raises(ValueError):
+            render_locator(Location(0, 0), span=400)
+
+    def test_reads_multipolygons(self, tmp_path):
+        """Coastlines may come from other GeoJSON files, e.g. Natural Earth."""
+        path = tmp_path / "land.geojson"
+        square = [[-10, -10], [10, -10], [10, 10], [-10, 10], [-10, -10]]
+        path.write_text(
+            json.dumps(
+                {
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "geometry": {
+                                "type": "MultiPolygon",
+                                "coordinates": [[square]],
+                            },
+                        }
+                    ],
+                }
+            )
+        )
+
+        (polygon,) = load_coastlines(str(path))
+        _, _, rows = decode(render_locator(Location(60, 60), coastlines=str(path)))
+
+        assert polygon[0][0] == (-10, -10)
+        assert pixel(rows, 0, 0) == LAND
+        assert pixel(rows, 20, 5) == OCEAN
+
+
+class TestMediaCache:
+    """Tests for the cache of rendered and uploaded maps."""
+
+    def test_keys_round_the_coordinates(self, tmp_path):
+        cache = MediaCache(str(tmp_path))
+
+        assert cache.key(Location(41.387, 2.17)) == "+41.4_+002.2"
+        assert cache.key(Location(-33.87, -151.21)) == "-33.9_-151.2"
+        assert MediaCache(str(tmp_path), precision=0).key(Location(41.6, 2.2)) == (
+            "+42_+002"
+        )
+
+    def test_images_are_rendered_once(self, tmp_path):
+        """Nearby places should share the image file of their rounded place."""
+        image = MediaCache(str(tmp_path)).image(Location(41.387, 2.17))
+
+        assert (tmp_path / "+41.4_+002.2.png").read_bytes() == image
+        (tmp_path / "+41.4_+002.2.png").write_bytes(b"cached")
+        assert MediaCache(str(tmp_path)).image(Location(41.39, 2.2)) == b"cached"
+
+    def test_media_ids_are_kept_per_target(self, tmp_path):
+        """Each target should upload a place once, across restarts."""
+        mastodon, twitter = MediaTarget("mastodon"), MediaTarget("twitter")
+        cache = MediaCache(str(tmp_path))
+        barcelona = Location(41.387, 2.17)
+
+        assert cache.media_id(mastodon, barcelona) == "mastodon-media-1"
+        assert cache.media_id(mastodon, Location(41.4, 2.2)) == "mastodon-media-1"
+        assert cache.media_id(twitter, barcelona) == "twitter-media-1"
+        assert MediaCache(str(tmp_path)).media_id(mastodon, barcelona) == (
+            "mastodon-media-1"
+        )
+
+        assert len(mastodon.uploads) == len(twitter.uploads) == 1
+        assert json.loads((tmp_path / "media_ids.json").read_text()) == {
+            "mastodon": {
+                "+41.4_+002.2": {"id": "mastodon-media-1", "expires_at": None}
+            },
+            "twitter": {"+41.4_+002.2": {"id": "twitter-media-1", "expires_at": None}},
+        }
+
+    def test_expired_media_are_uploaded_again(self, tmp_path):
+        """Media ids should be reused only until the target expires them."""
+        now = datetime.datetime(2024, 6, 1, 9, tzinfo=datetime.timezone.utc)
+        clock = [now]
+        target = MediaTarget("twitter")
+        target.media_ttl = datetime.timedelta(hours=23)
+        cache = MediaCache(str(tmp_path), now=lambda: clock[0])
+        barcelona = Location(41.4, 2.2)
+
+        assert cache.media_id(target, barcelona) == "twitter-media-1"
+        clock[0] = now + datetime.timedelta(hours=22)
+        assert cache.media_id(target, barcelona) == "twitter-media-1"
+        clock[0] = now + datetime.timedelta(hours=23)
+        assert cache.media_id(target, barcelona) == "twitter-media-2"
+        assert json.loads((tmp_path / "media_ids.json").read_text())["twitter"] == {
+            "+41.4_+002.2": {
+                "id": "twitter-media-2",
+                "expires_at": "2024-06-03T07:00:00+00:00",
+            }
+        }
+
+    def test_single_use_media_are_uploaded_every_time(self, tmp_path):
+        """Targets whose media belong to a single post should not cache ids."""
+        target = MediaTarget("mastodon")
+        target.media_reusable = False
+        cache = MediaCache(str(tmp_path))
+
+        assert cache.media_id(target, Location(41.4, 2.2)) == "mastodon-media-1"
+        assert cache.media_id(target, Location(41.4, 2.2)) == "mastodon-media-2"
+        assert not (tmp_path / "media_ids.json").exists()
+        assert len(list(tmp_path.glob("*.png"))) == 1
+
+    def test_evicted_and_unversioned_media_are_uploaded_again(self, tmp_path):
+        """Rejected ids, and ids cached without their expiry, should be dropped."""
+        (tmp_path / "media_ids.json").write_text(
+            json.dumps({"twitter": {"+41.4_+002.2": "twitter-media-0"}})
+        )
+        target = MediaTarget("twitter")
+        cache = MediaCache(str(tmp_path))
+        barcelona = Location(41.4, 2.2)
+
+        assert cache.media_id(target, barcelona) == "twitter-media-1"
+        cache.evict(target, barcelona)
+        assert cache.media_id(target, barcelona) == "twitter-media-2"
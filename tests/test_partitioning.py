@@ -0,0 +1,167 @@
+"""Tests for the migration to a table partitioned by month."""
+
+import pytest
+
+from psycopg import sql
+
+from almanacbot.partitioning import Migration, create_partitioned_table
+
+
+class FakeConnection:
+    """Connection recording the statements run, answering fetchone in turn."""
+
+    def __init__(self, *results):
+        self.statements = []
+        self.results = list(results)
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def sql(self) -> list:
+        return [statement for statement, _ in self.statements]
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params=None):
+        if isinstance(statement, sql.Composable):
+            statement = statement.as_string()
+        self.connection.statements.append((statement, params))
+
+    def fetchone(self):
+        return self.connection.results.pop(0)
+
+
+class TestCreatePartitionedTable:
+    """Tests for the partitioned ephemeris table."""
+
+    def test_creates_a_partition_per_month(self):
+        """Every month should have its partition, named after the prefix."""
+        connection = FakeConnection()
+
+        create_partitioned_table(
+            connection.cursor(),
+            "almanac",
+            "ephemeris_partitioned",
+            partition_prefix="ephemeris",
+            sequence="almanac.ephemeris_id_seq",
+        )
+
+        table, *partitions, index, trigram_index = connection.sql()
+        assert "nextval('almanac.ephemeris_id_seq'::regclass)" in table
+        assert "primary key (id, month)" in table
+        assert table.endswith("PARTITION BY LIST (month)")
+        assert partitions[0] == (
+            'CREATE TABLE IF NOT EXISTS "almanac"."ephemeris_01" PARTITION OF '
+            '"almanac"."ephemeris_partitioned" FOR VALUES IN (1)'
+        )
+        assert len(partitions) == 12
+        assert "EXTRACT(DAY FROM date)" in index
+        assert trigram_index == (
+            'CREATE INDEX IF NOT EXISTS "idx_ephemeris_partitioned_text_trgm" ON '
+            '"almanac"."ephemeris_partitioned" USING gin (text gin_trgm_ops)'
+        )
+
+
+class TestMigration:
+    """Tests for the online migration steps."""
+
+    def test_mirrors_changes_with_the_utc_month(self):
+        """The trigger should mirror rows with the partition key of the client."""
+        connection = FakeConnection(("almanac.ephemeris_id_seq",))
+
+        Migration(connection, "almanac", "ephemeris").prepare()
+
+        function, trigger = connection.sql()[-2:]
+        assert 'NEW."last_tweeted_at"' in function
+        assert "EXTRACT(MONTH FROM NEW.date AT TIME ZONE 'UTC')::smallint" in function
+        assert "AFTER INSERT OR UPDATE OR DELETE" in trigger
+        assert connection.commits == 1
+
+    def test_partitioned_table_can_find_near_duplicates(self):
+        """The table taking the name should have the trigram index of texts."""
+        connection = FakeConnection(("almanac.ephemeris_id_seq",))
+
+        Migration(connection, "almanac", "ephemeris").prepare()
+
+        assert (
+            'CREATE INDEX IF NOT EXISTS "idx_ephemeris_partitioned_text_trgm" ON '
+            '"almanac"."ephemeris_partitioned" USING gin (text gin_trgm_ops)'
+        ) in connection.sql()
+
+    def test_copies_in_batches(self):
+        """Ids should be copied in ranges of batch_size, one transaction each."""
+        connection = FakeConnection((1, 25))
+        migration = Migration(connection, "almanac", "ephemeris")
+
+        assert list(migration.copy(batch_size=10)) == [(10, 25), (20, 25), (25, 25)]
+        assert [params for _, params in connection.statements[1:]] == [
+            (1, 11),
+            (11, 21),
+            (21, 26),
+        ]
+        assert "FOR SHARE" in connection.statements[1][0]
+        assert connection.commits == 4
+
+    def test_copies_nothing_from_an_empty_table(self):
+        connection = FakeConnection((None, None))
+
+        assert list(Migration(connection, "almanac", "ephemeris").copy()) == []
+
+    def test_switch_checks_the_row_counts(self):
+        """Tables should not be switched when rows are missing."""
+        connection = FakeConnection((10, 9))
+
+        with pytest.raises(ValueError):
+            Migration(connection, "almanac", "ephemeris").switch()
+
+        assert connection.rollbacks == 1
+        assert not any("RENAME" in statement for statement in connection.sql())
+
+    def test_switch_renames_the_tables(self):
+        """The partitioned table should take the name, sequence and triggers."""
+        connection = FakeConnection(
+            (10, 10), ("almanac.ephemeris_id_seq",), (True,), (True,)
+        )
+
+        Migration(connection, "almanac", "ephemeris").switch()
+
+        statements = connection.sql()
+        assert statements[0].startswith('LOCK TABLE "almanac"."ephemeris"')
+        assert (
+            'ALTER TABLE "almanac"."ephemeris" RENAME TO "ephemeris_unpartitioned"'
+            in statements
+        )
+        assert (
+            'ALTER TABLE "almanac"."ephemeris_partitioned" RENAME TO "ephemeris"'
+            in statements
+        )
+        assert (
+            'ALTER SEQUENCE almanac.ephemeris_id_seq OWNED BY "almanac"."ephemeris"."id"'
+            in statements
+        )
+        assert any(
+            statement.startswith('CREATE TRIGGER "ephemeris_notify_today_inserts"')
+            for statement in statements
+        )
+        assert statements[-1] == (
+            'ALTER MATERIALIZED VIEW "almanac"."ephemeris_partitioned_day_stats" '
+            'RENAME TO "ephemeris_day_stats"'
+        )
+        assert connection.commits == 1
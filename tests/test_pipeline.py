@@ -0,0 +1,130 @@
+"""Tests for the acknowledgement pipeline stage."""
+
+import datetime
+import threading
+from unittest.mock import MagicMock
+
+from almanacbot.pipeline import AcknowledgementWriter
+from almanacbot.storage import PostRecord
+
+POSTED_AT = datetime.datetime(2024, 6, 1, 8, tzinfo=datetime.timezone.utc)
+
+
+class TestAcknowledgementWriter:
+    """Tests for the background acknowledgement writer."""
+
+    def test_close_drains_pending_acknowledgements(self):
+        """Every queued id should be written before close returns."""
+        storage = MagicMock()
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=3) as writer:
+            for ephemeris_id in range(7):
+                writer.acknowledge(ephemeris_id)
+
+        written = [
+            ephemeris_id
+            for call in storage.mark_many_as_tweeted.call_args_list
+            for ephemeris_id in call.args[0]
+        ]
+        assert written == list(range(7))
+        assert writer.acknowledged == list(range(7))
+        assert all(
+            len(call.args[0]) <= 3
+            for call in storage.mark_many_as_tweeted.call_args_list
+        )
+
+    def test_batches_acknowledgements_queued_during_a_write(self):
+        """Ids queued while the storage is busy should be written together."""
+        release = threading.Event()
+        storage = MagicMock()
+        storage.mark_many_as_tweeted.side_effect = lambda ids: release.wait(5)
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=10) as writer:
+            writer.acknowledge(1)
+            while storage.mark_many_as_tweeted.call_count == 0:
+                pass
+            for ephemeris_id in (2, 3, 4):
+                writer.acknowledge(ephemeris_id)
+            assert writer.depth == 3
+            release.set()
+
+        assert [
+            call.args[0] for call in storage.mark_many_as_tweeted.call_args_list
+        ] == [
+            [1],
+            [2, 3, 4],
+        ]
+        assert writer.peak_depth == 3
+
+    def test_records_failed_acknowledgements(self):
+        """Storage errors should be recorded instead of killing the writer."""
+        storage = MagicMock()
+        storage.mark_many_as_tweeted.side_effect = [Exception("DB down"), None]
+
+        with AcknowledgementWriter(storage, batch_size=1) as writer:
+            writer.acknowledge(1)
+            writer.acknowledge(2)
+
+        assert writer.failed == [1]
+        assert writer.acknowledged == [2]
+
+    def test_deliveries_are_written_before_acknowledgements(self):
+        """Partial deliveries should be recorded before the final mark."""
+        storage = MagicMock()
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=10) as writer:
+            writer.deliver(1, "twitter")
+            writer.deliver(1, "mastodon")
+            writer.acknowledge(1)
+
+        assert [call[0] for call in storage.method_calls] == [
+            "mark_many_delivered",
+            "mark_many_as_tweeted",
+        ]
+        storage.mark_many_delivered.assert_called_once_with(
+            [(1, "twitter"), (1, "mastodon")]
+        )
+        assert writer.acknowledged == [1]
+
+    def test_posts_are_recorded_in_batches(self):
+        """Posts should be appended to the history in one call per batch."""
+        storage = MagicMock()
+        posts = [
+            PostRecord(1, "twitter", POSTED_AT, 0.2, "11"),
+            PostRecord(1, "mastodon", POSTED_AT, 0.1),
+        ]
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=10) as writer:
+            for record in posts:
+                writer.record(record)
+            writer.acknowledge(1)
+
+        assert [call[0] for call in storage.method_calls] == [
+            "record_posts",
+            "mark_many_as_tweeted",
+        ]
+        storage.record_posts.assert_called_once_with(posts)
+
+    def test_history_failures_do_not_fail_acknowledgements(self):
+        """A history write error should not keep the ephemeris untweeted."""
+        storage = MagicMock()
+        storage.record_posts.side_effect = Exception("DB down")
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=10) as writer:
+            writer.record(PostRecord(1, "twitter", POSTED_AT, 0.2))
+            writer.acknowledge(1)
+
+        assert writer.acknowledged == [1]
+        assert writer.failed == []
+
+    def test_bundles_are_acknowledged_in_one_update(self):
+        """Ids acknowledged together should never be split between updates."""
+        storage = MagicMock()
+
+        with AcknowledgementWriter(storage, queue_size=10, batch_size=2) as writer:
+            writer.acknowledge(1)
+            writer.acknowledge_many([2, 3, 4])
+
+        updates = [call.args[0] for call in storage.mark_many_as_tweeted.call_args_list]
+        assert [update for update in updates if 2 in update][0][-3:] == [2, 3, 4]
+        assert writer.acknowledged == [1, 2, 3, 4]
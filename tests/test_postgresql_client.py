@@ -1,32 +1,33 @@
 """Tests for PostgreSQL client."""
 
 import datetime
+import json
+from typing import List
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from almanacbot.ephemeris import Ephemeris
-from almanacbot.postgresql_client import PostgreSQLClient
+import psycopg
+from psycopg import errors
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+
+from almanacbot import tracing
+from almanacbot.ephemeris import Ephemeris, table_models
+from almanacbot.postgresql_client import PostgreSQLClient, _traced_connect
+from almanacbot.selection import Scoring
 
 
 class TestGetUntweetedTodayEphemeris:
     """Tests for month+day matching and idempotency."""
 
     @pytest.fixture
-    def client(self):
+    def client(self, make_postgresql_client):
         """Create a PostgreSQLClient with mocked engine."""
-        with patch("almanacbot.postgresql_client.create_engine"):
-            client = PostgreSQLClient(
-                user="test",
-                password="test",
-                hostname="localhost",
-                database="test",
-                ephemeris_table="ephemeris",
-                logging_echo=False,
-            )
-            return client
+        return make_postgresql_client()
 
-    def test_returns_ephemeris_matching_today(self, client):
+    def test_returns_ephemeris_matching_today(self, client, mock_session):
         """Should return ephemeris where month+day matches today."""
         now = datetime.datetime.now(datetime.timezone.utc)
         matching_eph = Ephemeris(
@@ -39,26 +40,18 @@ class TestGetUntweetedTodayEphemeris:
             last_tweeted_at=None,
         )
 
-        mock_session = MagicMock()
-        mock_session.__enter__ = MagicMock(return_value=mock_session)
-        mock_session.__exit__ = MagicMock(return_value=False)
         mock_session.scalars.return_value.all.return_value = [matching_eph]
 
-        with patch("almanacbot.postgresql_client.Session", return_value=mock_session):
-            result = client.get_untweeted_today_ephemeris()
+        result = client.get_untweeted_today_ephemeris()
 
         assert len(result) == 1
         assert result[0].id == 1
 
-    def test_returns_empty_when_no_matches(self, client):
+    def test_returns_empty_when_no_matches(self, client, mock_session):
         """Should return empty list when no ephemeris matches today."""
-        mock_session = MagicMock()
-        mock_session.__enter__ = MagicMock(return_value=mock_session)
-        mock_session.__exit__ = MagicMock(return_value=False)
         mock_session.scalars.return_value.all.return_value = []
 
-        with patch("almanacbot.postgresql_client.Session", return_value=mock_session):
-            result = client.get_untweeted_today_ephemeris()
+        result = client.get_untweeted_today_ephemeris()
 
         assert result == []
 
@@ -67,45 +60,28 @@ class TestMarkAsTweeted:
     """Tests for idempotency marking."""
 
     @pytest.fixture
-    def client(self):
+    def client(self, make_postgresql_client):
         """Create a PostgreSQLClient with mocked engine."""
-        with patch("almanacbot.postgresql_client.create_engine"):
-            client = PostgreSQLClient(
-                user="test",
-                password="test",
-                hostname="localhost",
-                database="test",
-                ephemeris_table="ephemeris",
-                logging_echo=False,
-            )
-            return client
+        return make_postgresql_client()
 
-    def test_updates_last_tweeted_at(self, client):
+    def test_updates_last_tweeted_at(self, client, mock_session):
         """Should set last_tweeted_at to current UTC time."""
         mock_eph = MagicMock()
         mock_eph.last_tweeted_at = None
 
-        mock_session = MagicMock()
-        mock_session.__enter__ = MagicMock(return_value=mock_session)
-        mock_session.__exit__ = MagicMock(return_value=False)
         mock_session.get.return_value = mock_eph
 
-        with patch("almanacbot.postgresql_client.Session", return_value=mock_session):
-            client.mark_as_tweeted(1)
+        client.mark_as_tweeted(1)
 
         assert mock_eph.last_tweeted_at is not None
         mock_session.commit.assert_called_once()
 
-    def test_handles_missing_ephemeris(self, client):
+    def test_handles_missing_ephemeris(self, client, mock_session):
         """Should handle non-existent ephemeris ID gracefully."""
-        mock_session = MagicMock()
-        mock_session.__enter__ = MagicMock(return_value=mock_session)
-        mock_session.__exit__ = MagicMock(return_value=False)
         mock_session.get.return_value = None
 
-        with patch("almanacbot.postgresql_client.Session", return_value=mock_session):
-            # Should not raise an exception
-            client.mark_as_tweeted(999)
+        # Should not raise an exception
+        client.mark_as_tweeted(999)
 
         mock_session.commit.assert_not_called()
 
@@ -114,20 +90,11 @@ class TestGetTodayEphemeris:
     """Tests for the get_today_ephemeris method."""
 
     @pytest.fixture
-    def client(self):
+    def client(self, make_postgresql_client):
         """Create a PostgreSQLClient with mocked engine."""
-        with patch("almanacbot.postgresql_client.create_engine"):
-            client = PostgreSQLClient(
-                user="test",
-                password="test",
-                hostname="localhost",
-                database="test",
-                ephemeris_table="ephemeris",
-                logging_echo=False,
-            )
-            return client
+        return make_postgresql_client()
 
-    def test_returns_all_today_ephemeris(self, client):
+    def test_returns_all_today_ephemeris(self, client, mock_session):
         """Should return all ephemeris for today regardless of tweet status."""
         now = datetime.datetime.now(datetime.timezone.utc)
         ephemerides = [
@@ -151,12 +118,468 @@ class TestGetTodayEphemeris:
             ),
         ]
 
+        mock_session.scalars.return_value.all.return_value = ephemerides
+
+        result = client.get_today_ephemeris()
+
+        assert len(result) == 2
+
+
+class TestChannelTables:
+    """Tests for clients of other ephemeris tables and schemas."""
+
+    @pytest.fixture
+    def client(self, make_postgresql_client):
+        """Create a PostgreSQLClient of the london table with mocked engine."""
+        return make_postgresql_client("london", schema="almanac")
+
+    def test_queries_channel_tables(self, client, mock_session):
+        """Ephemeris and companion tables should be named after the channel."""
+        mock_session.scalars.return_value.all.return_value = []
+
+        client.get_untweeted_today_ephemeris()
+        client.claim_due_retries(10, datetime.timedelta(minutes=15))
+
+        ephemeris_query = str(mock_session.scalars.call_args.args[0])
+        retries_query = str(mock_session.execute.call_args.args[0])
+        assert "FROM almanac.london" in ephemeris_query
+        assert "almanac.london_retry_outbox" in retries_query
+
+    def test_rows_are_ephemeris(self):
+        """Rows of channel tables should still be Ephemeris instances."""
+        london, outbox, delivery, history = table_models("london", "almanac")
+
+        assert issubclass(london, Ephemeris)
+        assert london.__table__.fullname == "almanac.london"
+        assert outbox.__table__.fullname == "almanac.london_retry_outbox"
+        assert delivery.__table__.fullname == "almanac.london_delivery"
+        assert history.__table__.fullname == "almanac.london_post_history"
+        assert table_models("london", "almanac")[0] is london
+        assert table_models()[0] is Ephemeris
+
+    def test_today_follows_the_clock(self, make_postgresql_client, mock_session):
+        """Queries should compare dates to the injected clock, not now()."""
+        now = datetime.datetime(2024, 2, 29, 8, tzinfo=datetime.timezone.utc)
+        client = make_postgresql_client(now=lambda: now)
+        mock_session.scalars.return_value.all.return_value = []
+
+        client.get_untweeted_today_ephemeris()
+
+        query, params = mock_session.scalars.call_args.args
+        assert "now()" not in str(query.compile())
+        assert params == {"now": now}
+
+
+class TestCachedStatements:
+    """Tests for the hot statements built once and prepared by psycopg."""
+
+    def test_statements_are_shared_by_clients_of_a_table(self, make_postgresql_client):
+        """Clients of the same table should reuse the same statement objects."""
+        first = make_postgresql_client()
+        second = make_postgresql_client()
+        other = make_postgresql_client("events")
+
+        assert first._statements is second._statements
+        assert other._statements is not first._statements
+
+    def test_sql_does_not_depend_on_the_number_of_ids(
+        self, make_postgresql_client, mock_session
+    ):
+        """Ids should be bound as one array, keeping a single preparable SQL text."""
+        client = make_postgresql_client()
+
+        client.mark_many_as_tweeted([1])
+        client.mark_many_as_tweeted([1, 2, 3])
+
+        (one, one_params), (three, three_params) = [
+            call.args for call in mock_session.execute.call_args_list[::3]
+        ]
+        assert one is three
+        assert "ANY" in str(one.compile(dialect=postgresql.dialect()))
+        assert (one_params["ids"], three_params["ids"]) == ([1], [1, 2, 3])
+
+    def test_top_candidates_are_ranked_by_the_server(
+        self, make_postgresql_client, mock_session
+    ):
+        """Only the limit best rows should be selected, scored with bound weights."""
+        client = make_postgresql_client()
+
+        client.get_top_untweeted_today_ephemeris(5, Scoring(round_bonus=3.0))
+
+        statement, params = mock_session.scalars.call_args.args
+        query = str(statement.compile(dialect=postgresql.dialect()))
+        assert statement is client._statements.top_untweeted_today
+        assert "EXTRACT(MONTH FROM ephemeris.date)" in query
+        assert "ORDER BY %(weight)s * ephemeris.weight" in query
+        assert "NOT (EXISTS (SELECT retry_outbox.ephemeris_id" in query
+        assert query.endswith("LIMIT %(limit)s::INTEGER")
+        assert (params["limit"], params["round_bonus"], params["max_years"]) == (
+            5,
+            3.0,
+            10,
+        )
+
+    def test_due_retries_are_claimed_once(self, make_postgresql_client, mock_session):
+        """Due rows should be locked, skipping locked ones, and leased at once."""
+        now = datetime.datetime(2024, 6, 1, 9, tzinfo=datetime.timezone.utc)
+        client = make_postgresql_client(now=lambda: now)
+        eph = Ephemeris(id=7, date=now, text="Event.")
+        mock_session.execute.return_value.all.return_value = [(eph, 2)]
+
+        (entry,) = client.claim_due_retries(10, datetime.timedelta(minutes=15))
+
+        (select, _), (lease, lease_params) = [
+            call.args for call in mock_session.execute.call_args_list
+        ]
+        assert (entry.ephemeris, entry.attempts) == (eph, 2)
+        assert str(select.compile(dialect=postgresql.dialect())).endswith(
+            "FOR UPDATE OF retry_outbox SKIP LOCKED"
+        )
+        assert lease is client._statements.lease_retries
+        assert lease_params == {
+            "ids": [7],
+            "until": now + datetime.timedelta(minutes=15),
+        }
+        mock_session.commit.assert_called_once()
+
+    def test_prepare_threshold_is_passed_to_psycopg(
+        self, make_postgresql_client, mock_create_engine
+    ):
+        """The prepare threshold should reach psycopg's connections."""
+        make_postgresql_client(prepare_threshold=None)
+
+        assert (
+            mock_create_engine.call_args.kwargs["connect_args"]["prepare_threshold"]
+            is None
+        )
+
+    def test_sessions_are_in_utc(self, make_postgresql_client, mock_create_engine):
+        """Dates should be read in UTC, the time zone of the partition key."""
+        make_postgresql_client()
+
+        assert (
+            mock_create_engine.call_args.kwargs["connect_args"]["options"]
+            == "-c TimeZone=UTC"
+        )
+
+
+class TestDayStats:
+    """Tests for the materialized day statistics."""
+
+    def test_count_reads_the_channel_view(self, make_postgresql_client, mock_session):
+        """Counting should sum the day statistics view of the table."""
+        client = make_postgresql_client("events", schema="almanac")
+        mock_session.execute.return_value.scalar.return_value = 3
+
+        assert client.count_ephemeris() == 3
+
+        query = str(mock_session.execute.call_args.args[0])
+        assert "sum(almanac.events_day_stats.events)" in query
+        assert "count" not in query
+
+    def test_count_without_the_view_counts_the_rows(
+        self, make_postgresql_client, mock_session
+    ):
+        """Tables created before the view, or without it, should still count."""
+        client = make_postgresql_client("events", schema="almanac")
+        mock_session.execute.side_effect = [
+            sqlalchemy.exc.ProgrammingError(
+                "SELECT", {}, errors.UndefinedTable("no events_day_stats")
+            ),
+            MagicMock(scalar_one=MagicMock(return_value=5)),
+        ]
+
+        assert client.count_ephemeris() == 5
+
+        query = str(mock_session.execute.call_args.args[0])
+        assert "count(*)" in query
+        assert "FROM almanac.events" in query
+
+
+class TestInsertListener:
+    """Tests for listening to the notifications of the insert trigger."""
+
+    @pytest.fixture
+    def client(self, make_postgresql_client):
+        client = make_postgresql_client("events", schema="almanac")
+        driver = client.engine.raw_connection.return_value.driver_connection
+        # the table has its notify_today_inserts trigger
+        driver.execute.return_value.fetchone.return_value = (True,)
+        return client
+
+    @staticmethod
+    def listens(driver) -> List[str]:
+        return [
+            call.args[0].as_string()
+            for call in driver.execute.call_args_list
+            if not isinstance(call.args[0], str)
+        ]
+
+    def test_listens_on_a_detached_connection(self, client):
+        """Ids of every pending notification should be returned at once."""
+        connection = client.engine.raw_connection.return_value
+        driver = connection.driver_connection
+        driver.notifies.side_effect = [
+            iter([MagicMock(payload="1,2")]),
+            iter([MagicMock(payload="3")]),
+            iter([]),
+        ]
+
+        listener = client.listen_inserts()
+
+        connection.detach.assert_called_once()
+        assert driver.autocommit is True
+        assert self.listens(driver) == ['LISTEN "almanac.events"']
+        assert listener.wait(5.0) == [1, 2, 3]
+        assert listener.wait(5.0) == []
+        listener.close()
+        connection.close.assert_called_once()
+
+    def test_tables_without_the_trigger_are_not_listened_to(self, client):
+        """A table whose inserts are not notified should not be listened to."""
+        connection = client.engine.raw_connection.return_value
+        connection.driver_connection.execute.return_value.fetchone.return_value = (
+            False,
+        )
+
+        assert client.listen_inserts() is None
+        connection.close.assert_called_once()
+
+    def test_listens_again_after_losing_the_connection(self, client):
+        """A lost connection should be opened again, and LISTEN again."""
+        connection = client.engine.raw_connection.return_value
+        driver = connection.driver_connection
+        driver.notifies.side_effect = [
+            psycopg.OperationalError("server closed the connection"),
+            iter([MagicMock(payload="4")]),
+            iter([]),
+        ]
+        listener = client.listen_inserts()
+
+        with patch("almanacbot.postgresql_client.time.sleep") as sleep:
+            assert listener.wait(5.0) == []
+        sleep.assert_called_once_with(5.0)
+        connection.close.assert_called_once()
+
+        assert listener.wait(5.0) == [4]
+        assert client.engine.raw_connection.call_count == 2
+        assert self.listens(driver) == ['LISTEN "almanac.events"'] * 2
+        listener.close()
+
+
+class TestPartitionedTable:
+    """Tests for the tables list-partitioned on the month of date."""
+
+    @pytest.fixture
+    def client(self, make_postgresql_client):
+        return make_postgresql_client(schema="almanac", partitioned=True)
+
+    def test_today_filters_on_the_partition_key(self, client, make_postgresql_client):
+        """Today's queries should compare the partition key, to prune the others."""
+        for statement in (
+            client._statements.today,
+            client._statements.untweeted_today,
+            client._statements.top_untweeted_today,
+            client._statements.today_counts,
+        ):
+            query = str(statement.compile(dialect=postgresql.dialect()))
+            assert (
+                "almanac.ephemeris.month = "
+                "CAST(EXTRACT(MONTH FROM timezone('UTC', %(now)s::"
+            ) in query
+        assert "month" not in str(make_postgresql_client()._statements.today)
+
+    def test_rows_are_still_ephemeris(self):
+        """The partition key should not be an attribute of the rows."""
+        ephemeris, *_ = table_models("ephemeris", "almanac", True)
+
+        assert issubclass(ephemeris, Ephemeris)
+        assert "month" in ephemeris.__table__.c
+        assert not hasattr(ephemeris, "month")
+        assert table_models("ephemeris", "almanac", True)[0] is ephemeris
+
+    def test_inserts_write_the_utc_month(self, client, mock_session):
+        """The partition key should be the month of date in UTC."""
+        plus_two = datetime.timezone(datetime.timedelta(hours=2))
+
+        client.insert_ephemeris(
+            Ephemeris(date=datetime.datetime(1950, 7, 1, 1, tzinfo=plus_two), text="E")
+        )
+
+        insert = mock_session.execute.call_args.args[0].compile()
+        assert insert.params["month"] == 6
+
+    @pytest.mark.parametrize("partitioned", [True, False])
+    def test_inserts_find_the_table_partitioned(
+        self, make_postgresql_client, mock_session, partitioned
+    ):
+        """Clients not configured as partitioned should follow the catalog."""
+        client = make_postgresql_client(schema="almanac")
+        connection = client.engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.scalar_one.return_value = partitioned
+
+        for _ in range(2):
+            client.insert_ephemeris(
+                Ephemeris(date=datetime.datetime(1950, 7, 1, 1), text="E")
+            )
+
+        assert "relkind = 'p'" in str(connection.execute.call_args.args[0])
+        assert connection.execute.call_args.args[1] == {
+            "table": '"almanac"."ephemeris"'
+        }
+        # a partitioned table stays so, an unpartitioned one may be switched
+        assert connection.execute.call_count == (1 if partitioned else 2)
+        insert = mock_session.execute.call_args.args[0].compile()
+        assert ("month" in insert.params) is partitioned
+
+
+class TestNearDuplicates:
+    """Tests for the near-duplicate review of staged loads."""
+
+    @pytest.fixture
+    def client(self, make_postgresql_client):
+        return make_postgresql_client("events", schema="almanac")
+
+    def test_staging_draws_ids_from_the_table(self, client, executed_sql):
+        """The staging table should copy the columns and the id default."""
+        assert client.create_staging() == "events_staging"
+        assert executed_sql() == [
+            'CREATE UNLOGGED TABLE IF NOT EXISTS "almanac"."events_staging" '
+            '(LIKE "almanac"."events" INCLUDING DEFAULTS)',
+            'TRUNCATE "almanac"."events_staging"',
+        ]
+
+    def test_finds_pairs_of_adjacent_days(self, client, raw_cursor, executed_sql):
+        """Staged rows should be compared to stored and to earlier staged rows."""
+        date = datetime.datetime(1992, 7, 25, tzinfo=datetime.timezone.utc)
+        raw_cursor.fetchall.return_value = [
+            (12, date, "Barcelona Games open", 3, date, "Barcelona Games opened", 0.8)
+        ]
+
+        (duplicate,) = client.find_near_duplicates(0.6)
+
+        assert duplicate.ephemeris_id == 12
+        assert duplicate.duplicate_of == 3
+        assert duplicate.similarity == 0.8
+        index, analyze, threshold, query = executed_sql()
+        assert "USING gin (text gin_trgm_ops)" in index
+        assert "pg_trgm.similarity_threshold" in threshold
+        assert raw_cursor.execute.call_args_list[2].args[1] == ("0.6",)
+        stored, staged = query.split(" UNION ALL ")
+        assert 'JOIN "almanac"."events" AS d ON d.text % s.text' in stored
+        assert 'JOIN "almanac"."events_staging" AS d' in staged
+        assert "d.id < s.id" in staged
+        assert query.count("to_char(s.date, 'MMDD') IN") == 2
+        assert query.count("to_char(d.date, 'MMDD') IN") == 2
+
+    def test_merges_and_drops_the_staging_table(self, client, executed_sql):
+        client.merge_staging()
+
+        assert executed_sql() == [
+            'INSERT INTO "almanac"."events" SELECT * FROM "almanac"."events_staging"',
+            'DROP TABLE "almanac"."events_staging"',
+        ]
+
+
+class TestTracing:
+    """Tests for the spans of connections and client calls."""
+
+    def test_connections_and_calls_are_traced(self, tmp_path):
+        tracing.configure(str(tmp_path / "traces.jsonl"))
+        try:
+            client = PostgreSQLClient(
+                user="test",
+                password="test",
+                hostname="localhost",
+                database="test",
+                ephemeris_table="ephemeris",
+                logging_echo=False,
+            )
+            mock_session = MagicMock()
+            mock_session.__enter__ = MagicMock(return_value=mock_session)
+            with patch(
+                "almanacbot.postgresql_client.Session", return_value=mock_session
+            ):
+                client.mark_as_tweeted(42)
+            tracing.flush()
+        finally:
+            tracing.configure(None)
+
+        assert event.contains(client.engine, "do_connect", _traced_connect)
+        (line,) = (tmp_path / "traces.jsonl").read_text().splitlines()
+        (span,) = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert span["name"] == "postgresql.mark_as_tweeted"
+        assert span["attributes"] == [
+            {"key": "ephemeris_id", "value": {"intValue": "42"}}
+        ]
+
+
+class TestReplica:
+    """Tests for routing reports and exports to a read replica."""
+
+    @pytest.fixture
+    def make_client(self, make_postgresql_client):
+        def make_client(lag=0.0):
+            client = make_postgresql_client(replica=MagicMock(), max_replica_lag=10.0)
+            connection = client.replica.connect.return_value.__enter__.return_value
+            connection.execute.return_value.scalar_one.return_value = lag
+            return client
+
+        return make_client
+
+    @staticmethod
+    def engines(client, *calls) -> list:
         mock_session = MagicMock()
         mock_session.__enter__ = MagicMock(return_value=mock_session)
         mock_session.__exit__ = MagicMock(return_value=False)
-        mock_session.scalars.return_value.all.return_value = ephemerides
+        mock_session.execute.return_value.scalar.return_value = 0
+        with patch(
+            "almanacbot.postgresql_client.Session", return_value=mock_session
+        ) as session:
+            for call in calls:
+                call()
+        return [args.args[0] for args in session.call_args_list]
 
-        with patch("almanacbot.postgresql_client.Session", return_value=mock_session):
-            result = client.get_today_ephemeris()
+    def test_reports_read_from_a_fresh_replica(self, make_client):
+        """Counts should go to the replica, checked once per interval."""
+        client = make_client(lag=0.5)
 
-        assert len(result) == 2
+        engines = self.engines(client, client.count_ephemeris, client.count_ephemeris)
+
+        assert engines == [client.replica, client.replica]
+        client.replica.connect.assert_called_once()
+
+    def test_posting_reads_go_to_the_primary(self, make_client):
+        """Tweet status should never be read from the replica."""
+        client = make_client()
+
+        engines = self.engines(
+            client,
+            client.get_untweeted_today_ephemeris,
+            client.get_today_ephemeris,
+            lambda: client.claim_due_retries(10, datetime.timedelta(minutes=15)),
+        )
+
+        assert engines == [client.engine] * 3
+        client.replica.connect.assert_not_called()
+
+    def test_lagging_replica_falls_back_to_the_primary(self, make_client):
+        client = make_client(lag=60.0)
+
+        assert self.engines(client, client.count_ephemeris) == [client.engine]
+
+    def test_unreachable_replica_falls_back_to_the_primary(self, make_client):
+        client = make_client()
+        client.replica.connect.side_effect = sqlalchemy.exc.OperationalError(
+            "SELECT 1", {}, Exception("could not connect")
+        )
+
+        assert self.engines(client, client.count_ephemeris) == [client.engine]
+
+    def test_exports_stream_from_the_replica(self, make_client):
+        client = make_client()
+
+        client.copy_ephemeris_csv_to(MagicMock())
+
+        client.replica.raw_connection.assert_called_once()
+        client.engine.raw_connection.assert_not_called()
@@ -0,0 +1,539 @@
+"""Tests for the fan-out publisher and its targets, against local fake endpoints."""
+
+import datetime
+import http.server
+import json
+import threading
+import urllib.parse
+from unittest.mock import patch
+
+import pytest
+import requests
+from babel import Locale
+
+from almanacbot.ephemeris import Ephemeris, Location
+from almanacbot.maps import MediaCache
+from almanacbot.publisher import (
+    FanOutPublisher,
+    MastodonTarget,
+    PublishTarget,
+    WebhookTarget,
+    create_target,
+    pack,
+    render_text,
+)
+
+CATALAN = Locale.parse("ca_ES")
+ENGLISH = Locale.parse("en_GB")
+
+
+class FakeTarget(PublishTarget):
+    """Target recording posts, optionally failing or waiting for an event."""
+
+    def __init__(self, name, locale=CATALAN, fail=(), wait_for=None, **kwargs):
+        super().__init__(name, locale, **kwargs)
+        self.posts = []
+        self.replies = []
+        self._fail = set(fail)
+        self._wait_for = wait_for
+
+    def post(self, text, key, reply_to=None):
+        if self._wait_for is not None:
+            assert self._wait_for.wait(5)
+        if text in self._fail:
+            raise ConnectionError(f"{self.name} is down")
+        self.posts.append(text)
+        self.replies.append(reply_to)
+        return f"{self.name}-{len(self.posts)}"
+
+
+class MediaTarget(FakeTarget):
+    """Target recording the media uploaded and attached to its posts."""
+
+    def __init__(self, name, fail_uploads=False, rejected=(), **kwargs):
+        super().__init__(name, **kwargs)
+        self.uploads = []
+        self.media = []
+        self._fail_uploads = fail_uploads
+        self._rejected = set(rejected)
+
+    def post(self, text, key, reply_to=None, media_ids=()):
+        self.media.append(list(media_ids))
+        if self._rejected.intersection(media_ids):
+            raise ValueError(f"{self.name} rejects media {list(media_ids)}")
+        return super().post(text, key, reply_to)
+
+    def rejects_media(self, exc):
+        return isinstance(exc, ValueError)
+
+    def upload_media(self, image, mime_type, description):
+        if self._fail_uploads:
+            raise ConnectionError(f"{self.name} rejects media")
+        self.uploads.append((image, mime_type))
+        return f"{self.name}-media-{len(self.uploads)}"
+
+
+class FakeEndpoint(http.server.BaseHTTPRequestHandler):
+    """Local HTTP endpoint accepting posts, answering with the status and body."""
+
+    requests = []
+    status = 200
+    body = b"{}"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).requests.append((self.path, dict(self.headers), body))
+        self.send_response(type(self).status)
+        self.send_header("Content-Length", str(len(type(self).body)))
+        self.end_headers()
+        self.wfile.write(type(self).body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    """Serve FakeEndpoint on a free local port."""
+    FakeEndpoint.requests = []
+    FakeEndpoint.status = 200
+    FakeEndpoint.body = b"{}"
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeEndpoint)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def make_ephemeris(count: int) -> list:
+    return [
+        Ephemeris(
+            id=eph_id,
+            date=datetime.datetime(
+                1950, 6, eph_id, 12, 0, tzinfo=datetime.timezone.utc
+            ),
+            text=f"Event {eph_id}, ${{date}}.",
+        )
+        for eph_id in range(1, count + 1)
+    ]
+
+
+def publish(publisher, ephemeris, delivered=None, dry_run=False, threads=None):
+    """Run a publication, returning the deliveries and completions reported."""
+    deliveries, completions = [], {}
+    publisher.publish(
+        ephemeris,
+        delivered or {},
+        lambda eph, post: deliveries.append((eph.id, post.target)),
+        lambda results: completions.update((eph.id, errors) for eph, errors in results),
+        dry_run=dry_run,
+        threads=threads,
+    )
+    return deliveries, completions
+
+
+def short_ephemeris(*texts) -> list:
+    return [
+        Ephemeris(id=eph_id, date=datetime.datetime(1950, 6, 1), text=text)
+        for eph_id, text in enumerate(texts, start=1)
+    ]
+
+
+class TestPack:
+    """Tests for packing texts into the fewest posts."""
+
+    def test_fills_each_post_in_order(self):
+        """Texts should be added to the current post while they fit."""
+        assert pack(["a" * 100, "b" * 100, "c" * 100, "d" * 50], 280) == [
+            [0, 1],
+            [2, 3],
+        ]
+
+    def test_counts_the_separator(self):
+        """The separator between texts should count towards the limit."""
+        assert pack(["a" * 139, "b" * 139], 279) == [[0], [1]]
+        assert pack(["a" * 139, "b" * 139], 280) == [[0, 1]]
+
+    def test_long_texts_are_posted_alone(self):
+        """A text over the limit should get a post of its own."""
+        assert pack(["a" * 10, "b" * 300, "c" * 10], 280) == [[0], [1], [2]]
+
+
+class TestBundling:
+    """Tests for targets packing the ephemeris of a run into fewer posts."""
+
+    def test_digest_posts_fit_the_limit(self):
+        """A digest target should post as many ephemeris per post as fit."""
+        target = FakeTarget("digest", bundle="digest", max_length=14)
+        calls = []
+
+        FanOutPublisher([target]).publish(
+            short_ephemeris("One.", "Two.", "Three.", "Four."),
+            {},
+            lambda eph, post: None,
+            calls.append,
+        )
+
+        assert target.posts == ["One.\n\nTwo.", "Three.\n\nFour."]
+        assert target.replies == [None, None]
+        # ephemeris completed by the same post are reported together
+        assert [[eph.id for eph, _ in results] for results in calls] == [[1, 2], [3, 4]]
+
+    def test_thread_posts_reply_to_each_other(self):
+        """A thread target should chain its posts from the given head."""
+        target = FakeTarget("thread", bundle="thread", max_length=10)
+
+        deliveries, completions = publish(
+            FanOutPublisher([target]),
+            short_ephemeris("One.", "Two.", "Three."),
+            threads={"thread": "head"},
+        )
+
+        assert target.posts == ["One.\n\nTwo.", "Three."]
+        assert target.replies == ["head", "thread-1"]
+        assert completions == {1: {}, 2: {}, 3: {}}
+
+    def test_failure_breaks_the_thread(self):
+        """Posts after a failed one should be left to the retries."""
+        target = FakeTarget("thread", bundle="thread", max_length=4, fail={"Two."})
+
+        deliveries, completions = publish(
+            FanOutPublisher([target]), short_ephemeris("One.", "Two.", "Six.")
+        )
+
+        assert target.posts == ["One."]
+        assert deliveries == [(1, "thread")]
+        assert completions[1] == {}
+        assert isinstance(completions[2]["thread"], ConnectionError)
+        assert completions[3]["thread"] is completions[2]["thread"]
+
+    def test_rejects_unknown_modes(self):
+        """Targets should only accept the known bundle modes."""
+        with pytest.raises(ValueError):
+            FakeTarget("twitter", bundle="carousel")
+
+
+class TestFanOutPublisher:
+    """Tests for the concurrent publication to every target."""
+
+    def test_posts_to_every_target_in_its_locale(self):
+        """Each target should get every ephemeris rendered in its locale."""
+        catalan, english = FakeTarget("ca"), FakeTarget("en", locale=ENGLISH)
+
+        deliveries, completions = publish(
+            FanOutPublisher([catalan, english]), make_ephemeris(2)
+        )
+
+        assert catalan.posts == [
+            "Event 1, dijous, 1 de juny del 1950.",
+            "Event 2, divendres, 2 de juny del 1950.",
+        ]
+        assert english.posts == [
+            "Event 1, Thursday, 1 June 1950.",
+            "Event 2, Friday, 2 June 1950.",
+        ]
+        assert sorted(deliveries) == [(1, "ca"), (1, "en"), (2, "ca"), (2, "en")]
+        assert completions == {1: {}, 2: {}}
+
+    def test_slow_target_does_not_delay_the_others(self):
+        """A blocked target should not stop the others from posting."""
+        unblock = threading.Event()
+        fast = FakeTarget("fast")
+        slow = FakeTarget("slow", wait_for=unblock)
+        completions = {}
+
+        def on_delivery(eph, post):
+            if post.target == "fast" and len(fast.posts) == 3:
+                unblock.set()
+
+        FanOutPublisher([fast, slow]).publish(
+            make_ephemeris(3),
+            {},
+            on_delivery,
+            lambda results: completions.update(
+                (eph.id, errors) for eph, errors in results
+            ),
+        )
+
+        assert len(fast.posts) == len(slow.posts) == 3
+        assert completions == {1: {}, 2: {}, 3: {}}
+
+    def test_failures_are_reported_per_target(self):
+        """An ephemeris should complete with the errors of its failed targets."""
+        up = FakeTarget("up")
+        down = FakeTarget("down", fail={"Event 1, dijous, 1 de juny del 1950."})
+
+        deliveries, completions = publish(
+            FanOutPublisher([up, down]), make_ephemeris(2)
+        )
+
+        assert sorted(deliveries) == [(1, "up"), (2, "down"), (2, "up")]
+        assert list(completions[1]) == ["down"]
+        assert isinstance(completions[1]["down"], ConnectionError)
+        assert completions[2] == {}
+
+    def test_skips_targets_already_delivered(self):
+        """Retries should only go to the targets that have not been reached."""
+        done, pending = FakeTarget("done"), FakeTarget("pending")
+
+        deliveries, completions = publish(
+            FanOutPublisher([done, pending]), make_ephemeris(1), {1: {"done"}}
+        )
+
+        assert done.posts == []
+        assert len(pending.posts) == 1
+        assert deliveries == [(1, "pending")]
+        assert completions == {1: {}}
+
+    def test_deliveries_carry_post_records(self):
+        """Deliveries should report the post id, time and latency of the post."""
+        clock = [0.0]
+        now = datetime.datetime(2024, 6, 1, 8, tzinfo=datetime.timezone.utc)
+
+        class SlowTarget(FakeTarget):
+            def post(self, text, key, reply_to=None):
+                clock[0] += 0.25
+                return super().post(text, key, reply_to)
+
+        records = []
+        FanOutPublisher(
+            [SlowTarget("slow")], clock=lambda: clock[0], now=lambda: now
+        ).publish(
+            make_ephemeris(2),
+            {},
+            lambda eph, post: records.append(post),
+            lambda results: None,
+        )
+
+        assert [(post.ephemeris_id, post.post_id) for post in records] == [
+            (1, "slow-1"),
+            (2, "slow-2"),
+        ]
+        assert {(post.target, post.posted_at, post.latency) for post in records} == {
+            ("slow", now, 0.25)
+        }
+
+    def test_rate_budget_spaces_posts(self):
+        """Posts of a target should be at least min_interval seconds apart."""
+        clock = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        target = FakeTarget("limited", min_interval=60)
+        publisher = FanOutPublisher([target], sleep=sleep, clock=lambda: clock[0])
+
+        publish(publisher, make_ephemeris(3))
+
+        assert sleeps == [60, 60]
+
+    def test_dry_run_posts_nothing(self):
+        """Dry runs should complete every ephemeris without posting."""
+        target = FakeTarget("twitter")
+
+        _, completions = publish(
+            FanOutPublisher([target]), make_ephemeris(2), dry_run=True
+        )
+
+        assert target.posts == []
+        assert completions == {1: {}, 2: {}}
+
+    def test_rejects_duplicate_target_names(self):
+        """Target names identify deliveries, so they must be unique."""
+        with pytest.raises(ValueError):
+            FanOutPublisher([FakeTarget("twitter"), FakeTarget("twitter")])
+
+
+class TestMaps:
+    """Tests for the locator maps attached to posts."""
+
+    @staticmethod
+    def located(*locations) -> list:
+        ephemeris = make_ephemeris(len(locations))
+        for eph, location in zip(ephemeris, locations):
+            eph.location = location
+        return ephemeris
+
+    def test_maps_are_uploaded_once_per_place(self, tmp_path):
+        """Ephemeris of the same rounded place should share one upload."""
+        target = MediaTarget("mastodon")
+        publisher = FanOutPublisher([target], media=MediaCache(str(tmp_path)))
+
+        publish(
+            publisher,
+            self.located(Location(41.387, 2.17), Location(41.39, 2.168), None),
+        )
+
+        assert len(target.uploads) == 1
+        assert target.uploads[0][1] == "image/png"
+        assert target.media == [["mastodon-media-1"], ["mastodon-media-1"], []]
+
+    def test_targets_without_maps_post_text(self, tmp_path):
+        """Targets without media support or with maps off should get no map."""
+        plain = FakeTarget("webhook")
+        disabled = MediaTarget("twitter", maps=False)
+        publisher = FanOutPublisher([plain, disabled], media=MediaCache(str(tmp_path)))
+
+        _, completions = publish(publisher, self.located(Location(41.4, 2.2)))
+
+        assert completions == {1: {}}
+        assert disabled.uploads == [] and disabled.media == [[]]
+
+    def test_digests_go_without_maps(self, tmp_path):
+        """A post of several ephemeris has no single place to locate."""
+        target = MediaTarget("mastodon", bundle="digest")
+        publisher = FanOutPublisher([target], media=MediaCache(str(tmp_path)))
+
+        publish(publisher, self.located(Location(41.4, 2.2), Location(51.5, -0.1)))
+
+        assert target.uploads == [] and target.media == [[]]
+
+    def test_rejected_maps_are_uploaded_again(self, tmp_path):
+        """A cached media the target rejects should be replaced, once."""
+        target = MediaTarget("twitter", rejected={"twitter-media-1"})
+        media = MediaCache(str(tmp_path))
+        publisher = FanOutPublisher([target], media=media)
+
+        _, completions = publish(
+            publisher, self.located(Location(41.4, 2.2), Location(41.4, 2.2))
+        )
+
+        assert completions == {1: {}, 2: {}}
+        assert target.media == [
+            ["twitter-media-1"],
+            ["twitter-media-2"],
+            ["twitter-media-2"],
+        ]
+        assert len(target.posts) == 2
+
+    def test_failed_uploads_post_without_the_map(self, tmp_path):
+        """Maps are best effort and should never hold a post back."""
+        target = MediaTarget("mastodon", fail_uploads=True)
+        publisher = FanOutPublisher([target], media=MediaCache(str(tmp_path)))
+
+        _, completions = publish(publisher, self.located(Location(41.4, 2.2)))
+
+        assert completions == {1: {}}
+        assert target.media == [[]]
+
+
+class TestRenderText:
+    """Tests for the rendering of ephemeris texts."""
+
+    def test_renders_only_the_placeholders_found_at_ingest(self):
+        """Placeholders analyzed at ingest should be the only ones computed."""
+        eph = make_ephemeris(1)[0]
+        eph.text = "Fa ${years_ago} anys, $$5."
+        eph.placeholders = "years_ago"
+
+        with patch("almanacbot.publisher.format_date") as format_date:
+            text = render_text(eph, CATALAN, datetime.date(2000, 6, 1))
+
+        format_date.assert_not_called()
+        assert text == "Fa 50 anys, $5."
+
+    def test_static_texts_are_returned_as_they_are(self):
+        """Texts without placeholders should not go through a template."""
+        eph = make_ephemeris(1)[0]
+        eph.text, eph.placeholders = "Event.", ""
+
+        with patch("almanacbot.publisher.string.Template") as template:
+            assert render_text(eph, CATALAN, datetime.date(2000, 6, 1)) == "Event."
+
+        template.assert_not_called()
+
+
+class TestHttpTargets:
+    """Tests for the HTTP publishing targets."""
+
+    def test_mastodon_posts_status(self, endpoint):
+        """Mastodon targets should post a status with an idempotency key."""
+        target = MastodonTarget("mastodon", CATALAN, endpoint, access_token="secret")
+
+        target.post("Hola!", key="almanac-1-20240601")
+
+        path, headers, body = FakeEndpoint.requests[0]
+        assert path == "/api/v1/statuses"
+        assert headers["Authorization"] == "Bearer secret"
+        assert headers["Idempotency-Key"] == "almanac-1-20240601"
+        assert urllib.parse.parse_qs(body.decode()) == {"status": ["Hola!"]}
+
+    def test_mastodon_attaches_uploaded_media(self, endpoint):
+        """Media should be uploaded to the media API and attached by id."""
+        FakeEndpoint.body = b'{"id": "108"}'
+        target = MastodonTarget("mastodon", CATALAN, endpoint, access_token="secret")
+
+        media_id = target.upload_media(b"\x89PNG", "image/png", "Map of Barcelona")
+        target.post("Hola!", key="almanac-1-20240601", media_ids=[media_id])
+
+        (upload_path, headers, upload), (_, _, body) = FakeEndpoint.requests
+        assert media_id == "108"
+        assert upload_path == "/api/v2/media"
+        assert headers["Authorization"] == "Bearer secret"
+        assert headers["Content-Type"].startswith("multipart/form-data")
+        assert b"Map of Barcelona" in upload and b"\x89PNG" in upload
+        assert urllib.parse.parse_qs(body.decode())["media_ids[]"] == ["108"]
+        assert target.supports_media
+        assert not WebhookTarget("bridge", CATALAN, endpoint).supports_media
+
+    def test_mastodon_rejects_unknown_media(self, endpoint):
+        """Media ids failing the status validation should be told apart."""
+        FakeEndpoint.status = 422
+        target = MastodonTarget("mastodon", CATALAN, endpoint, access_token="secret")
+
+        with pytest.raises(requests.HTTPError) as rejected:
+            target.post("Hola!", key="almanac-1-20240601", media_ids=["108"])
+
+        assert target.rejects_media(rejected.value)
+        assert not target.rejects_media(ConnectionError("down"))
+        # statuses own their media, which are uploaded for each one
+        assert not target.media_reusable
+
+    def test_webhook_posts_json(self, endpoint):
+        """Webhook targets should post the text and key as JSON."""
+        target = WebhookTarget("bridge", CATALAN, f"{endpoint}/posts")
+
+        target.post("Hola!", key="almanac-1-20240601")
+
+        path, headers, body = FakeEndpoint.requests[0]
+        assert path == "/posts"
+        assert "Authorization" not in headers
+        assert json.loads(body) == {
+            "text": "Hola!",
+            "idempotency_key": "almanac-1-20240601",
+        }
+
+    def test_http_errors_raise(self, endpoint):
+        """Error responses should raise, to be classified for retries."""
+        FakeEndpoint.status = 503
+        target = WebhookTarget("bridge", CATALAN, endpoint)
+
+        with pytest.raises(requests.HTTPError):
+            target.post("Hola!", key="")
+
+    def test_create_target(self, endpoint):
+        """Targets should be created from their configuration section."""
+        target = create_target(
+            {
+                "name": "mastodon-es",
+                "type": "mastodon",
+                "locale": "es_ES",
+                "min_interval": 30.0,
+                "base_url": endpoint,
+                "access_token": "secret",
+            }
+        )
+
+        assert isinstance(target, MastodonTarget)
+        assert (target.name, str(target.locale), target.min_interval) == (
+            "mastodon-es",
+            "es_ES",
+            30.0,
+        )
+        with pytest.raises(ValueError):
+            create_target({"type": "fax", "locale": "es_ES", "name": "fax"})
@@ -0,0 +1,91 @@
+"""Tests for the retry policies of failed posts."""
+
+import datetime
+from unittest.mock import MagicMock
+
+import requests
+import tweepy
+
+from almanacbot import retry
+
+NOW = datetime.datetime(2024, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+def http_error(exc_type: type, status_code: int, **kwargs) -> tweepy.HTTPException:
+    response = MagicMock(status_code=status_code, reason="Error")
+    response.json.return_value = {}
+    return exc_type(response, **kwargs)
+
+
+class TestClassify:
+    """Tests for the classification of posting errors."""
+
+    def test_transient_errors_are_retried(self):
+        """Rate limits, server and network errors should be retried."""
+        assert retry.classify(http_error(tweepy.TooManyRequests, 429)) is not None
+        assert retry.classify(http_error(tweepy.TwitterServerError, 503)) is not None
+        assert retry.classify(requests.ConnectionError()) is not None
+
+    def test_client_errors_are_permanent(self):
+        """Client errors, e.g. duplicate content, should not be retried."""
+        assert retry.classify(http_error(tweepy.Forbidden, 403)) is None
+        assert retry.classify(http_error(tweepy.BadRequest, 400)) is None
+
+    def test_http_errors_are_classified_by_status(self):
+        """Errors of raise_for_status() should be retried as tweepy's are."""
+
+        def status_error(status_code: int) -> requests.HTTPError:
+            response = requests.Response()
+            response.status_code = status_code
+            return requests.HTTPError(f"{status_code} Error", response=response)
+
+        assert retry.classify(status_error(429)) == retry.RATE_LIMIT_POLICY
+        assert retry.classify(status_error(502)) == retry.SERVER_ERROR_POLICY
+        for status_code in (401, 403, 404, 422):
+            assert retry.classify(status_error(status_code)) is None
+
+
+class TestNextAttemptAt:
+    """Tests for the exponential backoff with jitter."""
+
+    def test_backoff_grows_exponentially_within_jitter_bounds(self):
+        """Delays should double per attempt, between half and the full delay."""
+        exc = requests.Timeout()
+        policy = retry.classify(exc)
+
+        for attempts in (1, 2, 3):
+            delay = policy.base_delay * 2 ** (attempts - 1)
+            earliest = retry.next_attempt_at(exc, attempts, NOW, rand=lambda: 0.0)
+            latest = retry.next_attempt_at(exc, attempts, NOW, rand=lambda: 1.0)
+
+            assert earliest == NOW + datetime.timedelta(seconds=delay / 2)
+            assert latest == NOW + datetime.timedelta(seconds=delay)
+
+    def test_backoff_is_capped(self):
+        """Delays should never exceed the policy maximum."""
+        exc = http_error(tweepy.TwitterServerError, 500)
+        policy = retry.classify(exc)
+
+        retry_at = retry.next_attempt_at(exc, 9, NOW, rand=lambda: 1.0)
+
+        assert retry_at == NOW + datetime.timedelta(seconds=policy.max_delay)
+
+    def test_rate_limits_wait_for_reset(self):
+        """Rate limited posts should not be retried before the limit resets."""
+        reset_at = NOW + datetime.timedelta(hours=1)
+        exc = http_error(
+            tweepy.TooManyRequests, 429, reset_time=int(reset_at.timestamp())
+        )
+
+        assert retry.next_attempt_at(exc, 1, NOW) == reset_at
+
+    def test_gives_up_after_max_attempts(self):
+        """No retry should be scheduled once the attempts are exhausted."""
+        exc = requests.Timeout()
+        policy = retry.classify(exc)
+
+        assert retry.next_attempt_at(exc, policy.max_attempts, NOW) is None
+
+    def test_permanent_errors_are_not_retried(self):
+        """Permanent errors should not get a next attempt."""
+        assert retry.next_attempt_at(http_error(tweepy.Forbidden, 403), 1, NOW) is None
@@ -0,0 +1,156 @@
+"""Tests for the staggered posting schedule."""
+
+import datetime
+
+import pytest
+
+from almanacbot.clock import SimulatedClock
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.scheduler import PostingSchedule, PostingWindow, parse_windows
+from almanacbot.selection import Scoring
+
+UTC = datetime.timezone.utc
+
+
+def make_storage(now: datetime.datetime, count: int, year: int = 1901):
+    """Memory storage of count ephemeris of the day of now, on a clock."""
+    clock = SimulatedClock(now)
+    storage = MemoryStorage(
+        [(now.replace(year=year, hour=12), "Event.", None)] * count, now=clock
+    )
+    return storage, clock
+
+
+def post(storage, clock, planned, at: datetime.datetime) -> None:
+    """Mark the planned ephemeris as tweeted at the time given."""
+    clock.now = at
+    storage.mark_many_as_tweeted([eph.id for eph in planned])
+
+
+class TestParseWindows:
+    """Tests for the posting windows configuration."""
+
+    def test_parses_sorted_windows(self):
+        """Windows should be parsed and sorted by start time."""
+        windows = parse_windows("13:00-15:00/5, 08:00-10:30/10")
+
+        assert windows == [
+            PostingWindow(datetime.time(8), datetime.time(10, 30), 10),
+            PostingWindow(datetime.time(13), datetime.time(15), 5),
+        ]
+
+    def test_empty_value_has_no_windows(self):
+        """An empty value should disable the schedule."""
+        assert parse_windows("") == []
+
+    @pytest.mark.parametrize(
+        "value",
+        [
+            "08:00-10:00",
+            "10:00-08:00/5",
+            "08:00-10:00/0",
+            "08:00-10:00/5,09:00-11:00/5",
+        ],
+    )
+    def test_rejects_invalid_windows(self, value):
+        """Malformed, reversed, empty and overlapping windows should raise."""
+        with pytest.raises(ValueError):
+            parse_windows(value)
+
+
+class TestPostingSchedule:
+    """Tests for the selection of the ephemeris to post on each run."""
+
+    schedule = PostingSchedule(parse_windows("08:00-10:00/4"), timezone="UTC")
+
+    def test_without_windows_posts_everything(self):
+        """Without windows nor daily cap every untweeted ephemeris is posted."""
+        now = datetime.datetime(2024, 6, 1, 11, 0, tzinfo=UTC)
+        storage, _ = make_storage(now, 50)
+
+        planned = PostingSchedule().plan(storage, now, exclude={7})
+
+        assert len(planned) == 49 and 7 not in [eph.id for eph in planned]
+
+    def test_nothing_posted_outside_windows(self):
+        """No ephemeris should be posted outside the windows."""
+        now = datetime.datetime(2024, 6, 1, 11, 0, tzinfo=UTC)
+
+        assert self.schedule.plan(make_storage(now, 3)[0], now) == []
+
+    def test_cap_is_released_evenly(self):
+        """Each run should post the share of the window elapsed so far."""
+        start = datetime.datetime(2024, 6, 1, 8, 0, tzinfo=UTC)
+        storage, clock = make_storage(start, 10)
+
+        posted_per_run = []
+        for minutes in range(0, 120, 10):
+            now = start + datetime.timedelta(minutes=minutes)
+            clock.now = now
+            planned = self.schedule.plan(storage, now)
+            post(storage, clock, planned, now)
+            posted_per_run.append(len(planned))
+
+        assert posted_per_run == [1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0]
+
+    def test_posts_of_previous_windows_are_not_counted(self):
+        """Only the posts made in the open window should count for its cap."""
+        now = datetime.datetime(2024, 6, 1, 9, 59, tzinfo=UTC)
+        storage, clock = make_storage(now, 10)
+        earlier = datetime.datetime(2024, 6, 1, 7, 0, tzinfo=UTC)
+        post(storage, clock, storage.get_today_ephemeris()[:5], earlier)
+        clock.now = now
+
+        assert len(self.schedule.plan(storage, now)) == 4
+
+    def test_windows_are_local_time(self):
+        """Windows should be matched in the schedule timezone."""
+        schedule = PostingSchedule(
+            parse_windows("08:00-10:00/4"), timezone="Europe/Madrid"
+        )
+        summer_morning = datetime.datetime(2024, 6, 1, 6, 0, tzinfo=UTC)
+
+        assert (
+            len(schedule.plan(make_storage(summer_morning, 3)[0], summer_morning)) == 1
+        )
+
+    def test_round_anniversaries_first(self):
+        """Round anniversaries should be posted before the other events."""
+        now = datetime.datetime(2024, 6, 1, 9, 59, tzinfo=UTC)
+        storage, _ = make_storage(now, 3, year=1901)
+        storage.copy_ephemeris([(now.replace(year=1974), "Fifty years ago.", None)])
+
+        planned = self.schedule.plan(storage, now)
+
+        assert [eph.id for eph in planned] == [4, 1, 2, 3]
+
+    def test_excluded_ephemeris_are_not_planned(self):
+        """Due retries are posted anyway, so they should not take a slot."""
+        now = datetime.datetime(2024, 6, 1, 9, 59, tzinfo=UTC)
+        storage, _ = make_storage(now, 6)
+
+        planned = self.schedule.plan(storage, now, exclude={1, 2})
+
+        assert [eph.id for eph in planned] == [3, 4, 5, 6]
+
+    def test_daily_cap_posts_the_best_scored(self):
+        """Without windows, the daily cap should keep the best of the day."""
+        now = datetime.datetime(2024, 6, 1, 9, 0, tzinfo=UTC)
+        storage, clock = make_storage(now, 5, year=1990)
+        storage.copy_ephemeris([(now.replace(year=1999), "Round.", None)])
+        schedule = PostingSchedule(daily_cap=2, scoring=Scoring(round_bonus=5))
+
+        planned = schedule.plan(storage, now)
+        post(storage, clock, planned, now)
+
+        assert [eph.id for eph in planned] == [6, 1]
+        assert schedule.plan(storage, now + datetime.timedelta(hours=1)) == []
+
+    def test_rejects_negative_daily_cap(self):
+        with pytest.raises(ValueError):
+            PostingSchedule(daily_cap=-1)
+
+    def test_rejects_unknown_timezone(self):
+        """An unknown timezone should raise ValueError."""
+        with pytest.raises(ValueError):
+            PostingSchedule(timezone="Mars/Olympus_Mons")
@@ -0,0 +1,84 @@
+"""Tests for the weighted selection of a day's ephemeris."""
+
+import datetime
+import random
+
+from almanacbot.ephemeris import Ephemeris
+from almanacbot.selection import Scoring, top
+
+UTC = datetime.timezone.utc
+TODAY = datetime.date(2024, 6, 1)
+
+
+def candidate(eph_id, year, posted_year=None, weight=1.0) -> Ephemeris:
+    return Ephemeris(
+        id=eph_id,
+        date=datetime.datetime(year, 6, 1, 12, tzinfo=UTC),
+        text="Event.",
+        last_tweeted_at=(
+            None
+            if posted_year is None
+            else datetime.datetime(posted_year, 6, 1, 9, tzinfo=UTC)
+        ),
+        weight=weight,
+    )
+
+
+class TestScoring:
+    """Tests for the terms of the score."""
+
+    def test_sums_weight_rotation_and_round_anniversaries(self):
+        scoring = Scoring(weight=2.0, per_year=1.0, max_years=10, round_bonus=5.0)
+
+        assert scoring.score(1.0, 1950, 2021, 2024) == 2.0 + 3.0
+        assert scoring.score(1.0, 1974, 2021, 2024) == 2.0 + 3.0 + 5.0
+        assert scoring.score(3.0, 1950, None, 2024) == 6.0 + 10.0
+        assert scoring.score(1.0, 1950, 1990, 2024) == 2.0 + 10.0
+
+    def test_this_years_events_are_not_round(self):
+        assert Scoring().score(1.0, 2024, None, 2024) == Scoring().score(
+            1.0, 2023, None, 2024
+        )
+
+
+class TestTop:
+    """Tests for the selection of the best candidates."""
+
+    def test_rotates_the_events_posted_lately(self):
+        """Last year's winners should give way to events not posted since."""
+        candidates = [
+            candidate(1, 1900, posted_year=2023),
+            candidate(2, 1910, posted_year=2023),
+            candidate(3, 1920, posted_year=2019),
+            candidate(4, 1930),
+        ]
+
+        assert [eph.id for eph in top(candidates, 2, Scoring(), TODAY)] == [4, 3]
+
+    def test_weights_and_round_anniversaries_win(self):
+        candidates = [
+            candidate(1, 1900),
+            candidate(2, 1999),
+            candidate(3, 1950, weight=20.0),
+        ]
+
+        assert [eph.id for eph in top(candidates, 3, Scoring(), TODAY)] == [3, 2, 1]
+
+    def test_matches_a_full_sort(self):
+        """The bounded heap should pick what sorting every candidate picks."""
+        generator = random.Random(49)
+        candidates = [
+            candidate(
+                eph_id,
+                generator.randint(1800, 2023),
+                generator.choice([None, *range(2010, 2024)]),
+                generator.choice([0.5, 1.0, 2.0]),
+            )
+            for eph_id in range(5000)
+        ]
+        scoring = Scoring()
+
+        assert (
+            top(candidates, 20, scoring, TODAY)
+            == sorted(candidates, key=lambda eph: scoring.rank(eph, TODAY.year))[:20]
+        )
@@ -0,0 +1,111 @@
+"""Tests for the time-travel simulation of daily runs."""
+
+import datetime
+
+import pytest
+from babel import Locale
+
+from almanacbot.almanacbot import AlmanacBot, Channel
+from almanacbot.clock import SimulatedClock
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.publisher import FanOutPublisher
+from almanacbot.simulator import CountingTarget, random_corpus, simulate
+
+UTC = datetime.timezone.utc
+
+
+def simulated_bot(rows, clock):
+    target = CountingTarget("simulated", Locale.parse("ca_ES"))
+    storage = MemoryStorage(rows, now=clock)
+    bot = AlmanacBot.from_channels(
+        [Channel("simulated", storage, FanOutPublisher([target], now=clock))],
+        now=clock,
+    )
+    return bot, target
+
+
+class TestSimulate:
+    """Tests for replaying days on a simulated clock."""
+
+    def test_leap_day_events_are_only_due_on_leap_years(self):
+        """Feb 29 events should be posted on Feb 29, and skipped otherwise."""
+        clock = SimulatedClock(datetime.datetime(2023, 1, 1, tzinfo=UTC))
+        bot, target = simulated_bot(
+            [
+                (datetime.datetime(2000, 2, 28, 12, tzinfo=UTC), "Eve.", None),
+                (datetime.datetime(2000, 2, 29, 12, tzinfo=UTC), "Leap.", None),
+                (datetime.datetime(2001, 3, 1, 12, tzinfo=UTC), "March.", None),
+            ],
+            clock,
+        )
+
+        reports = [
+            *simulate(
+                bot, clock, datetime.date(2023, 2, 28), datetime.date(2023, 3, 1)
+            ),
+            *simulate(
+                bot, clock, datetime.date(2024, 2, 28), datetime.date(2024, 3, 1)
+            ),
+        ]
+
+        assert [(str(r.day), r.due, r.posted) for r in reports] == [
+            ("2023-02-28", 1, 1),
+            ("2023-03-01", 1, 1),
+            ("2024-02-28", 1, 1),
+            ("2024-02-29", 1, 1),
+            ("2024-03-01", 1, 1),
+        ]
+        assert all(report.consistent for report in reports)
+        assert target.posts == 5
+
+    def test_leap_day_events_are_reported_in_non_leap_years(self):
+        """Feb 29 events never due should be counted once per non-leap year."""
+        clock = SimulatedClock(datetime.datetime(2023, 1, 1, tzinfo=UTC))
+        bot, target = simulated_bot(
+            [
+                (datetime.datetime(year, 2, 29, 12, tzinfo=UTC), "Leap.", None)
+                for year in (1996, 2000, 2004)
+            ],
+            clock,
+        )
+
+        reports = list(
+            simulate(bot, clock, datetime.date(2023, 2, 1), datetime.date(2024, 3, 31))
+        )
+
+        assert {str(r.day): r.skipped for r in reports if r.skipped} == {
+            "2023-02-28": 3
+        }
+        assert all(report.consistent for report in reports)
+        assert target.posts == 3
+
+    def test_full_year_is_consistent(self):
+        """Every event of a random corpus should be posted once on its day."""
+        clock = SimulatedClock(datetime.datetime(2024, 1, 1, tzinfo=UTC))
+        bot, target = simulated_bot(random_corpus(2000), clock)
+
+        reports = list(
+            simulate(bot, clock, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+        )
+
+        assert len(reports) == 366
+        assert all(report.consistent for report in reports)
+        assert sum(report.posted for report in reports) == target.posts == 2000
+        assert target.too_long == 0
+
+
+class TestSimulatedClock:
+    """Tests for the clock standing still."""
+
+    def test_moves_only_when_told(self):
+        """The clock should only change when set or advanced."""
+        clock = SimulatedClock(datetime.datetime(2024, 2, 29, 8, tzinfo=UTC))
+
+        clock.advance(datetime.timedelta(days=1))
+
+        assert clock() == clock() == datetime.datetime(2024, 3, 1, 8, tzinfo=UTC)
+
+    def test_rejects_naive_times(self):
+        """Naive times would not compare with the stored aware dates."""
+        with pytest.raises(ValueError):
+            SimulatedClock(datetime.datetime(2024, 2, 29))
@@ -0,0 +1,60 @@
+"""Tests for the validation and metadata of text templates."""
+
+import pytest
+from babel import Locale
+
+from almanacbot.templates import (
+    TemplateError,
+    TemplateInfo,
+    analyze,
+    date_max_length,
+    weighted_length,
+)
+
+CATALAN = Locale.parse("ca_ES")
+ENGLISH = Locale.parse("en_GB")
+
+
+class TestAnalyze:
+    """Tests for the parsing of ephemeris texts."""
+
+    def test_finds_placeholders_and_static_length(self):
+        """Placeholders should be listed and left out of the static length."""
+        info = analyze("El ${date}, avui fa $years_ago anys.")
+
+        assert info == TemplateInfo(
+            placeholders=("date", "years_ago"), static_length=len("El , avui fa  anys.")
+        )
+
+    def test_escaped_dollars_are_static(self):
+        """An escaped $$ should count as a single static $."""
+        assert analyze("Costava $$5.") == TemplateInfo((), len("Costava $5."))
+
+    @pytest.mark.parametrize(
+        "text", ["Fa ${anys} anys.", "Fa ${years_ago anys.", "Costava 5$ o $."]
+    )
+    def test_rejects_broken_templates(self, text):
+        """Unknown placeholders and stray $ should raise at ingest."""
+        with pytest.raises(TemplateError):
+            analyze(text)
+
+
+class TestLengths:
+    """Tests for the weighted tweet lengths."""
+
+    def test_weighted_length(self):
+        """CJK and emoji should weigh 2, URLs 23."""
+        assert weighted_length("Hola") == 4
+        assert weighted_length("日本") == 4
+        assert weighted_length("🎉") == 2
+        assert weighted_length("Vegeu https://example.com/a/very/long/path") == 29
+
+    def test_max_length_covers_the_longest_date(self):
+        """The worst case should use the longest date of every locale."""
+        info = analyze("${date}: ${years_ago} anys")
+
+        assert date_max_length(CATALAN) == len("divendres, 13 de setembre del 2024")
+        assert info.max_length([CATALAN]) == date_max_length(CATALAN) + 4 + 7
+        assert info.max_length([CATALAN, ENGLISH]) == max(
+            info.max_length([CATALAN]), info.max_length([ENGLISH])
+        )
@@ -0,0 +1,193 @@
+"""Tests for the spans of runs and their exporters."""
+
+import contextvars
+import datetime
+import json
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from almanacbot import tracing
+from almanacbot.almanacbot import AlmanacBot, Channel
+from almanacbot.memory_storage import MemoryStorage
+from almanacbot.publisher import FanOutPublisher
+from tests.test_publisher import FakeTarget
+
+
+@pytest.fixture
+def traces(tmp_path):
+    """Path of the OTLP/JSON lines file spans are exported to."""
+    path = tmp_path / "traces.jsonl"
+    tracing.configure(str(path))
+    yield path
+    tracing.configure(None)
+
+
+def read_spans(path) -> list:
+    tracing.flush()
+    return [
+        span
+        for line in path.read_text(encoding="UTF-8").splitlines()
+        for resource in json.loads(line)["resourceSpans"]
+        for scope in resource["scopeSpans"]
+        for span in scope["spans"]
+    ]
+
+
+def attributes(span: dict) -> dict:
+    return {
+        attribute["key"]: next(iter(attribute["value"].values()))
+        for attribute in span["attributes"]
+    }
+
+
+class TestDisabled:
+    """Tests for tracing without a destination."""
+
+    def test_spans_are_a_shared_no_op(self):
+        assert not tracing.enabled()
+        with tracing.span("run", run_id="abc") as span:
+            span.set("posted", 1)
+        assert tracing.span("other") is span
+
+    def test_traced_functions_are_called_directly(self):
+        @tracing.traced("double", value="value")
+        def double(value):
+            return value * 2
+
+        assert double(2) == 4
+        assert double.__name__ == "double"
+
+
+class TestSpans:
+    """Tests for nesting, tagging and exporting spans."""
+
+    def test_children_share_the_trace_of_their_parent(self, traces):
+        with tracing.span("run", run_id="abc") as run:
+            with tracing.span("select"):
+                pass
+            run.set("posted", 2)
+        with tracing.span("run"):
+            pass
+
+        select, first, second = read_spans(traces)
+        assert select["traceId"] == first["traceId"] != second["traceId"]
+        assert select["parentSpanId"] == first["spanId"]
+        assert "parentSpanId" not in first
+        assert attributes(first) == {"run_id": "abc", "posted": "2"}
+        assert int(first["startTimeUnixNano"]) <= int(select["startTimeUnixNano"])
+        assert int(select["endTimeUnixNano"]) <= int(first["endTimeUnixNano"])
+
+    def test_errors_set_the_status(self, traces):
+        with pytest.raises(ConnectionError):
+            with tracing.span("post"):
+                raise ConnectionError("twitter is down")
+
+        (span,) = read_spans(traces)
+        assert span["status"] == {
+            "code": 2,
+            "message": "ConnectionError: twitter is down",
+        }
+
+    def test_traced_calls_are_tagged_with_arguments(self, traces):
+        @tracing.traced("mark", ephemeris_id="eph_ids", target="target")
+        def mark(eph_ids, target=None):
+            return len(eph_ids)
+
+        assert mark([1, 2]) == 2
+
+        (span,) = read_spans(traces)
+        assert span["name"] == "mark"
+        assert span["attributes"] == [
+            {
+                "key": "ephemeris_id",
+                "value": {
+                    "arrayValue": {"values": [{"intValue": "1"}, {"intValue": "2"}]}
+                },
+            }
+        ]
+
+    def test_threads_continue_the_trace_of_their_caller(self, traces):
+        def post():
+            with tracing.span("post"):
+                pass
+
+        with tracing.span("publish"):
+            worker = threading.Thread(
+                target=contextvars.copy_context().run, args=(post,)
+            )
+            worker.start()
+            worker.join()
+
+        post, publish = read_spans(traces)
+        assert post["parentSpanId"] == publish["spanId"]
+        assert post["traceId"] == publish["traceId"]
+
+    def test_batches_are_exported_when_full(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        tracing.configure(str(path), batch_size=2)
+        try:
+            for _ in range(3):
+                with tracing.span("render"):
+                    pass
+            assert len(path.read_text(encoding="UTF-8").splitlines()) == 1
+        finally:
+            tracing.configure(None)
+        assert len(path.read_text(encoding="UTF-8").splitlines()) == 2
+
+    def test_posts_batches_to_a_collector(self):
+        tracer = tracing.configure("http://localhost:4318/v1/traces")
+        try:
+            with patch.object(tracer.exporter._session, "post") as post:
+                with tracing.span("run"):
+                    pass
+                tracing.flush()
+        finally:
+            tracing.configure(None)
+
+        url = post.call_args.args[0]
+        request = post.call_args.kwargs["json"]
+        assert url == "http://localhost:4318/v1/traces"
+        (resource,) = request["resourceSpans"]
+        assert resource["scopeSpans"][0]["spans"][0]["name"] == "run"
+
+    def test_export_errors_are_not_raised(self, tmp_path):
+        tracing.configure(str(tmp_path / "missing" / "traces.jsonl"))
+        try:
+            with tracing.span("run"):
+                pass
+            tracing.flush()
+        finally:
+            tracing.configure(None)
+
+
+class TestRunTrace:
+    """Tests for the spans of a bot run."""
+
+    def test_stages_are_spans_of_the_run(self, traces):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        storage = MemoryStorage([(now, "One ${years_ago}.", None)])
+        target = FakeTarget("twitter")
+        bot = AlmanacBot.from_channels(
+            [Channel("default", storage, FanOutPublisher([target]))]
+        )
+
+        assert bot.run() == 1
+
+        spans = {span["name"]: span for span in read_spans(traces)}
+        assert set(spans) == {
+            "run",
+            "channel",
+            "select",
+            "publish",
+            "render",
+            "post",
+            "acknowledge",
+        }
+        assert len({span["traceId"] for span in spans.values()}) == 1
+        eph_id = str(storage.get_today_ephemeris()[0].id)
+        assert attributes(spans["render"])["ephemeris_id"] == eph_id
+        assert attributes(spans["post"])["target"] == "twitter"
+        assert spans["post"]["parentSpanId"] == spans["publish"]["spanId"]
+        assert spans["acknowledge"]["parentSpanId"] == spans["publish"]["spanId"]